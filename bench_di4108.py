@@ -0,0 +1,240 @@
+'''
+Benchmarks of the DI-4108 data path, run against the simulated device (see di4108_sim) and a
+server on the loopback interface, so they need no hardware.  Each measures a likely ceiling on
+the sampling rate that can be sustained:
+
+    decode - DI4108_WRAPPER.convert_bytes_to_int and convert_data, and their numpy
+        counterparts in di4108_decode (demux, convert) [MS/s - million values per second]
+    acq - the trig_data_pulse loop, reading a simulated device in real time, for a grid of
+        sampling frequency and number of channels; a configuration is sustained if every
+        sample arrives and none overflow.  Reports the highest fs sustained for each number of
+        channels, and the highest aggregate rate [MS/s].  (The loop's last poll may end before
+        all its samples are in, so 90% of the samples of the pulse count as every sample.)
+    latency - end-to-end time of a shot through a server (init, trigger and wait, store), and
+        its overhead beyond the pulse itself [s]
+    server - rate at which a server sends a shot with store, raw and demultiplexed [MB/s]
+
+Results are written as JSON: each metric with its value, unit, and whether higher or lower
+is better, plus the details behind it.  Saved results can serve as a baseline: metrics worse
+than the baseline's by more than the tolerance are reported as regressions, and the exit
+status is then 1.
+
+The server benchmarks run in a temporary directory, where the server keeps its settings.
+
+USAGE:
+    python3 bench_di4108.py [--quick] [--only decode,acq,latency,server] [--output results.json]
+        [--baseline baseline.json] [--tolerance 0.2]
+e.g.
+    python3 bench_di4108.py --output baseline.json
+    ...change code...
+    python3 bench_di4108.py --baseline baseline.json
+'''
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import numpy
+from digitizer_models import DI4108_WRAPPER
+from di4108_sim import SimulatedDI4108
+from di4108_decode import demux, convert
+
+BENCHMARKS=['decode','acq','latency','server']
+
+def best_time(fn,min_time=0.5,min_reps=3):
+    '''
+    Call fn repeatedly, for at least min_time [s] and min_reps times; return the shortest
+    time any one call took [s].
+    '''
+    best=float('inf')
+    t_end=time.perf_counter()+min_time
+    n=0
+    while n<min_reps or time.perf_counter()<t_end :
+        t=time.perf_counter()
+        fn()
+        best=min(best,time.perf_counter()-t)
+        n+=1
+    return best
+
+def simulated_device(realtime=False,**settings):
+    return DI4108_WRAPPER(dev=SimulatedDI4108(realtime=realtime),**settings)
+
+def bench_decode(metrics,details,quick):
+    device=simulated_device(chans=8)
+    n_records=device.number_records
+    #Pure-Python conversions are slow - give them fewer samples
+    raw_small=device.dev.frames(0,2000 if quick else 20000)
+    raw=numpy.tile(numpy.frombuffer(raw_small,dtype='<i2'),10).tobytes()
+    values=DI4108_WRAPPER.convert_bytes_to_int(raw_small)
+    n_small=len(raw_small)//2
+    n=len(raw)//2
+    layout=device.record_layout()
+    min_time=0.2 if quick else 1.0
+    t=best_time(lambda : DI4108_WRAPPER.convert_bytes_to_int(raw_small),min_time)
+    metrics['decode.convert_bytes_to_int']=(n_small/t/1E6,'MS/s','higher')
+    t=best_time(lambda : device.convert_data(values),min_time)
+    metrics['decode.convert_data']=(n_small/t/1E6,'MS/s','higher')
+    #demux alone only makes a view - time it with the copy to contiguous records
+    t=best_time(lambda : numpy.ascontiguousarray(demux(raw,n_records)),min_time)
+    metrics['decode.demux']=(n/t/1E6,'MS/s','higher')
+    chan_data=numpy.ascontiguousarray(demux(raw,n_records))
+    t=best_time(lambda : convert(chan_data,layout),min_time)
+    metrics['decode.convert']=(n/t/1E6,'MS/s','higher')
+    details['decode']={'records':n_records,'values_python':n_small,'values_numpy':n}
+
+def bench_acq(metrics,details,quick):
+    pulse_duration=0.2 if quick else 0.5
+    rates=[10E3,40E3,160E3] if quick else [10E3,20E3,40E3,80E3,160E3]
+    grid=[]
+    for nchans in ([1,8] if quick else [1,2,4,8]) :
+        max_fs=None
+        for fs in rates :
+            device=simulated_device(realtime=True,fs=fs,chans=nchans)
+            t=time.perf_counter()
+            (data,elapsed_time,raw_data)=device.trig_data_pulse(pulse_duration)
+            seconds=time.perf_counter()-t
+            samples=len(raw_data)//(2*device.number_records)
+            expected=int(fs*pulse_duration)
+            ok=samples>=0.9*expected and device.dev.overflows==0
+            grid.append({'fs':fs,'chans':nchans,'samples':samples,'expected':expected,\
+                'overflows':device.dev.overflows,'seconds':seconds,'ok':ok})
+            if not ok :
+                break #Higher rates will not do better
+            max_fs=fs
+        metrics['acq.max_fs.chans_{}'.format(nchans)]=(max_fs or 0.0,'Hz','higher')
+    sustained=[g['fs']*g['chans'] for g in grid if g['ok']]
+    metrics['acq.max_aggregate_rate']=(max(sustained+[0.0])/1E6,'MS/s','higher')
+    details['acq']={'pulse_duration':pulse_duration,'grid':grid}
+
+@contextlib.contextmanager
+def loopback_server(simulate):
+    '''
+    Serve a simulated site on a free loopback port, in a temporary directory; yields the
+    port.
+    '''
+    import di4108_server
+    cwd=os.getcwd()
+    with tempfile.TemporaryDirectory() as directory :
+        os.chdir(directory)
+        try :
+            with socket.socket() as s :
+                s.bind(('localhost',0))
+                port=s.getsockname()[1]
+            di4108_server.add_site(port,simulate=simulate)
+            server=di4108_server.ThreadedTCPServer(('localhost',port),di4108_server.ThreadedTCPRequestHandler)
+            threading.Thread(target=server.serve_forever,daemon=True).start()
+            try :
+                yield port
+            finally :
+                server.shutdown()
+                server.server_close()
+        finally :
+            os.chdir(cwd)
+
+def bench_latency(metrics,details,quick):
+    from di4108_client import DI4108Client
+    fs=10000
+    n_samps=1000 #0.1 s pulse
+    n_shots=3 if quick else 10
+    shots=[]
+    with loopback_server({'realtime':True}) as port :
+        with DI4108Client('localhost',port) as client :
+            for i in range(n_shots) :
+                t0=time.perf_counter()
+                client.init(fs=fs,chans=8,n_samps_post=n_samps)
+                t1=time.perf_counter()
+                client.acquire(30.0)
+                t2=time.perf_counter()
+                client.store_raw()
+                t3=time.perf_counter()
+                shots.append({'init':t1-t0,'acquire':t2-t1,'store':t3-t2,'total':t3-t0})
+    total=float(numpy.median([s['total'] for s in shots]))
+    metrics['latency.shot']=(total,'s','lower')
+    metrics['latency.overhead']=(total-n_samps/float(fs),'s','lower')
+    details['latency']={'fs':fs,'n_samps_post':n_samps,'shots':shots}
+
+def bench_server(metrics,details,quick):
+    from di4108_client import DI4108Client
+    fs=160E3
+    n_samps=int(fs*(0.25 if quick else 1.0))
+    n_reps=3 if quick else 10
+    results={}
+    with loopback_server({'realtime':False}) as port :
+        with DI4108Client('localhost',port) as client :
+            client.init(fs=fs,chans=8,n_samps_post=n_samps)
+            client.acquire(60.0)
+            n_bytes=client.query_data_length()
+            out=bytearray(n_bytes*2) #Room for float32
+            for (name,fetch) in [('raw',lambda : client.store_raw(out)),\
+                ('int16',lambda : client.store('int16',out=out)),\
+                ('float32',lambda : client.store('float32',out=out))] :
+                t=best_time(fetch,0.0,n_reps)
+                results[name]=t
+                n=n_bytes*(2 if name=='float32' else 1)
+                metrics['server.store_{}'.format(name)]=(n/t/1E6,'MB/s','higher')
+    details['server']={'fs':fs,'n_samps_post':n_samps,'shot_bytes':n_bytes,'seconds':results}
+
+def run(benchmarks,quick=False):
+    '''
+    Run the named benchmarks.  Returns the results, as written to JSON.
+    '''
+    metrics={}
+    details={}
+    for name in benchmarks :
+        #Keep stdout for the results - device and server chatter goes to stderr
+        with contextlib.redirect_stdout(sys.stderr) :
+            globals()['bench_'+name](metrics,details,quick)
+    return {'version':1,'time':time.strftime('%Y-%m-%dT%H:%M:%S'),'host':platform.node(),\
+        'python':platform.python_version(),'numpy':numpy.__version__,'quick':quick,\
+        'metrics':dict([(k,{'value':v,'unit':u,'better':b}) for (k,(v,u,b)) in metrics.items()]),\
+        'details':details}
+
+def compare(results,baseline,tolerance=0.2):
+    '''
+    Compare results with baseline results.  Returns list of (metric, value, baseline value,
+    relative change, regressed) for metrics in both - regressed if worse than the baseline by
+    more than tolerance (a fraction).
+    '''
+    comparison=[]
+    for (name,metric) in sorted(results['metrics'].items()) :
+        if not name in baseline['metrics'] :
+            continue
+        (value,base)=(metric['value'],baseline['metrics'][name]['value'])
+        change=(value-base)/base if base else 0.0
+        worse=-change if metric['better']=='higher' else change
+        comparison.append((name,value,base,change,worse>tolerance))
+    return comparison
+
+if __name__ == "__main__":
+    parser=argparse.ArgumentParser(description='Benchmark the DI-4108 data path against a simulated device')
+    parser.add_argument('--quick',action='store_true',help='fewer, shorter runs')
+    parser.add_argument('--only',default=','.join(BENCHMARKS),help='comma-separated benchmarks, of '+', '.join(BENCHMARKS))
+    parser.add_argument('--output',help='file to write results to (default=stdout)')
+    parser.add_argument('--baseline',help='results file to compare with')
+    parser.add_argument('--tolerance',type=float,default=0.2,help='fraction a metric may be worse than the baseline')
+    args=parser.parse_args()
+    benchmarks=args.only.split(',')
+    for name in benchmarks :
+        if not name in BENCHMARKS :
+            parser.error("Unknown benchmark {} - benchmarks are {}".format(name,', '.join(BENCHMARKS)))
+    results=run(benchmarks,args.quick)
+    if args.output is None :
+        print(json.dumps(results,indent=1))
+    else :
+        with open(args.output,'w') as f :
+            json.dump(results,f,indent=1)
+    for (name,metric) in sorted(results['metrics'].items()) :
+        sys.stderr.write('{:32s} {:12.4g} {}\n'.format(name,metric['value'],metric['unit']))
+    if not args.baseline is None :
+        with open(args.baseline) as f :
+            comparison=compare(results,json.load(f),args.tolerance)
+        regressions=[c for c in comparison if c[4]]
+        for (name,value,base,change,regressed) in comparison :
+            sys.stderr.write('{:32s} {:12.4g} vs {:12.4g} {:+7.1%}{}\n'.format(name,value,base,change,' REGRESSION' if regressed else ''))
+        if len(regressions)>0 :
+            sys.exit(1)
@@ -0,0 +1,2 @@
+#Hardware scripts and data-parsing scripts, run by hand against a real DI-4108 - not pytest tests
+collect_ignore=['test_di4108.py','test_di4108_server.py','parse_data_test.py']
@@ -0,0 +1,458 @@
+'''
+asyncio client for collecting shots from many DI-4108 servers at once - e.g. one Raspberry Pi
+per digitizer.  Each node is triggered, waited on and fetched in its own task, so collecting a
+shot takes as long as the slowest node, not the sum over all nodes.  A node that fails or
+misses its timeout is reported in the results without holding up the others.
+
+Shots are received with recv_into straight into a buffer kept per node - the small array
+header apart, so that only the data need room - and scaled into a float32 buffer kept per
+node.  Both are reused from shot to shot and only reallocated if a shot outgrows them.
+
+The clock of each node is tracked by ping (see di4108_clock) in the background, on a
+connection of its own (see ClockTracker), so pings never wait on a shot, nor delay a trigger;
+each shot's start time is given on the local clock, from the estimate over the recent window
+of pings, with its uncertainty.
+
+USAGE:
+    async def main():
+        async with ShotCollector(['pi1:4220','pi2:4220','pi3:4220'],timeout=15) as collector :
+            await collector.init(fs=10000,n_samps_post=10000)
+            results=await collector.shot()
+            for result in results :
+                if result.ok :
+                    print(result.node,result.array.shape)
+                else :
+                    print(result.node,'failed:',result.error)
+    asyncio.run(main())
+'''
+import time
+import socket
+import asyncio
+import threading
+import numpy
+from di4108_protocol import NEGOTIATE, PROTOCOL_VERSION, HEADER, FLAG_JSON, FLAG_ERROR, OP, \
+    ProtocolError, encode_header, encode_body, decode_header, decode_body
+from di4108_decode import ARRAY_PREFIX_SIZE, array_header_length, map_array, convert
+from di4108_client import CommandError
+from di4108_clock import ClockEstimator
+import di4108_log
+from di4108_log import debugging
+
+LOG=di4108_log.get_logger('async_client')
+
+async def sock_recv_into_exactly(sock,view):
+    '''
+    Fill the writable buffer, view, from the non-blocking socket, sock, on the running loop.
+    '''
+    loop=asyncio.get_running_loop()
+    view=memoryview(view).cast('B')
+    n_read=0
+    while n_read<len(view) :
+        n=await loop.sock_recv_into(sock,view[n_read:])
+        if n==0 :
+            raise ProtocolError("Connection closed after {} of {} bytes".format(n_read,len(view)))
+        n_read+=n
+    return view
+
+class AsyncDI4108Client:
+    '''
+    Coroutine counterpart of di4108_client.DI4108Client: one persistent framed-protocol
+    connection to one server site, reopened by the next command if a command fails or is
+    cancelled (e.g. by asyncio.wait_for timing out).  Commands have no timeout of their own -
+    wrap them in asyncio.wait_for.
+    '''
+    def __init__(self,host='localhost',port=4220):
+        self.host=host
+        self.port=port
+        self.sock=None
+        self.request_id=0
+        self.header=bytearray(HEADER.size)
+        self.clock=ClockEstimator() #Server clock relative to this one
+
+    async def connect(self):
+        if self.sock is None :
+            loop=asyncio.get_running_loop()
+            infos=await loop.getaddrinfo(self.host,self.port,type=socket.SOCK_STREAM)
+            (family,sock_type,proto,canonname,address)=infos[0]
+            sock=socket.socket(family,sock_type,proto)
+            try :
+                sock.setblocking(False)
+                sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+                await loop.sock_connect(sock,address)
+                await loop.sock_sendall(sock,NEGOTIATE)
+                version=bytearray(1)
+                await sock_recv_into_exactly(sock,version)
+                if version[0]!=PROTOCOL_VERSION :
+                    raise ProtocolError("Server speaks protocol version {}, expected {}".format(version[0],PROTOCOL_VERSION))
+            except :
+                sock.close()
+                raise
+            self.sock=sock
+        return self.sock
+
+    def close(self):
+        if not self.sock is None :
+            try :
+                self.sock.close()
+            finally :
+                self.sock=None
+
+    async def request(self,opcode,body=None):
+        '''
+        Send a request and receive the header of its reply, returning (flags, length) - the
+        caller must then receive the length bytes of its body.  Raises CommandError, having
+        received the body, if the server reports an error.
+        '''
+        sock=await self.connect()
+        loop=asyncio.get_running_loop()
+        self.request_id=(self.request_id+1)&0xFFFFFFFF
+        (payload,flags)=encode_body(body)
+        await loop.sock_sendall(sock,encode_header(opcode,flags,self.request_id,len(payload))+bytes(payload))
+        await sock_recv_into_exactly(sock,self.header)
+        (reply_opcode,flags,reply_id,length)=decode_header(self.header)
+        if reply_id!=self.request_id :
+            raise ProtocolError("Reply to request {} received while waiting for request {}".format(reply_id,self.request_id))
+        if flags & FLAG_ERROR :
+            reply=await sock_recv_into_exactly(sock,bytearray(length))
+            raise CommandError("{} failed: {}".format(OP.names.get(reply_opcode,reply_opcode),bytes(reply).decode()))
+        return (flags,length)
+
+    async def call(self,opcode,body=None,out=None):
+        '''
+        Send a request and return (flags, body) of its reply, with the body received into out
+        if it fits (see DI4108Client.recv).  Raises CommandError if the server reports an error.
+        '''
+        try :
+            (flags,length)=await self.request(opcode,body)
+            if out is None or memoryview(out).nbytes<length :
+                reply=bytearray(length)
+            else :
+                reply=memoryview(out).cast('B')[:length]
+            await sock_recv_into_exactly(self.sock,reply)
+        except CommandError :
+            raise #Connection is still in step
+        except :
+            #Including cancellation - the connection may be mid-frame
+            self.close()
+            raise
+        return (flags,reply)
+
+    async def call_json(self,opcode,body=None):
+        (flags,reply)=await self.call(opcode,body)
+        return decode_body(reply,flags|FLAG_JSON)
+
+    async def init(self,**settings):
+        await self.call(OP.INIT,settings)
+
+    async def trig_pulse(self):
+        return await self.call_json(OP.TRIG_PULSE)
+
+    async def wait(self,job=None,timeout=None):
+        args={}
+        if not job is None :
+            args['job']=job
+        if not timeout is None :
+            args['timeout']=timeout
+        return await self.call_json(OP.WAIT,args)
+
+    async def status(self,job=None):
+        return await self.call_json(OP.STATUS,None if job is None else {'job':job})
+
+    async def get_settings(self):
+        return await self.call_json(OP.GET_SETTINGS)
+
+    async def query_data_length(self):
+        (flags,reply)=await self.call(OP.QUERY_DATA_LENGTH)
+        return int(reply)
+
+    async def ping(self):
+        '''
+        See DI4108Client.ping.
+        '''
+        t1=time.time()
+        reply=await self.call_json(OP.PING)
+        t4=time.time()
+        return self.clock.add(t1,reply['t_recv'],reply['t_send'],t4)
+
+    async def sync_clock(self,n_pings=8):
+        for i in range(n_pings) :
+            await self.ping()
+        return self.clock.estimate()
+
+    def shot_start(self,desc):
+        '''
+        See DI4108Client.shot_start - but the clock must already have been estimated.
+        '''
+        if desc.get('t_start') is None :
+            raise ValueError("Shot has no start time")
+        (t_start,uncertainty)=self.clock.to_local(desc['t_start'])
+        return (t_start,uncertainty+(desc.get('t_start_uncertainty') or 0.0))
+
+    async def store_raw(self,out=None):
+        (flags,reply)=await self.call(OP.STORE,out=out)
+        return reply
+
+    async def store(self,format='int16',byteorder='native',out=None):
+        (flags,reply)=await self.call(OP.STORE,{'format':format,'byteorder':byteorder},out=out)
+        return reply
+
+    async def store_array(self,format='int16',byteorder='native',out=None):
+        '''
+        Fetch the last shot demultiplexed by the server, receiving its header on its own and
+        its data straight into out (a writable buffer - query_data_length() bytes hold a
+        shot in format 'int16') if they fit, else into a new bytearray.  Returns (array,
+        desc, buffer), with the array mapped onto buffer, without copying.
+        '''
+        try :
+            (flags,length)=await self.request(OP.STORE,{'format':format,'byteorder':byteorder})
+            prefix=await sock_recv_into_exactly(self.sock,bytearray(ARRAY_PREFIX_SIZE))
+            header=await sock_recv_into_exactly(self.sock,bytearray(array_header_length(prefix)))
+            n_bytes=length-len(prefix)-len(header)
+            if out is None or memoryview(out).nbytes<n_bytes :
+                out=bytearray(n_bytes)
+            await sock_recv_into_exactly(self.sock,memoryview(out).cast('B')[:n_bytes])
+        except CommandError :
+            raise
+        except :
+            self.close()
+            raise
+        (array,desc)=map_array(memoryview(out).cast('B')[:n_bytes],header)
+        return (array,desc,out)
+
+class NodeResult:
+    '''
+    Outcome of one collection step on one node.  ok is True if it succeeded; otherwise error
+    holds the exception (asyncio.TimeoutError if the node missed its timeout).
+
+    For a shot, array is the node's shot (one row per record, see ShotCollector.shot), desc
+    its description, status the status of its acquisition job, and t_start the time it
+    started on the local clock, within t_start_uncertainty [s], from clock, the estimate of the
+    node's clock (see ClockEstimator.estimate).  seconds is how long the node took, or was
+    given before it timed out.
+    '''
+    def __init__(self,node):
+        self.node=node
+        self.ok=False
+        self.error=None
+        self.status=None
+        self.array=None
+        self.desc=None
+        self.t_start=None
+        self.t_start_uncertainty=None
+        self.clock=None
+        self.seconds=None
+
+    def __repr__(self):
+        return 'NodeResult({!r}, ok={}, seconds={}, error={!r})'.format(self.node,self.ok,self.seconds,self.error)
+
+class CollectResults(list):
+    '''
+    List of NodeResult, in the order the nodes were given, with the failures also in failed.
+    '''
+    @property
+    def ok(self):
+        return len(self.failed)==0
+
+    @property
+    def failed(self):
+        return [r for r in self if not r.ok]
+
+def parse_node(node,default_port=4220):
+    '''
+    Return (host, port) of node, given as 'host', 'host:port', or a (host, port) tuple.
+    '''
+    if isinstance(node,str) :
+        (host,sep,port)=node.rpartition(':')
+        if sep=='' :
+            return (node,default_port)
+        return (host,int(port))
+    return (node[0],int(node[1]))
+
+class ClockTracker:
+    '''
+    Ping a set of nodes every interval [s], on a thread and event loop of its own, each over a
+    connection of its own, adding each exchange to the node's ClockEstimator, which thereby
+    holds a sliding window of recent exchanges.  A node that fails to answer within timeout [s]
+    is skipped until the next round.
+
+    USAGE:
+        tracker=ClockTracker(nodes,clocks) #nodes as (host, port), clocks the ClockEstimator of each
+        tracker.start()
+        ...
+        tracker.stop()
+    '''
+    def __init__(self,nodes,clocks,interval=1.0,timeout=5.0):
+        self.clients=[AsyncDI4108Client(host,port) for (host,port) in nodes]
+        for (client,clock) in zip(self.clients,clocks) :
+            client.clock=clock
+        self.interval=interval
+        self.timeout=timeout
+        self.loop=None
+        self.task=None
+        self.started=threading.Event()
+        self.thread=threading.Thread(target=self.run,name='di4108-clock',daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.started.wait()
+
+    def run(self):
+        self.loop=asyncio.new_event_loop()
+        try :
+            self.task=self.loop.create_task(self.ping_forever())
+            self.started.set()
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError :
+            pass
+        finally :
+            for client in self.clients :
+                client.close()
+            self.loop.close()
+
+    async def ping(self,client):
+        try :
+            await asyncio.wait_for(client.ping(),self.timeout)
+        except Exception as e :
+            if debugging():
+                LOG.debug("Ping of %s:%s failed: %r",client.host,client.port,e)
+
+    async def ping_forever(self):
+        while True :
+            await asyncio.gather(*[self.ping(client) for client in self.clients])
+            await asyncio.sleep(self.interval)
+
+    def stop(self):
+        if self.thread.is_alive() :
+            self.loop.call_soon_threadsafe(self.task.cancel)
+            self.thread.join(self.timeout)
+
+class ShotCollector:
+    '''
+    Trigger, wait on, and fetch shots from many DI-4108 server sites concurrently.  See
+    module documentation.
+    '''
+    def __init__(self,nodes,timeout=30.0,format='int16',scaled=True,ping_interval=1.0):
+        '''
+        INPUTS:
+            nodes=list of server sites, each 'host', 'host:port', or (host, port)
+            timeout=longest time [s] any one node may take for each step - an init, or
+                trigger, acquisition and transfer of a shot - before it is reported as failed
+            format=format requested from the servers - 'int16' (demultiplexed, half the bytes
+                of float32) or 'float32'
+            scaled=for format 'int16', convert shots to physical units (float32) here
+            ping_interval=time [s] between background pings of each node's clock, which start
+                with the first shot - see ClockTracker
+        '''
+        self.nodes=[parse_node(node) for node in nodes]
+        self.names=['{}:{}'.format(host,port) for (host,port) in self.nodes]
+        self.clients=[AsyncDI4108Client(host,port) for (host,port) in self.nodes]
+        self.buffers=[None]*len(self.nodes) #Receive buffer of each node, reused from shot to shot
+        self.values=[None]*len(self.nodes) #Float32 buffer each node's shots are scaled into
+        self.timeout=timeout
+        self.format=format
+        self.scaled=scaled
+        self.ping_interval=ping_interval
+        self.clock_tracker=None
+
+    def close(self):
+        if not self.clock_tracker is None :
+            self.clock_tracker.stop()
+            self.clock_tracker=None
+        for client in self.clients :
+            client.close()
+
+    def track_clocks(self):
+        '''
+        Start pinging every node in the background, if not already started - see ClockTracker.
+        '''
+        if self.clock_tracker is None :
+            self.clock_tracker=ClockTracker(self.nodes,[client.clock for client in self.clients],\
+                self.ping_interval,min(self.timeout,5.0))
+            self.clock_tracker.start()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self,*exc_info):
+        self.close()
+
+    async def run_node(self,i,step,timeout):
+        result=NodeResult(self.names[i])
+        start=time.perf_counter()
+        try :
+            await asyncio.wait_for(step(i,result),timeout)
+            result.ok=True
+        except Exception as e :
+            result.error=e
+        result.seconds=time.perf_counter()-start
+        return result
+
+    async def run_all(self,step,timeout=None):
+        if timeout is None :
+            timeout=self.timeout
+        return CollectResults(await asyncio.gather(*[self.run_node(i,step,timeout) for i in range(len(self.clients))]))
+
+    def preallocate(self,n_bytes):
+        '''
+        Allocate each node's buffers for shots of up to n_bytes of data (as returned by
+        query_data_length, which int16 shots match - float32 ones take twice as many), so that
+        not even the first shot allocates.  The array header of each shot is received apart
+        from its data, so needs no room here.
+        '''
+        self.buffers=[bytearray(n_bytes) if b is None or len(b)<n_bytes else b for b in self.buffers]
+        if self.scaled and self.format=='int16' :
+            n_values=n_bytes//2
+            self.values=[numpy.empty(n_values,dtype=numpy.float32) if v is None or v.size<n_values else v for v in self.values]
+
+    def scale(self,i,chan_data,layout):
+        '''
+        Convert node i's int16 shot to physical units, into its float32 buffer - grown if the
+        shot outgrows it.
+        '''
+        if self.values[i] is None or self.values[i].size<chan_data.size :
+            self.values[i]=numpy.empty(chan_data.size,dtype=numpy.float32)
+        return convert(chan_data,layout,out=self.values[i][:chan_data.size].reshape(chan_data.shape))
+
+    async def init(self,timeout=None,**settings):
+        '''
+        Send the same init to every node.  Returns CollectResults.
+        '''
+        async def step(i,result):
+            await self.clients[i].init(**settings)
+        return await self.run_all(step,timeout)
+
+    async def sync_clocks(self,n_pings=8,timeout=None):
+        '''
+        Ping every node n_pings times, to (re-)estimate its clock.  Returns CollectResults,
+        with each node's clock estimate (see ClockEstimator.estimate) as its status.
+        '''
+        async def step(i,result):
+            result.status=await self.clients[i].sync_clock(n_pings)
+        return await self.run_all(step,timeout)
+
+    async def shot(self,timeout=None):
+        '''
+        Trigger a pulse on every node, wait for it, and fetch it.  Returns CollectResults.
+
+        Each node's array is mapped onto its receive buffer, or, if scaled, converted from it
+        into its float32 buffer - either way it is overwritten by the next shot, so copy any
+        to be kept.
+        '''
+        self.track_clocks()
+        async def step(i,result):
+            client=self.clients[i]
+            if not client.clock.ready :
+                await client.sync_clock()
+            job=await client.trig_pulse()
+            #Timeout is enforced here, by wait_for, so the server may hold the wait indefinitely
+            result.status=await client.wait(job['job'])
+            if result.status['state']!='done' :
+                raise CommandError("Acquisition failed: {}".format(result.status['error']))
+            (result.array,result.desc,self.buffers[i])=await client.store_array(self.format,out=self.buffers[i])
+            if self.scaled and self.format=='int16' :
+                result.array=self.scale(i,result.array,result.desc['layout'])
+            #Clock estimate over the recent window of background pings
+            result.clock=client.clock.estimate()
+            if not result.desc.get('t_start') is None :
+                (result.t_start,result.t_start_uncertainty)=client.shot_start(result.desc)
+        return await self.run_all(step,timeout)
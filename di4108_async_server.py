@@ -0,0 +1,239 @@
+'''
+asyncio entry point for the DI-4108 server.  Speaks the same protocols as di4108_server
+(framed, and legacy tags) and runs the same commands, but socket I/O is event-driven on a
+single thread, so hundreds of idle or monitoring clients cost no OS thread each.  Device work
+runs on the executor of the connection's site (see di4108_server.DI4108Site), a single
+dedicated worker thread per device: a trigger only queues an acquisition job there, and an
+init, which waits for its turn in that queue, runs on a worker thread, so neither stalls the
+event loop.  So does any other command that may touch the device or work on shot data -
+demultiplexing, scaling, reducing and compressing - and so does drawing each piece of a
+compressed reply; only commands that cost no more than a lookup run on the loop itself.
+Worker threads come from a pool of the server's own, of COMMAND_THREADS, so that blocking
+commands neither take the threads the loop needs for its own work, nor grow without bound.  A
+wait request, and the pulse of a legacy <trig_pulse>, are awaited on the loop, so long-polling
+clients hold no thread either.
+
+The streaming and state broadcast services of each site are served on the same loop, each
+subscriber a task, woken as data are published (see di4108_stream.serve_subscriber).
+
+USAGE:
+    python3 di4108_async_server.py [port[:serial_number] ...]
+'''
+import sys
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import di4108_log
+from di4108_server import DI4108Commands, AcqPorts, parse_sites, get_site, debugging
+from di4108_stream import serve_subscriber, serve_status
+from di4108_metrics import METRICS_PORT, MetricsHTTPServer
+from di4108_protocol import NEGOTIATE, PROTOCOL_VERSION, HEADER, OP, decode_header
+
+LOG=di4108_log.get_logger('async_server')
+
+COMMAND_THREADS=8 #Worker threads for commands that may block - see AsyncDI4108Session.run
+COMMAND_EXECUTOR=ThreadPoolExecutor(max_workers=COMMAND_THREADS,thread_name_prefix='di4108-cmd')
+
+class AsyncDI4108Session(DI4108Commands):
+    '''
+    One client connection on the asyncio server.  Replies produced by a command are queued in
+    pending and written by the event loop once the command returns, since blocking commands run
+    on a worker thread.
+    '''
+    #Commands cheap enough to run on the event loop - they never touch the device, nor work on
+    #shot data.  All others (e.g. init, which waits on the site's device queue, store and
+    #get_seg, which decode and compress shots) run on a worker thread
+    INLINE_COMMANDS={'ping','status','wait','metrics','shm','postproc','query_data_length','get_settings'}
+    send_chunk=1024*1024 #Largest piece of a reply handed to the transport at once [bytes]
+
+    def __init__(self,reader,writer):
+        self.reader=reader
+        self.writer=writer
+        self.pending=[]
+        self.pulse=None #Job of a legacy trig_pulse, to await on the loop - see wait_pulse
+
+    def send_raw(self,payload):
+        self.pending.append(payload)
+
+    def send_file(self,f):
+        self.pending.append(f)
+
+    def send_iter(self,pieces):
+        self.pending.append(pieces)
+
+    async def flush(self):
+        '''
+        Write queued replies.  Large buffers are written a chunk at a time, waiting for each to
+        drain, so the transport never buffers a copy of more than one chunk; files are sent
+        with sendfile; iterators of pieces (e.g. compressed chunks) are drawn from only as
+        fast as the client reads.
+        '''
+        pending=self.pending
+        self.pending=[]
+        for item in pending :
+            if hasattr(item,'fileno') :
+                try :
+                    await self.writer.drain()
+                    self.count_sent(await asyncio.get_running_loop().sendfile(self.writer.transport,item))
+                finally :
+                    item.close()
+                continue
+            if hasattr(item,'__next__') :
+                #Each piece may be compressed as it is drawn - draw it on a worker thread
+                while True :
+                    piece=await asyncio.get_running_loop().run_in_executor(COMMAND_EXECUTOR,next,item,None)
+                    if piece is None :
+                        break
+                    await self.write(piece)
+            else :
+                await self.write(item)
+
+    async def write(self,piece):
+        view=memoryview(piece).cast('B')
+        for i in range(0,len(view),AsyncDI4108Session.send_chunk) :
+            self.writer.write(view[i:i+AsyncDI4108Session.send_chunk])
+            await self.writer.drain()
+        self.count_sent(len(view))
+
+    def wait_job(self,job,timeout):
+        #Framed wait requests are awaited in serve before dispatch; legacy requests run on a
+        #worker thread, and may block
+        if not self.framed :
+            super(AsyncDI4108Session,self).wait_job(job,timeout)
+
+    def wait_pulse(self,job):
+        self.pulse=job #Awaited in serve, on the loop, before the next command
+
+    async def await_job(self,body):
+        '''
+        Wait on the event loop for the job of a wait request to finish, or for its timeout.
+        Errors are left for dispatch to report.
+        '''
+        try :
+            (job,timeout)=self.find_job(bytes(body).decode() if len(body)>0 else None)
+        except Exception :
+            return
+        await asyncio.wait([asyncio.wrap_future(job.future)],timeout=timeout)
+
+    async def run(self,blocking,fn,*args):
+        '''
+        Run a command, on a worker thread of COMMAND_EXECUTOR if blocking, else inline on the
+        event loop.
+        '''
+        if blocking :
+            await asyncio.get_running_loop().run_in_executor(COMMAND_EXECUTOR,fn,*args)
+        else :
+            fn(*args)
+
+    def blocking(self,name):
+        '''
+        Whether the named command must run on a worker thread.  Settings changed by another
+        connection are re-applied before dispatch, and re-applying them touches the device, so
+        even a cheap command then runs off the loop.
+        '''
+        return not name in AsyncDI4108Session.INLINE_COMMANDS or self.settings_cache.version!=self.settings_version
+
+    async def run_legacy(self,data):
+        '''
+        Run the commands of a legacy request in order, each on a worker thread or the loop, as
+        a framed request would be, awaiting the pulse of a <trig_pulse> on the loop before
+        going on, so that a following <store> returns its data.
+        '''
+        try :
+            await self.run(True,self.reinitialize)
+            for (name,args) in self.legacy_commands(data) :
+                await self.run(self.blocking(name),self.run_command,name,*args)
+                if not self.pulse is None :
+                    (job,self.pulse)=(self.pulse,None)
+                    await asyncio.wrap_future(job.future)
+                await self.flush()
+        except:
+            LOG.error("Can't handle %r",data)
+            raise
+
+    async def serve(self):
+        '''
+        Serve the connection until the client closes it.  See ThreadedTCPRequestHandler.handle.
+        '''
+        try :
+            #Setting up may open the device, and reads the settings file - not on the loop.
+            #Site is given by the port the client connected to
+            await self.run(True,self.init_commands,self.writer.get_extra_info('sockname')[1],\
+                self.writer.get_extra_info('peername')[0])
+            first=await self.reader.read(1)
+            if len(first)==0 :
+                return
+            self.framed=first==NEGOTIATE
+            if self.framed :
+                self.writer.write(bytes([PROTOCOL_VERSION]))
+                while True :
+                    try :
+                        header=await self.reader.readexactly(HEADER.size)
+                    except asyncio.IncompleteReadError :
+                        break #Client closed connection
+                    (opcode,flags,request_id,length)=decode_header(header)
+                    if not self.check_frame(opcode,request_id,length) :
+                        await self.flush()
+                        break
+                    body=await self.reader.readexactly(length)
+                    if opcode==OP.WAIT :
+                        await self.await_job(body)
+                    await self.run(self.blocking(OP.names.get(opcode)),self.dispatch_frame,opcode,request_id,body)
+                    await self.flush()
+            else :
+                #Legacy request - a single read, as in the original protocol; the request may
+                #hold several commands
+                data=first+await self.reader.read(DI4108Commands.buffer_size-1)
+                await self.run_legacy(str(data,'ascii'))
+        except (ConnectionError,asyncio.IncompleteReadError) as e :
+            if debugging():
+                LOG.debug("Connection lost: %r",e)
+        finally :
+            self.writer.close()
+            try :
+                await self.writer.wait_closed()
+            except ConnectionError :
+                pass
+
+async def handle_connection(reader,writer):
+    await AsyncDI4108Session(reader,writer).serve()
+
+async def start_server(host="localhost",port=AcqPorts.SITE0):
+    '''
+    Start listening and return the asyncio Server object.
+
+    USAGE:
+        server=await start_server(host,port)
+    '''
+    return await asyncio.start_server(handle_connection,host,port,reuse_address=True)
+
+async def start_site_services(host,site):
+    '''
+    Start the streaming and state broadcast services of site on the running loop.  Returns
+    list of the asyncio Server objects.
+    '''
+    servers=[await asyncio.start_server(lambda r,w : serve_subscriber(r,w,site.stream_ring),host,site.stream_port,reuse_address=True),\
+        await asyncio.start_server(lambda r,w : serve_status(r,w,site.tstat_ring),host,site.tstat_port,reuse_address=True)]
+    LOG.info("Site %s: streaming service on port %s, state broadcast service on port %s",site.port,site.stream_port,site.tstat_port)
+    return servers
+
+async def serve(host="localhost",ports=(AcqPorts.SITE0,)):
+    servers=[await start_server(host,port) for port in ports]
+    for server in servers :
+        for sock in server.sockets :
+            (ip,port)=sock.getsockname()[0:2]
+            print("IP: {}".format(ip))
+            print("PORT: {}".format(port))
+    for port in ports :
+        servers+=await start_site_services(host,get_site(port))
+    LOG.info("Serving")
+    await asyncio.gather(*[server.serve_forever() for server in servers])
+
+if __name__ == "__main__":
+    # Use SITE0 Port - this appears to be the main port for the acq400 class devices for i/o
+    HOST = "localhost"
+    di4108_log.configure()
+    sites=parse_sites(sys.argv[1:])
+    metrics_server=MetricsHTTPServer((HOST,METRICS_PORT))
+    threading.Thread(target=metrics_server.serve_forever,daemon=True).start()
+    asyncio.run(serve(HOST,[site.port for site in sites]))
@@ -0,0 +1,341 @@
+'''
+Client library for the DI-4108 server, over the framed protocol of di4108_protocol.
+
+One DI4108Client holds one persistent connection, reused for every command, and reconnects
+on the next command if the connection fails or times out.  Replies are received with
+recv_into straight into a buffer sized from the frame header - the same length that
+query_data_length reports - so shots of any size arrive whole, in one allocation, or in a
+buffer the caller provides and reuses.  Arrays are decoded with di4108_decode.
+
+The client also tracks the offset of the server's clock from its own, by ping (see
+di4108_clock), to place shots on the local clock with shot_start.
+
+USAGE:
+    client=DI4108Client('198.125.177.3')
+    client.init(fs=10000,chans=8,v_range=10,n_samps_post=10000)
+    job=client.trig_pulse()
+    client.wait(job['job'])
+    (values,desc)=client.get_shot() #float32 array, one row per record, in physical units
+    client.close()
+'''
+import json
+import time
+import socket
+import numpy
+from di4108_protocol import HEADER, FLAG_JSON, FLAG_MORE, FLAG_ERROR, OP, ProtocolError, \
+    decode_header, decode_body, negotiate, send_frame, recv_into_exactly
+from di4108_decode import unpack_array, convert, ChunkDecoder
+from di4108_clock import ClockEstimator
+from di4108_shm import SharedShot
+
+class CommandError(IOError):
+    '''
+    Raised when the server reports that a command failed.  The message is the server's.
+    '''
+    pass
+
+class DI4108Client:
+    '''
+    Connection to one DI-4108 server site.  See module documentation.
+    '''
+    def __init__(self,host='localhost',port=4220,timeout=10.0):
+        '''
+        INPUTS:
+            host, port=address of the server site
+            timeout=longest wait for any one socket operation [s]; None waits indefinitely.
+                A wait extends it by its own timeout.
+        '''
+        self.host=host
+        self.port=port
+        self.timeout=timeout
+        self.sock=None
+        self.request_id=0
+        self.header=bytearray(HEADER.size)
+        self.clock=ClockEstimator() #Server clock relative to this one
+
+    def connect(self):
+        '''
+        Open the connection, if not already open.  Commands call this themselves.
+        '''
+        if self.sock is None :
+            sock=socket.create_connection((self.host,self.port),self.timeout)
+            try :
+                sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+                negotiate(sock)
+            except :
+                sock.close()
+                raise
+            self.sock=sock
+        return self.sock
+
+    def close(self):
+        if not self.sock is None :
+            try :
+                self.sock.close()
+            finally :
+                self.sock=None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+    def send(self,opcode,body=None):
+        '''
+        Send a request, returning its request id.
+        '''
+        self.request_id=(self.request_id+1)&0xFFFFFFFF
+        send_frame(self.connect(),opcode,body,self.request_id)
+        return self.request_id
+
+    def recv(self,request_id,out=None):
+        '''
+        Receive one reply frame for request_id.  Returns (flags, body), with the body received
+        into out (a writable buffer, e.g. a bytearray or numpy array, at least as long as the
+        body) if given - body is then a memoryview of out - else into a new bytearray.
+
+        Raises CommandError if the server reports an error.
+        '''
+        recv_into_exactly(self.sock,self.header)
+        (opcode,flags,reply_id,length)=decode_header(self.header)
+        if reply_id!=request_id :
+            raise ProtocolError("Reply to request {} received while waiting for request {}".format(reply_id,request_id))
+        if flags & FLAG_ERROR or out is None or memoryview(out).nbytes<length :
+            body=bytearray(length)
+        else :
+            body=memoryview(out).cast('B')[:length]
+        recv_into_exactly(self.sock,body)
+        if flags & FLAG_ERROR :
+            raise CommandError("{} failed: {}".format(OP.names.get(opcode,opcode),body.decode()))
+        return (flags,body)
+
+    def call(self,opcode,body=None,out=None,extra_time=0):
+        '''
+        Send a request and return (flags, body) of its reply - see recv.  A timeout, or any
+        other error that leaves the connection unusable, closes it, so that the next command
+        reconnects.
+
+        INPUTS:
+            extra_time=additional time [s] the server may take to reply, e.g. for a wait, or
+                None to wait for the reply indefinitely
+        '''
+        try :
+            request_id=self.send(opcode,body)
+            if extra_time is None :
+                self.sock.settimeout(None)
+            elif extra_time>0 and not self.timeout is None :
+                self.sock.settimeout(self.timeout+extra_time)
+            try :
+                return self.recv(request_id,out)
+            finally :
+                if not self.sock is None :
+                    self.sock.settimeout(self.timeout)
+        except CommandError :
+            raise #Connection is still in step
+        except :
+            self.close()
+            raise
+
+    def call_json(self,opcode,body=None,extra_time=0):
+        (flags,reply)=self.call(opcode,body,extra_time=extra_time)
+        return decode_body(reply,flags|FLAG_JSON)
+
+    def call_frames(self,opcode,body=None):
+        '''
+        Send a request with a multi-frame reply, yielding (flags, body) of each frame.
+        '''
+        try :
+            request_id=self.send(opcode,body)
+            while True :
+                (flags,reply)=self.recv(request_id)
+                yield (flags,reply)
+                if not flags & FLAG_MORE :
+                    break
+        except CommandError :
+            raise
+        except :
+            self.close()
+            raise
+
+    def init(self,**settings):
+        '''
+        Configure the device and server - keyword arguments as DI4108_WRAPPER, plus
+        n_samps_pre, n_samps_post, store_mode, persist_shots, share_shots, share_live, and postproc.
+        '''
+        self.call(OP.INIT,settings)
+
+    def trig_pulse(self):
+        '''
+        Trigger a pulse.  Returns the status of its acquisition job, with the job id as 'job'.
+        '''
+        return self.call_json(OP.TRIG_PULSE)
+
+    def wait(self,job=None,timeout=None):
+        '''
+        Wait for an acquisition job (default=the most recent) to finish, or for timeout [s].
+        Returns the job status; its 'state' is 'done' or 'failed' if the job finished.
+        '''
+        args={}
+        if not job is None :
+            args['job']=job
+        if not timeout is None :
+            args['timeout']=timeout
+        #The server holds the reply until the job finishes or timeout - don't give up before it does
+        return self.call_json(OP.WAIT,args,extra_time=timeout)
+
+    def status(self,job=None):
+        return self.call_json(OP.STATUS,None if job is None else {'job':job})
+
+    def acquire(self,timeout=None):
+        '''
+        Trigger a pulse and wait for it.  Raises CommandError if the acquisition fails, or
+        TimeoutError if it is not done within timeout [s].
+        '''
+        status=self.wait(self.trig_pulse()['job'],timeout)
+        if status['state']=='failed' :
+            raise CommandError("Acquisition failed: {}".format(status['error']))
+        if status['state']!='done' :
+            raise TimeoutError("Acquisition not complete after {} s: {}".format(timeout,status))
+        return status
+
+    def get_settings(self):
+        return self.call_json(OP.GET_SETTINGS)
+
+    def query_data_length(self):
+        (flags,reply)=self.call(OP.QUERY_DATA_LENGTH)
+        return int(reply)
+
+    def metrics(self):
+        (flags,reply)=self.call(OP.METRICS)
+        return reply.decode()
+
+    def ping(self):
+        '''
+        Exchange one ping with the server, adding it to the estimate of the server's clock,
+        self.clock.  Returns (offset, delay) of the exchange [s] - see di4108_clock.
+        '''
+        t1=time.time()
+        reply=self.call_json(OP.PING)
+        t4=time.time()
+        return self.clock.add(t1,reply['t_recv'],reply['t_send'],t4)
+
+    def sync_clock(self,n_pings=8):
+        '''
+        Ping the server n_pings times, and return the estimate of its clock.
+        '''
+        for i in range(n_pings) :
+            self.ping()
+        return self.clock.estimate()
+
+    def shot_start(self,desc):
+        '''
+        Return (t_start, uncertainty) [s] of a shot or segment, given its header, desc (from
+        store, get_shot or get_seg), on this machine's clock (time.time()).  The uncertainty
+        combines that of the clock estimate and that of the start time on the server.  The
+        server is pinged first if its clock has not been estimated yet.
+        '''
+        if desc.get('t_start') is None :
+            raise ValueError("Shot has no start time")
+        if not self.clock.ready :
+            self.sync_clock()
+        (t_start,uncertainty)=self.clock.to_local(desc['t_start'])
+        return (t_start,uncertainty+(desc.get('t_start_uncertainty') or 0.0))
+
+    def postproc(self,job=None):
+        '''
+        Return the state and results of the post-processing of a job (default=the most recent) -
+        see the server's postproc command.
+        '''
+        return self.call_json(OP.POSTPROC,None if job is None else {'job':job})
+
+    def profile(self,format='summary',reset=False,enable=None,disable=False):
+        '''
+        Return the server's profile of its acquisition path - see the server's profile command.
+        '''
+        args={'format':format,'reset':reset,'disable':disable}
+        if not enable is None :
+            args['enable']=enable
+        return self.call_json(OP.PROFILE,args)
+
+    def shm(self):
+        '''
+        Return where the server shares its data in shared memory - see the server's shm command.
+        '''
+        return self.call_json(OP.SHM)
+
+    def shared_shot(self):
+        '''
+        Map the last shot shared by a server on this host (init with share_shots=True) - see
+        di4108_shm.SharedShot.  Only its small descriptor comes over the connection.
+        '''
+        desc=self.shm()['shot']
+        if desc is None :
+            raise ValueError("Server has shared no shots - init with share_shots=True")
+        return SharedShot(desc)
+
+    def store_raw(self,out=None):
+        '''
+        Fetch the raw, interleaved bytes of the last shot, into out if given (a writable buffer
+        at least query_data_length() bytes long, reused across shots), else into a new
+        bytearray.  Returns a memoryview or bytearray of exactly the shot's bytes.
+        '''
+        (flags,reply)=self.call(OP.STORE,out=out)
+        return reply
+
+    def store(self,format='int16',byteorder='native',out=None):
+        '''
+        Fetch the last shot demultiplexed by the server (format 'int16' or 'float32' - see the
+        server's store command).  Returns (array, desc), with the array mapped onto the
+        received buffer, without copying, and desc its header (layout, scales, elapsed_time).
+        '''
+        (flags,reply)=self.call(OP.STORE,{'format':format,'byteorder':byteorder},out=out)
+        return unpack_array(reply)
+
+    def store_compressed(self,format='raw',encoding='zlib',level=6,delta=None,chunk_samples=65536,byteorder='native'):
+        '''
+        Fetch the last shot compressed, decoding each chunk as it arrives.  Returns (array,
+        desc, stats): the array (samples x records for format 'raw', else records x samples),
+        its description, and transfer statistics of both ends - the server's under 'server'.
+        delta=whether to delta-encode before compressing; default=for the integer formats
+        (raw and int16), not float32.
+        '''
+        if delta is None :
+            delta=format!='float32'
+        args={'format':format,'encoding':encoding,'level':level,'delta':delta,\
+            'chunk_samples':chunk_samples,'byteorder':byteorder}
+        frames=self.call_frames(OP.STORE,args)
+        (flags,reply)=next(frames)
+        desc=json.loads(reply.decode())
+        decoder=ChunkDecoder(desc)
+        for (flags,reply) in frames :
+            if flags & FLAG_MORE :
+                decoder.feed(reply)
+            else :
+                server_stats=json.loads(reply.decode())
+        stats=decoder.stats()
+        stats['server']=server_stats
+        return (decoder.array(),desc,stats)
+
+    def get_seg(self,out=None,**args):
+        '''
+        Fetch part of the last shot, reduced on the server - keyword arguments as the server's
+        get_seg command (offset, length, chans, dec, mode, format, byteorder).  Returns
+        (array, desc).
+        '''
+        args.setdefault('byteorder','native')
+        (flags,reply)=self.call(OP.GET_SEG,args,out=out)
+        return unpack_array(reply)
+
+    def get_shot(self,scaled=True,out=None):
+        '''
+        Fetch the last shot as an array with one row per record (analog channels, then
+        digital input, rate, and counter).  The server only demultiplexes; scaling to physical
+        units (scaled=True, float32) is done here, which spares the server's CPU and sends half
+        the bytes of its float32 format.  Returns (array, desc).
+        '''
+        (chan_data,desc)=self.store('int16',out=out)
+        if scaled :
+            return (convert(chan_data,desc['layout']),desc)
+        return (chan_data,desc)
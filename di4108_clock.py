@@ -0,0 +1,107 @@
+'''
+Estimate the offset and drift of a DI-4108 server's clock relative to the local clock, from
+NTP-style ping exchanges (the ping command of di4108_server), so that shots from several
+servers can be placed on one time base without digitizing a shared reference on every board.
+
+Each exchange gives four times: t1, when the client sent the ping, and t4, when the reply
+arrived, on the local clock; t2, when the server received it, and t3, when the server
+replied, on the server's clock.  Then
+
+    offset=((t2-t1)+(t3-t4))/2 #Server clock minus local clock
+    delay=(t4-t1)-(t3-t2) #Round-trip network delay
+
+and the true offset lies within delay/2 of the measured one, whatever the asymmetry of the
+path.  Exchanges with the smallest delays are therefore the most trustworthy; the estimator
+fits a straight line (offset and drift) to the best of the recent exchanges.
+
+USAGE:
+    clock=ClockEstimator()
+    clock.add(t1,t2,t3,t4) #After each ping
+    (t_local,uncertainty)=clock.to_local(t_server)
+'''
+import threading
+from collections import deque
+import numpy
+
+class ClockEstimator:
+    '''
+    Running estimate of one remote clock relative to the local clock.  See module
+    documentation.
+    '''
+    def __init__(self,window=64,best_fraction=0.5,min_span=1.0):
+        '''
+        INPUTS:
+            window=number of most recent exchanges kept
+            best_fraction=fraction of the kept exchanges, those with the smallest delays, used
+                in the fit
+            min_span=shortest time [s] the exchanges used must span before drift is fitted;
+                until then drift is taken as zero
+        '''
+        self.exchanges=deque(maxlen=window) #(local time at midpoint, offset, delay)
+        self.best_fraction=best_fraction
+        self.min_span=min_span
+        self.lock=threading.Lock()
+        self.t_ref=0.0
+        self.offset_ref=None
+        self.drift=0.0
+        self.uncertainty=None
+
+    def add(self,t1,t2,t3,t4):
+        '''
+        Add one ping exchange (see module documentation) and update the estimate.  Returns
+        (offset, delay) of the exchange [s].
+        '''
+        offset=((t2-t1)+(t3-t4))/2.0
+        delay=max((t4-t1)-(t3-t2),0.0)
+        with self.lock :
+            self.exchanges.append(((t1+t4)/2.0,offset,delay))
+            self.fit()
+        return (offset,delay)
+
+    def fit(self):
+        best=sorted(self.exchanges,key=lambda e : e[2])
+        best=numpy.array(best[:max(1,int(round(len(best)*self.best_fraction)))])
+        (t,offsets,delays)=(best[:,0],best[:,1],best[:,2])
+        self.t_ref=float(t.mean())
+        if len(best)>=3 and t.max()-t.min()>=self.min_span :
+            (self.drift,self.offset_ref)=[float(x) for x in numpy.polyfit(t-self.t_ref,offsets,1)]
+            residuals=offsets-(self.offset_ref+self.drift*(t-self.t_ref))
+        else :
+            self.drift=0.0
+            self.offset_ref=float(offsets[delays.argmin()])
+            residuals=offsets-self.offset_ref
+        #Bound from the best exchange, widened by the scatter of the others about the fit
+        self.uncertainty=float(delays.min()/2.0+numpy.sqrt(numpy.mean(residuals**2)))
+
+    @property
+    def ready(self):
+        return not self.offset_ref is None
+
+    def offset(self,t):
+        '''
+        Return estimated offset [s] of the remote clock from the local clock at local time t.
+        '''
+        with self.lock :
+            if self.offset_ref is None :
+                raise ValueError("No clock exchanges yet - ping the server first")
+            return self.offset_ref+self.drift*(t-self.t_ref)
+
+    def to_local(self,t_remote):
+        '''
+        Convert a time on the remote clock to the local clock.  Returns (t_local, uncertainty) [s].
+        '''
+        with self.lock :
+            if self.offset_ref is None :
+                raise ValueError("No clock exchanges yet - ping the server first")
+            #Solve t_local+offset(t_local)=t_remote
+            t_local=(t_remote-self.offset_ref+self.drift*self.t_ref)/(1.0+self.drift)
+            return (t_local,self.uncertainty)
+
+    def estimate(self):
+        '''
+        Return dictionary of the current estimate: offset [s] (remote minus local) at local
+        time t_ref [s], drift [s/s], uncertainty [s], and number of exchanges kept.
+        '''
+        with self.lock :
+            return {'offset':self.offset_ref,'drift':self.drift,'t_ref':self.t_ref,\
+                'uncertainty':self.uncertainty,'exchanges':len(self.exchanges)}
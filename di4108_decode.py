@@ -0,0 +1,353 @@
+'''
+Vectorized decoding of DI-4108 data with numpy.  These functions are array equivalents of
+DI4108_WRAPPER.convert_bytes_to_int and DI4108_WRAPPER.convert_data, for use on the server
+(segment fetches, demultiplexed store formats) and in clients.
+
+Raw data are interleaved records: one little-endian 16-bit word per record per sample, with
+the records of a sample in the order given by the device layout (see
+DI4108_WRAPPER.record_layout) - analog channels, then digital inputs, rate, and counter.
+
+Arrays sent over the wire are preceded by an array header: a 4-byte big-endian length, then
+that many bytes of JSON describing the array - at least its dtype and shape - so a client can
+map the data that follow straight into an array with unpack_array.
+
+Arrays may also be sent compressed (see encode_chunks): split along time into chunks, each
+optionally delta-encoded per channel, then compressed with zlib as one stream flushed at every
+chunk, so that each chunk can be sent, and decoded by a ChunkDecoder, as soon as it is ready.
+'''
+import json
+import struct
+import time
+import zlib
+import numpy
+
+REDUCE_MODES=('stride','mean','minmax')
+FORMATS=('raw','int16','float32') #'raw'=interleaved bytes as read from the device
+BYTEORDERS={'little':'<','big':'>','native':'='}
+ENCODINGS=('raw','zlib') #'raw'=uncompressed pass-through
+
+_ARRAY_HEADER_LENGTH=struct.Struct('!I')
+ARRAY_PREFIX_SIZE=_ARRAY_HEADER_LENGTH.size #Bytes at the start of a packed array giving its header's length
+
+def raw_to_int16(raw_data):
+    '''
+    View raw bytes data as an array of signed 16-bit integers, without copying.
+
+    USAGE:
+        int_data=raw_to_int16(raw_data)
+    '''
+    raw_data=memoryview(raw_data).cast('B')
+    return numpy.frombuffer(raw_data,dtype='<i2',count=len(raw_data)//2)
+
+def demux(raw_data,number_records,offset=0,length=None,records=None):
+    '''
+    Demultiplex interleaved raw data into channel-major form.
+
+    USAGE:
+        chan_data=demux(raw_data,number_records)
+        chan_data=demux(raw_data,number_records,offset=1000,length=500,records=[2,3])
+
+    INPUTS:
+        raw_data=bytes-like raw data from the device
+        number_records=number of records per sample
+        offset=first sample to return
+        length=number of samples to return; default=all samples from offset
+        records=list of record indices to return; default=all records
+
+    OUTPUT:
+        int16 array of shape (number of records returned, number of samples) - a view
+        into raw_data where possible.
+    '''
+    int_data=raw_to_int16(raw_data)
+    n_samps=len(int_data)//number_records
+    samples=int_data[:n_samps*number_records].reshape(n_samps,number_records)
+    if offset<0 :
+        raise ValueError("offset must be >= 0 - you entered {}".format(offset))
+    stop=n_samps if length is None else min(n_samps,offset+length)
+    samples=samples[offset:stop]
+    if not records is None :
+        if any([r<0 or r>=number_records for r in records]) :
+            raise ValueError("records must be between 0 and {} - you entered {}".format(number_records-1,records))
+        samples=samples[:,records]
+    return samples.T
+
+def reduce(chan_data,dec=1,mode='stride'):
+    '''
+    Decimate channel-major data along time by a factor of dec.
+
+    USAGE:
+        reduced=reduce(chan_data,dec,mode)
+
+    mode='stride' keeps every dec-th sample; 'mean' averages each window of dec samples
+    (float32 output); 'minmax' returns the minimum and maximum of each window, with output
+    shape (channels, windows, 2).  A final, partial window is kept.
+    '''
+    if not mode in REDUCE_MODES :
+        raise ValueError("mode must be one of {} - you entered {}".format(REDUCE_MODES,mode))
+    dec=int(dec)
+    if dec<1 :
+        raise ValueError("dec must be an integer >= 1 - you entered {}".format(dec))
+    if mode=='stride' or chan_data.shape[1]==0 :
+        return chan_data[:,::dec]
+    starts=numpy.arange(0,chan_data.shape[1],dec)
+    if mode=='mean' :
+        counts=numpy.diff(numpy.append(starts,chan_data.shape[1]))
+        sums=numpy.add.reduceat(chan_data,starts,axis=1,dtype=numpy.float64)
+        return (sums/counts).astype(numpy.float32)
+    return numpy.stack((numpy.minimum.reduceat(chan_data,starts,axis=1),\
+        numpy.maximum.reduceat(chan_data,starts,axis=1)),axis=2)
+
+def record_scales(layout):
+    '''
+    Describe how to convert each record of a shot with the given layout to physical units, as
+    convert_data does: a list with one dictionary per record, holding
+        kind='analog', 'digital', 'rate', or 'counter'
+        signed=whether the 16-bit raw value is read as signed (two's complement) or unsigned
+        scale, offset=value=raw*scale+offset, for all kinds but 'digital'
+        shift=value=raw>>shift, for 'digital'
+
+    A merged shot (see di4108_gateway) lists the layouts of its nodes under 'nodes'; its
+    records are those of each node in turn.
+    '''
+    if 'nodes' in layout :
+        return [scale for node in layout['nodes'] for scale in record_scales(node['layout'])]
+    scales=[{'kind':'analog','signed':True,'scale':layout['v_range']/32768.0,'offset':0.0}]*layout['nchans']
+    if layout['dig_in'] :
+        scales.append({'kind':'digital','signed':False,'shift':8})
+    if layout['rate_in'] :
+        scales.append({'kind':'rate','signed':True,'scale':layout['rate_range']/65536.0,'offset':layout['rate_range']/2.0})
+    if layout['counter_in'] :
+        scales.append({'kind':'counter','signed':True,'scale':1.0,'offset':32768.0})
+    return scales
+
+def convert(chan_data,layout,records=None,out=None):
+    '''
+    Vectorized equivalent of DI4108_WRAPPER.convert_data: scale channel-major raw data (as
+    returned by demux or reduce) to physical units.
+
+    USAGE:
+        values=convert(chan_data,layout)
+        values=convert(chan_data,layout,records=[2,3]) #chan_data holds records 2 and 3 only
+        values=convert(chan_data,layout,out=values) #Scale into an existing array
+
+    OUTPUT:
+        float32 array with the shape of chan_data - out, if given (it must have that shape)
+    '''
+    scales=record_scales(layout)
+    if records is None :
+        records=range(len(scales))
+    if out is None :
+        values=numpy.empty(chan_data.shape,dtype=numpy.float32)
+    elif out.shape!=chan_data.shape or out.dtype!=numpy.float32 :
+        raise ValueError("out must be a float32 array of shape {} - received {} of shape {}".format(chan_data.shape,out.dtype,out.shape))
+    else :
+        values=out
+    for (i,r) in enumerate(records) :
+        x=chan_data[i]
+        scale=scales[r]
+        if not scale['signed'] :
+            x=numpy.where(x<0,x+65536.0,x) #Reinterpret as unsigned 16-bit
+        if scale['kind']=='digital' :
+            values[i]=numpy.floor(x/float(1<<scale['shift']))
+        else :
+            values[i]=x*scale['scale']+scale['offset']
+    return values
+
+def format_array(chan_data,layout,records=None,format='int16',byteorder='little'):
+    '''
+    Put channel-major data in a requested wire format: 'int16' leaves raw values, 'float32'
+    scales to physical units with convert.  byteorder is 'little', 'big', or 'native' (that of
+    the machine running this function).
+    '''
+    if not format in FORMATS[1:] :
+        raise ValueError("format must be one of {} - you entered {}".format(FORMATS[1:],format))
+    if not byteorder in BYTEORDERS :
+        raise ValueError("byteorder must be one of {} - you entered {}".format(list(BYTEORDERS.keys()),byteorder))
+    if format=='float32' :
+        chan_data=convert(chan_data,layout,records)
+    return chan_data.astype(chan_data.dtype.newbyteorder(BYTEORDERS[byteorder]),copy=False)
+
+def reduce_records(chan_data,layout,records=None,dec=1,mode='stride',format='int16',byteorder='little'):
+    '''
+    Reduce channel-major raw data with reduce, and put the result in a wire format as
+    format_array does.  Windows of unsigned records (digital inputs) are reduced on their
+    unsigned values, and 'float32' data are scaled before reducing, so that means and
+    extrema are those of the physical values.
+    '''
+    if format=='float32' :
+        return format_array(reduce(convert(chan_data,layout,records),dec,mode),layout,records,'int16',byteorder)
+    if mode!='stride' :
+        scales=record_scales(layout)
+        if records is None :
+            records=range(len(scales))
+        unsigned=[i for (i,r) in enumerate(records) if not scales[r]['signed']]
+        if len(unsigned)>0 :
+            chan_data=chan_data.astype(numpy.int32)
+            chan_data[unsigned]%=65536
+            reduced=reduce(chan_data,dec,mode)
+            if mode=='minmax' :
+                reduced=reduced.astype(numpy.int16) #Same 16-bit patterns as the raw data
+            return format_array(reduced,layout,records,'int16',byteorder)
+    return format_array(reduce(chan_data,dec,mode),layout,records,format,byteorder)
+
+def pack_array(array,**meta):
+    '''
+    Return (array header, data) for sending array, with meta entries added to the header.
+    data is a C-contiguous memoryview of the array.
+    '''
+    array=numpy.ascontiguousarray(array)
+    desc=dict(meta)
+    desc['dtype']=array.dtype.str
+    desc['shape']=list(array.shape)
+    header=json.dumps(desc).encode()
+    return (_ARRAY_HEADER_LENGTH.pack(len(header))+header,memoryview(array.reshape(-1).view(numpy.uint8)))
+
+def unpack_array(buf):
+    '''
+    Map a buffer holding an array header and data onto a numpy array, without copying.
+
+    USAGE:
+        (array,desc)=unpack_array(buf)
+
+    desc is the decoded header dictionary.
+    '''
+    buf=memoryview(buf).cast('B')
+    start=ARRAY_PREFIX_SIZE+array_header_length(buf[:ARRAY_PREFIX_SIZE])
+    return map_array(buf[start:],buf[ARRAY_PREFIX_SIZE:start])
+
+def array_header_length(prefix):
+    '''
+    Length of the header of a packed array (see pack_array), read from its first
+    ARRAY_PREFIX_SIZE bytes - so that a receiver can take the header on its own, then the data
+    straight into a buffer of its choosing.
+    '''
+    return _ARRAY_HEADER_LENGTH.unpack(prefix)[0]
+
+def map_array(data,header):
+    '''
+    Map array data onto a numpy array, without copying, given the header they were packed with
+    (without its length prefix).  Returns (array, desc), as unpack_array.
+    '''
+    desc=json.loads(bytes(header).decode())
+    array=numpy.frombuffer(memoryview(data).cast('B'),dtype=numpy.dtype(desc['dtype'])).reshape(desc['shape'])
+    return (array,desc)
+
+def delta_encode(samples,axis):
+    '''
+    Per-channel delta encoding of integer samples along the time axis: the first sample is kept,
+    and each following sample is replaced by its difference from the one before, wrapping around
+    on overflow, so that slowly-varying signals become runs of small numbers that compress well.
+    '''
+    deltas=numpy.array(samples)
+    if not numpy.issubdtype(deltas.dtype,numpy.integer) :
+        raise ValueError("Delta encoding requires integer samples - received {}".format(deltas.dtype))
+    index=[slice(None)]*deltas.ndim
+    index[axis]=slice(1,None)
+    deltas[tuple(index)]-=numpy.take(samples,range(samples.shape[axis]-1),axis=axis)
+    return deltas
+
+def delta_decode(deltas,axis):
+    '''
+    Inverse of delta_encode.
+    '''
+    return numpy.cumsum(deltas,axis=axis,dtype=deltas.dtype)
+
+def encode_chunks(samples,axis,chunk_samples=65536,encoding='zlib',level=6,delta=False):
+    '''
+    Generator that encodes samples a chunk at a time, for sending while encoding.
+
+    USAGE:
+        for (encoded,raw_bytes) in encode_chunks(samples,axis,chunk_samples,'zlib',6,True) :
+            ...send encoded...
+
+    INPUTS:
+        samples=array of samples, with time along axis
+        chunk_samples=number of samples (along axis) per chunk
+        encoding='zlib' or 'raw' (chunks are sent as they are)
+        level=zlib compression level, 0 (none) to 9 (smallest)
+        delta=whether to delta-encode each chunk (integer samples only) - see delta_encode.  Each
+            chunk is encoded on its own, so it can be decoded without the ones before it.
+
+    OUTPUTS, per chunk:
+        encoded=bytes-like encoded chunk
+        raw_bytes=size of the chunk before encoding [bytes]
+    '''
+    if not encoding in ENCODINGS :
+        raise ValueError("encoding must be one of {} - you entered {}".format(ENCODINGS,encoding))
+    chunk_samples=int(chunk_samples)
+    if chunk_samples<1 :
+        raise ValueError("chunk_samples must be an integer >= 1 - you entered {}".format(chunk_samples))
+    if delta and not numpy.issubdtype(samples.dtype,numpy.integer) :
+        raise ValueError("Delta encoding requires integer samples - received {}".format(samples.dtype))
+    if encoding=='zlib' :
+        compressor=zlib.compressobj(level)
+    index=[slice(None)]*samples.ndim
+    for start in range(0,samples.shape[axis],chunk_samples) :
+        index[axis]=slice(start,start+chunk_samples)
+        chunk=samples[tuple(index)]
+        if delta :
+            chunk=delta_encode(chunk,axis)
+        chunk=numpy.ascontiguousarray(chunk)
+        raw=memoryview(chunk.reshape(-1).view(numpy.uint8))
+        if encoding=='zlib' :
+            #Sync flush ends each chunk on a byte boundary, so it can be decoded on arrival,
+            #while later chunks still benefit from the history of earlier ones
+            yield (compressor.compress(raw)+compressor.flush(zlib.Z_SYNC_FLUSH),len(raw))
+        else :
+            yield (raw,len(raw))
+
+class ChunkDecoder:
+    '''
+    Client-side inverse of encode_chunks.  Give it the description of the encoded array, then
+    feed it each encoded chunk in order.  It reports the compression ratio achieved and the
+    time spent decoding.
+
+    USAGE:
+        decoder=ChunkDecoder(desc) #desc holds dtype, shape, axis, encoding, and delta
+        for encoded in chunks :
+            decoder.feed(encoded)
+        samples=decoder.array()
+        decoder.stats() #Dictionary of sizes, ratio, and decoding time
+    '''
+    def __init__(self,desc):
+        self.dtype=numpy.dtype(desc['dtype'])
+        self.shape=list(desc['shape'])
+        self.axis=desc['axis']
+        self.encoding=desc.get('encoding','raw')
+        self.delta=desc.get('delta',False)
+        self.decompressor=zlib.decompressobj() if self.encoding=='zlib' else None
+        self.chunks=[]
+        self.wire_bytes=0
+        self.raw_bytes=0
+        self.decode_seconds=0.0
+
+    def feed(self,encoded):
+        '''
+        Decode one chunk, returning it as an array.
+        '''
+        t_start=time.perf_counter()
+        self.wire_bytes+=len(encoded)
+        if not self.decompressor is None :
+            encoded=self.decompressor.decompress(encoded)
+        chunk_shape=list(self.shape)
+        chunk_shape[self.axis]=-1
+        chunk=numpy.frombuffer(encoded,dtype=self.dtype).reshape(chunk_shape)
+        if self.delta :
+            chunk=delta_decode(chunk,self.axis)
+        self.raw_bytes+=chunk.nbytes
+        self.chunks.append(chunk)
+        self.decode_seconds+=time.perf_counter()-t_start
+        return chunk
+
+    def array(self):
+        '''
+        Return all chunks decoded so far, joined along time.
+        '''
+        if len(self.chunks)==0 :
+            return numpy.empty(self.shape,dtype=self.dtype)
+        return numpy.concatenate(self.chunks,axis=self.axis)
+
+    def stats(self):
+        return {'raw_bytes':self.raw_bytes,'wire_bytes':self.wire_bytes,\
+            'ratio':self.raw_bytes/self.wire_bytes if self.wire_bytes>0 else None,\
+            'decode_seconds':self.decode_seconds}
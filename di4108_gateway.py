@@ -0,0 +1,295 @@
+'''
+Aggregation gateway for several DI-4108 servers - e.g. one Raspberry Pi per digitizer.  The
+gateway serves one site port, speaking the same protocols (framed, and legacy tags) and
+commands as di4108_server, and fans each command out to all of its nodes in parallel (see
+di4108_async_client.ShotCollector):
+
+    init - the same settings are sent to every node
+    trig_pulse - every node is triggered, waited on, and its shot fetched; the shots are then
+        merged into one, which is cached for all readers
+    store, get_seg, query_data_length - answered from the merged shot, without touching the
+        nodes, so any number of analysis codes may read the same shot
+    get_settings - the settings of each node, by node
+    wait, status - as for a server, with the outcome on each node under 'nodes'
+    ping, metrics - answered by the gateway itself
+
+A merged shot holds the records of each node in turn, in the order the nodes were given, so
+records are indexed by channel across the whole system.  Its layout lists the nodes, each
+with the index of its first record and its own layout (see merge_shots).  The clock of each
+node is tracked by pinging it in the background (see di4108_clock), so the shots of the
+nodes are aligned by their start times, on the gateway's clock, to the nearest sample; the
+merged shot is stamped with the common start time and its uncertainty, and cut to the
+shortest node's shot.
+
+If any node fails or misses the timeout, the command fails, naming the failed nodes, and the
+previous merged shot is kept.
+
+USAGE:
+    python3 di4108_gateway.py port node [node ...]
+e.g.
+    python3 di4108_gateway.py 4220 pi1:4220 pi2:4220 pi3:4220
+'''
+import sys
+import json
+import time
+import asyncio
+import threading
+import numpy
+from di4108_server import DI4108Commands, ThreadedTCPRequestHandler, ThreadedTCPServer, DI4108Site, \
+    AcqJob, Shot, SettingsCache, STATE, SITES, SITES_LOCK, debugging
+from di4108_async_client import ShotCollector
+from di4108_metrics import METRICS_PORT, MetricsHTTPServer
+import di4108_log
+
+LOG=di4108_log.get_logger('gateway')
+
+def merge_shots(results,job_id=None):
+    '''
+    Merge the shots of several nodes into one Shot.
+
+    USAGE:
+        shot=merge_shots(results)
+
+    INPUTS:
+        results=successful NodeResults of ShotCollector.shot, with format 'int16' and
+            scaled=False - each array holds one row per record
+        job_id=id of the gateway job that collected the shots
+
+    OUTPUT:
+        Shot with interleaved raw data, as from a single device, holding the records of each
+        node in turn.  Its layout holds number_records, fs, and nodes, a list with one
+        dictionary per node: node (host:port), first_record (index of its first record in the
+        merged shot), samples (number of samples the node recorded), job (the node's job id),
+        and layout (the node's own record layout), and its alignment: t_start and
+        t_start_uncertainty (its start time on the local clock), clock (the estimate of the
+        node's clock they came from), and shift (the number of its first samples dropped to
+        align it with the others).
+
+    All nodes must sample at the same rate.  Their shots are aligned on the latest start time,
+    which becomes the start time of the merged shot, and cut to the shortest.  If any node's
+    start time is unknown, shots are aligned at their first samples instead.
+    '''
+    rates=set([r.desc['layout']['fs'] for r in results])
+    if len(rates)!=1 :
+        raise ValueError("Nodes sample at different rates ({}) - their shots cannot be merged".format(sorted(rates)))
+    fs=rates.pop()
+    if all([not r.t_start is None for r in results]) :
+        t_start=max([r.t_start for r in results])
+        shifts=[int(round((t_start-r.t_start)*fs)) for r in results]
+        #Rounding to the nearest sample adds up to half a sample period
+        t_start_uncertainty=max([r.t_start_uncertainty for r in results])+0.5/fs
+    else :
+        (t_start,t_start_uncertainty)=(None,None)
+        shifts=[0]*len(results)
+    n_samps=min([r.array.shape[1]-shift for (r,shift) in zip(results,shifts)])
+    if n_samps<=0 :
+        raise ValueError("Shots of the nodes do not overlap in time - start times {}".format([r.t_start for r in results]))
+    n_records=sum([r.array.shape[0] for r in results])
+    merged=numpy.empty((n_samps,n_records),dtype='<i2') #Interleaved, little-endian, as read from a device
+    nodes=[]
+    first_record=0
+    for (r,shift) in zip(results,shifts) :
+        n=r.array.shape[0]
+        merged[:,first_record:first_record+n]=r.array[:,shift:shift+n_samps].T
+        nodes.append({'node':r.node,'first_record':first_record,'samples':r.array.shape[1],\
+            'job':r.status['job'],'layout':r.desc['layout'],'t_start':r.t_start,\
+            't_start_uncertainty':r.t_start_uncertainty,'clock':r.clock,'shift':shift})
+        first_record+=n
+    layout={'number_records':n_records,'fs':fs,'nodes':nodes}
+    elapsed_time=max([r.desc['elapsed_time'] for r in results])
+    return Shot(merged.tobytes(),elapsed_time,layout,job_id,t_start,t_start_uncertainty)
+
+def check_results(results,action):
+    '''
+    Raise IOError describing the failed nodes of CollectResults, results, if there are any.
+    '''
+    if not results.ok :
+        failed=results.failed
+        raise IOError("{} failed on {} of {} nodes - {}".format(action,len(failed),len(results),\
+            '; '.join(['{}: {!r}'.format(r.node,r.error) for r in failed])))
+
+class GatewaySite(DI4108Site):
+    '''
+    The site served by a gateway: in place of a device, the list of nodes it fans out to.
+    Node I/O runs on the site's executor, one command at a time, as device work does on a
+    server site; each command runs the collector's coroutines to completion there, on an event
+    loop kept for the site.  The connections to the nodes are kept open from one command to
+    the next.
+    '''
+    def __init__(self,port,nodes,timeout=30.0):
+        '''
+        INPUTS:
+            port=site port of the gateway
+            nodes=list of server sites, each 'host', 'host:port', or (host, port)
+            timeout=longest time [s] any one node may take for each command
+        '''
+        super(GatewaySite,self).__init__(port)
+        self.settings=SettingsCache('gateway_settings_{}.json'.format(port)) #Last settings sent to the nodes
+        self.collector=ShotCollector(nodes,timeout,format='int16',scaled=False)
+        self.loop=asyncio.new_event_loop() #Only ever run on the executor's thread - see run
+
+    def run(self,coroutine):
+        '''
+        Run coroutine to completion on the site's event loop - from the executor's thread.
+        '''
+        return self.loop.run_until_complete(coroutine)
+
+    def close(self):
+        '''
+        Close the connections to the nodes, and the event loop, once any command in progress
+        is complete.
+        '''
+        def close():
+            self.collector.close()
+            self.loop.close()
+        self.executor.submit(close).result()
+
+    @property
+    def device(self):
+        raise ValueError("Gateway on port {} has no device of its own".format(self.port))
+
+    def expected_samples(self,pulse_duration):
+        return None #Known only once the nodes' shots are merged
+
+    def configure(self,**settings):
+        '''
+        Send the same init to every node.
+        '''
+        check_results(self.run(self.collector.init(**settings)),'init')
+
+    def node_settings(self):
+        '''
+        Return dictionary of the settings of each node, by node.
+        '''
+        async def step(i,result):
+            result.status=await self.collector.clients[i].get_settings()
+        results=self.run(self.collector.run_all(step))
+        check_results(results,'get_settings')
+        return dict([(r.node,r.status) for r in results])
+
+    def collect(self,job):
+        '''
+        Trigger, wait on and fetch a shot from every node, and publish the merged shot.
+        '''
+        job.results=self.run(self.collector.shot())
+        check_results(job.results,'trig_pulse')
+        shot=merge_shots(job.results,job.id)
+        self.publish_shot(shot)
+        return shot
+
+class GatewayJob(AcqJob):
+    '''
+    One triggered pulse on all of a gateway's nodes, run on the gateway site's executor.  Its
+    status is that of an AcqJob, with the outcome on each node under 'nodes'.  Queued by
+    GatewayCommands.handle_trig_pulse, with the arguments of AcqJob; those for the device
+    (persisting, sharing and post-processing the shot) are left to the nodes.
+    '''
+    def __init__(self,site,*args,**kwargs):
+        super(GatewayJob,self).__init__(site,*args,**kwargs)
+        self.results=None
+        self.n_samps=0
+
+    def run(self):
+        self.t_start=time.time()
+        self.state=AcqJob.RUNNING
+        self.site.publish_status(STATE.RUNPOST,elapsed=0)
+        try :
+            shot=self.site.collect(self)
+        except Exception as e :
+            self.error=str(e)
+            self.state=AcqJob.FAILED
+            self.site.publish_status(STATE.IDLE)
+            raise
+        self.n_samps=len(shot.data)//(2*shot.layout['number_records'])
+        self.elapsed_time=shot.elapsed_time
+        self.state=AcqJob.DONE
+        self.site.publish_status(STATE.IDLE,post=self.n_samps,elapsed=self.n_samps)
+        if debugging():
+            LOG.debug('Gateway job %s complete - %s records, %s samples',self.id,shot.layout['number_records'],self.n_samps)
+
+    @property
+    def samples(self):
+        return self.n_samps
+
+    def status(self):
+        status=super(GatewayJob,self).status()
+        status['nodes']=[]
+        if not self.results is None :
+            for r in self.results :
+                status['nodes'].append({'node':r.node,'ok':r.ok,'seconds':r.seconds,\
+                    'error':None if r.error is None else repr(r.error),\
+                    'status':r.status})
+        return status
+
+def add_gateway(port,nodes,timeout=30.0):
+    '''
+    Register a gateway site on port, fanning out to nodes.  Returns the GatewaySite.
+    '''
+    with SITES_LOCK :
+        if port in SITES :
+            raise ValueError("Site on port {} already exists".format(port))
+        SITES[port]=GatewaySite(port,nodes,timeout)
+        return SITES[port]
+
+class GatewayCommands(DI4108Commands):
+    '''
+    Server commands of a gateway - see module documentation.  Commands that read the merged
+    shot (store, get_seg, query_data_length), and trig_pulse, wait, status and metrics, are
+    those of DI4108Commands; trig_pulse queues a GatewayJob.  Commands on a device's shots
+    (shm, postproc, profile) are left to the nodes.
+    '''
+    job_class=GatewayJob
+    unsupported_commands=('shm','postproc','profile')
+
+    def init_commands(self,this_port,client=None):
+        super(GatewayCommands,self).init_commands(this_port,client)
+        for command in GatewayCommands.unsupported_commands :
+            del self._protocol_dict[command]
+        self.data_file_name='gateway_data_{}.bin'.format(this_port) #Never written - merged shots are kept in memory
+        self.pulse_duration=None #Set by the nodes' settings
+
+    def find_site(self,this_port):
+        with SITES_LOCK :
+            site=SITES.get(this_port)
+        if not isinstance(site,GatewaySite) :
+            raise ValueError("Site on port {} is not a gateway".format(this_port))
+        return site
+
+    def settings_to_json(self):
+        return json.dumps({}) #Settings live on the nodes - none sent yet
+
+    def reinitialize(self):
+        return None #Settings live on the nodes
+
+    def handle_init(self,settings_json):
+        '''
+        Send the same settings to every node, once any pulse in progress is complete.
+        '''
+        settings=json.loads(settings_json)
+        self.site.executor.submit(self.site.configure,**settings).result()
+        self.settings_cache.update(json.dumps(settings,sort_keys=True))
+
+    def handle_get_settings(self):
+        '''
+        Send the current settings of every node, as a JSON dictionary keyed by node.
+        '''
+        self.reply(json.dumps(self.site.executor.submit(self.site.node_settings).result()).encode())
+
+class GatewayRequestHandler(GatewayCommands,ThreadedTCPRequestHandler):
+    pass
+
+if __name__ == "__main__":
+    HOST = "localhost"
+    if len(sys.argv)<3 :
+        print(__doc__)
+        sys.exit(1)
+    di4108_log.configure()
+    site=add_gateway(int(sys.argv[1]),sys.argv[2:])
+    ThreadedTCPServer.allow_reuse_address = True
+    server = ThreadedTCPServer((HOST,site.port), GatewayRequestHandler)
+    print("IP: {}".format(server.server_address[0]))
+    print("PORT: {}".format(server.server_address[1]))
+    print("Nodes: {}".format(', '.join(site.collector.names)))
+    metrics_server=MetricsHTTPServer((HOST,METRICS_PORT))
+    threading.Thread(target=metrics_server.serve_forever,daemon=True).start()
+    server.serve_forever()
@@ -0,0 +1,66 @@
+'''
+Logging for the DI-4108 modules, through the standard logging module, under the logger
+'di4108' (e.g. di4108.server, di4108.device).  The level is resolved once, at import, from the
+environment:
+
+    DI4108_LOG_LEVEL - a logging level name, e.g. DEBUG, INFO, WARNING (default)
+    DEBUG_DEVICES - if set, DEBUG, as before this module
+
+and the result cached, so that hot code tests a module variable, not the environment:
+
+    if debugging() :
+        LOG.debug("Read %d bytes",n) #Formatted only if a handler emits it
+
+Warnings and errors are shown on stderr even if the application configures no logging;
+configure() gives debug messages a handler too, as the servers do when run.
+
+USAGE:
+    from di4108_log import get_logger, debugging
+    LOG=get_logger('server')
+    di4108_log.set_level('DEBUG') #e.g. from a debugger, at run time
+'''
+import os
+import logging
+
+LOGGER=logging.getLogger('di4108')
+
+def resolve_level():
+    '''
+    Return the logging level given by the environment - see module documentation.
+    '''
+    name=os.getenv('DI4108_LOG_LEVEL')
+    if name :
+        level=logging.getLevelName(name.upper())
+        if isinstance(level,int) :
+            return level
+    if os.getenv('DEBUG_DEVICES') :
+        return logging.DEBUG
+    return logging.WARNING
+
+DEBUG=False #Whether debug messages are logged - see set_level
+
+def set_level(level):
+    '''
+    Set the level of all DI-4108 loggers (a level or its name), and the cached debugging flag.
+    '''
+    global DEBUG
+    LOGGER.setLevel(level)
+    DEBUG=LOGGER.isEnabledFor(logging.DEBUG)
+
+def debugging():
+    return DEBUG
+
+def get_logger(name):
+    return LOGGER.getChild(name)
+
+def configure(format='%(asctime)s %(name)s %(levelname)s %(message)s'):
+    '''
+    Log to stderr, at the resolved level, if the application has not configured logging
+    itself.
+    '''
+    if not LOGGER.handlers and not logging.getLogger().handlers :
+        handler=logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(format))
+        LOGGER.addHandler(handler)
+
+set_level(resolve_level())
@@ -0,0 +1,186 @@
+'''
+Performance counters for the DI-4108 server, exposed as text in the Prometheus exposition
+format - by the metrics command of the site servers, and over HTTP on METRICS_PORT, so a
+scraper (or curl) can watch each Pi under load.
+
+Metrics are created once, at import, in a Registry, and updated from anywhere in the server:
+
+    READS=REGISTRY.counter('di4108_reads_total','Reads from the device')
+    READS.inc(site=4220)
+
+Gauges may instead be given a function, called at each scrape, returning {labels:value} -
+for values, such as subscriber backlogs, that are cheaper to compute when asked for than to
+keep up to date.
+'''
+import threading
+import http.server
+import socketserver
+from bisect import bisect_left
+
+METRICS_PORT=9108 #Not an acq400 port - chosen for the DI-4108
+
+#Default histogram bucket upper bounds [s]
+LATENCY_BUCKETS=(0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5)
+
+def label_key(labels):
+    '''
+    Hashable, ordered form of a dictionary of labels.
+    '''
+    return tuple(sorted([(k,str(v)) for (k,v) in labels.items()]))
+
+def format_labels(key,extra=()):
+    pairs=list(key)+list(extra)
+    if len(pairs)==0 :
+        return ''
+    return '{'+','.join(['{}="{}"'.format(k,v.replace('\\','\\\\').replace('"','\\"')) for (k,v) in pairs])+'}'
+
+def format_value(value):
+    if value==float('inf') :
+        return '+Inf'
+    return repr(float(value)) if isinstance(value,float) else str(value)
+
+class Metric:
+    kind='untyped'
+
+    def __init__(self,name,help_text):
+        self.name=name
+        self.help_text=help_text
+        self.values={}
+        self.lock=threading.Lock()
+
+    def samples(self):
+        '''
+        Return list of (name, label key, extra labels, value) to expose.
+        '''
+        with self.lock :
+            return [(self.name,key,(),value) for (key,value) in self.values.items()]
+
+    def exposition(self):
+        lines=['# HELP {} {}'.format(self.name,self.help_text),'# TYPE {} {}'.format(self.name,self.kind)]
+        for (name,key,extra,value) in self.samples() :
+            lines.append('{}{} {}'.format(name,format_labels(key,extra),format_value(value)))
+        return '\n'.join(lines)+'\n'
+
+class Counter(Metric):
+    '''
+    Monotonically increasing count, e.g. of bytes or events.
+    '''
+    kind='counter'
+
+    def inc(self,amount=1,**labels):
+        key=label_key(labels)
+        with self.lock :
+            self.values[key]=self.values.get(key,0)+amount
+
+class Gauge(Metric):
+    '''
+    Value that goes up and down.  Either set it, or give it a function, fn, which returns a
+    dictionary of {label dictionary as label_key: value} when scraped.
+    '''
+    kind='gauge'
+
+    def __init__(self,name,help_text,fn=None):
+        super(Gauge,self).__init__(name,help_text)
+        self.fn=fn
+
+    def set(self,value,**labels):
+        with self.lock :
+            self.values[label_key(labels)]=value
+
+    def samples(self):
+        if self.fn is None :
+            return super(Gauge,self).samples()
+        return [(self.name,key,(),value) for (key,value) in self.fn().items()]
+
+class Histogram(Metric):
+    '''
+    Distribution of observed values (e.g. latencies), counted in cumulative buckets.
+    '''
+    kind='histogram'
+
+    def __init__(self,name,help_text,buckets=LATENCY_BUCKETS):
+        super(Histogram,self).__init__(name,help_text)
+        self.buckets=tuple(sorted(buckets))
+
+    def observe(self,value,**labels):
+        key=label_key(labels)
+        with self.lock :
+            if not key in self.values :
+                self.values[key]=[[0]*(len(self.buckets)+1),0.0,0] #Bucket counts, sum, count
+            entry=self.values[key]
+            entry[0][bisect_left(self.buckets,value)]+=1
+            entry[1]+=value
+            entry[2]+=1
+
+    def samples(self):
+        samples=[]
+        with self.lock :
+            for (key,(counts,total,n)) in self.values.items() :
+                cumulative=0
+                for (bound,count) in zip(self.buckets+(float('inf'),),counts) :
+                    cumulative+=count
+                    samples.append((self.name+'_bucket',key,(('le',format_value(bound)),),cumulative))
+                samples.append((self.name+'_sum',key,(),total))
+                samples.append((self.name+'_count',key,(),n))
+        return samples
+
+class Registry:
+    '''
+    Collection of metrics, in order of creation.
+    '''
+    def __init__(self):
+        self.metrics=[]
+        self.lock=threading.Lock()
+
+    def add(self,metric):
+        with self.lock :
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self,name,help_text):
+        return self.add(Counter(name,help_text))
+
+    def gauge(self,name,help_text,fn=None):
+        return self.add(Gauge(name,help_text,fn))
+
+    def histogram(self,name,help_text,buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name,help_text,buckets))
+
+    def exposition(self):
+        '''
+        Return all metrics as text in the Prometheus exposition format.
+        '''
+        with self.lock :
+            metrics=list(self.metrics)
+        return ''.join([m.exposition() for m in metrics])
+
+#Metrics of this process
+REGISTRY=Registry()
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Answer any GET (conventionally, of /metrics) with the registry's exposition.
+    '''
+    def do_GET(self):
+        body=self.server.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,*args):
+        pass #Scrapes are frequent - don't print each one
+
+class MetricsHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    '''
+    USAGE:
+        metrics_server=MetricsHTTPServer((host,METRICS_PORT))
+        threading.Thread(target=metrics_server.serve_forever,daemon=True).start()
+    '''
+    daemon_threads=True
+    allow_reuse_address=True
+
+    def __init__(self,server_address,registry=REGISTRY):
+        self.registry=registry
+        super(MetricsHTTPServer,self).__init__(server_address,MetricsRequestHandler)
@@ -0,0 +1,181 @@
+'''
+Post-processing of completed shots in a pool of worker processes, so that analysis never
+competes with the USB reader and socket handlers for the server's GIL, and the acquisition
+thread never waits on it.  The server hands each shot over through shared memory (see
+di4108_shm): only its small descriptor is sent to a worker, which maps the shot, copies it out
+once (the decode stage), and runs the configured stages on it.
+
+A pipeline is a list of stages, each a stage name, or [name, {keyword arguments}]:
+
+    decode - demultiplex the raw shot into int16 records (always done first, if not listed)
+    calibrate - convert to physical units, as convert_data (float32)
+    decimate - reduce along time, with dec and mode as di4108_decode.reduce
+    spectrum - power spectrum of each record (Hann window), with the peak frequency of each
+        in the results; nfft=number of points (default=all samples)
+    archive - save the current records (and spectrum, if computed) to a numpy .npz file in
+        directory (default='.'), named shot_<job>.npz; its path is in the results.  The
+        directory is taken under the server's archive root (ARCHIVE_ROOT, from the environment
+        variable DI4108_ARCHIVE_ROOT, default='archive'), and must be relative, without '..'
+    summary - mean, standard deviation, minimum, maximum and rms of each record
+
+Each stage works on the records left by the one before it, and adds to a dictionary of
+results, which is what the worker returns.  E.g.
+    ['calibrate',['decimate',{'dec':10,'mode':'mean'}],'spectrum','summary']
+
+USAGE:
+    pipeline=PostProcessor(max_workers=3)
+    future=pipeline.submit(desc,stages) #desc from di4108_shm.ShmShotStore.publish
+    results=future.result()
+'''
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+from di4108_decode import demux, reduce, convert
+from di4108_shm import SharedShot, ShmOverrun
+
+ARCHIVE_ROOT=os.getenv('DI4108_ARCHIVE_ROOT','archive') #Directory archive stages write under
+
+def decoded(ctx):
+    '''
+    Copy the shot out of shared memory as int16 records, if not done already, and check that
+    it was not overwritten while being copied.
+    '''
+    if not 'records' in ctx :
+        shot=ctx['shot']
+        records=numpy.ascontiguousarray(demux(shot.data,ctx['layout']['number_records']))
+        if not shot.valid() :
+            raise ShmOverrun("Shot of job {} was overwritten before it could be processed".format(ctx['desc'].get('job')))
+        ctx['records']=records
+        ctx['fs']=float(ctx['layout']['fs'])
+    return ctx['records']
+
+def stage_decode(ctx):
+    decoded(ctx)
+    ctx['results']['shape']=list(ctx['records'].shape)
+
+def stage_calibrate(ctx):
+    ctx['records']=convert(decoded(ctx),ctx['layout'])
+
+def stage_decimate(ctx,dec=10,mode='mean'):
+    ctx['records']=reduce(decoded(ctx),dec,mode)
+    ctx['fs']/=int(dec)
+    ctx['results']['fs']=ctx['fs']
+
+def stage_spectrum(ctx,nfft=None):
+    records=decoded(ctx)
+    if records.ndim!=2 :
+        raise ValueError("spectrum needs one value per sample - not after decimate mode minmax")
+    n=records.shape[1] if nfft is None else int(nfft)
+    x=records[:,:n].astype(numpy.float64)
+    x=x-x.mean(axis=1,keepdims=True)
+    window=numpy.hanning(x.shape[1])
+    #One-sided power spectral density [units^2/Hz]
+    psd=numpy.abs(numpy.fft.rfft(x*window,n=n,axis=1))**2/(ctx['fs']*numpy.sum(window**2))
+    psd[:,1:]*=2.0
+    freqs=numpy.fft.rfftfreq(n,1.0/ctx['fs'])
+    ctx['spectrum']=(freqs,psd)
+    peaks=psd[:,1:].argmax(axis=1)+1 if psd.shape[1]>1 else numpy.zeros(psd.shape[0],dtype=int)
+    ctx['results']['peak_frequency']=[float(freqs[i]) for i in peaks]
+
+def archive_directory(directory,root=None):
+    '''
+    Resolve directory, as given in a client's pipeline, under the archive root (default=
+    ARCHIVE_ROOT).  Raises ValueError if it is absolute, or leads out of the root - clients
+    choose where to archive within the root, never where on the server.
+    '''
+    if not isinstance(directory,str) or os.path.isabs(directory) or \
+        '..' in directory.replace('\\','/').split('/') :
+        raise ValueError("Archive directory must be a relative path, without '..' - you entered {!r}".format(directory))
+    root=os.path.realpath(ARCHIVE_ROOT if root is None else root)
+    path=os.path.realpath(os.path.join(root,directory))
+    if os.path.commonpath([root,path])!=root :
+        raise ValueError("Archive directory {} leads out of the archive root".format(directory)) #By a symbolic link
+    return path
+
+def stage_archive(ctx,directory='.'):
+    records=decoded(ctx)
+    directory=archive_directory(directory,ctx.get('archive_root'))
+    os.makedirs(directory,exist_ok=True)
+    path=os.path.join(directory,'shot_{}.npz'.format(ctx['desc'].get('job')))
+    arrays={'records':records,'fs':ctx['fs']}
+    if 'spectrum' in ctx :
+        (arrays['freqs'],arrays['psd'])=ctx['spectrum']
+    tmp_path=path+'.tmp.npz'
+    numpy.savez(tmp_path,**arrays)
+    os.replace(tmp_path,path) #Readers never see a partial file
+    ctx['results']['archive']=path
+
+def stage_summary(ctx):
+    x=decoded(ctx).astype(numpy.float64)
+    axes=tuple(range(1,x.ndim))
+    ctx['results']['summary']={'mean':x.mean(axis=axes).tolist(),'std':x.std(axis=axes).tolist(),\
+        'min':x.min(axis=axes).tolist(),'max':x.max(axis=axes).tolist(),\
+        'rms':numpy.sqrt((x**2).mean(axis=axes)).tolist()}
+
+STAGES={'decode':stage_decode,'calibrate':stage_calibrate,'decimate':stage_decimate,\
+    'spectrum':stage_spectrum,'archive':stage_archive,'summary':stage_summary}
+
+def parse_stages(stages):
+    '''
+    Return list of (name, keyword arguments) of a pipeline, checking that each stage exists.
+    '''
+    parsed=[]
+    for stage in stages :
+        if isinstance(stage,str) :
+            (name,kwargs)=(stage,{})
+        else :
+            (name,kwargs)=(stage[0],dict(stage[1]) if len(stage)>1 else {})
+        if not name in STAGES :
+            raise ValueError("Unknown post-processing stage {} - stages are {}".format(name,list(STAGES.keys())))
+        if name=='archive' and 'directory' in kwargs :
+            archive_directory(kwargs['directory']) #Reject paths out of the root here, not in a worker
+        parsed.append((name,kwargs))
+    return parsed
+
+def run_pipeline(desc,stages,archive_root=None):
+    '''
+    Run stages on the shared shot described by desc, archiving under archive_root (default=
+    ARCHIVE_ROOT).  Runs in a worker process.  Returns the dictionary of results, with the job
+    id, and the time taken [s].
+    '''
+    t_start=time.perf_counter()
+    ctx={'desc':desc,'layout':desc['layout'],'results':{'job':desc.get('job')},'archive_root':archive_root}
+    ctx['shot']=SharedShot(desc)
+    try :
+        decoded(ctx)
+        for (name,kwargs) in parse_stages(stages) :
+            STAGES[name](ctx,**kwargs)
+    finally :
+        ctx.pop('shot').close()
+    ctx['results']['seconds']=time.perf_counter()-t_start
+    return ctx['results']
+
+class PostProcessor:
+    '''
+    Pool of worker processes running post-processing pipelines on shared shots.  Workers are
+    started on first use, and with the spawn method, so they inherit none of the server's
+    threads or sockets.  Archive stages write under archive_root (default=ARCHIVE_ROOT, as
+    set in the server's process).
+    '''
+    def __init__(self,max_workers=None,archive_root=None):
+        if max_workers is None :
+            max_workers=max(1,(os.cpu_count() or 2)-1) #Leave a core for the server
+        self.max_workers=max_workers
+        self.archive_root=os.path.abspath(ARCHIVE_ROOT if archive_root is None else archive_root)
+        self.executor=None
+
+    def submit(self,desc,stages):
+        '''
+        Queue a pipeline on a shared shot, returning its future at once.
+        '''
+        parse_stages(stages) #Report bad pipelines here, not in a worker
+        if self.executor is None :
+            self.executor=ProcessPoolExecutor(self.max_workers,mp_context=multiprocessing.get_context('spawn'))
+        return self.executor.submit(run_pipeline,desc,stages,self.archive_root)
+
+    def shutdown(self,wait=True):
+        if not self.executor is None :
+            self.executor.shutdown(wait)
+            self.executor=None
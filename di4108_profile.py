@@ -0,0 +1,168 @@
+'''
+Opt-in profiling of the acquisition path: where a shot's wall time goes - setting up the
+device, clearing its buffer, each read and the sleep after it, joining the reads, converting
+them, publishing the shot.  Each stage is recorded as an event - stage, monotonic start and
+end times (time.perf_counter), thread, and a value, such as the bytes read - in a fixed-size
+ring of preallocated arrays, so recording allocates nothing and the oldest events are
+overwritten once the ring is full.
+
+Profiling is off unless enabled - by enable(), or by setting the environment variable
+DI4108_PROFILE to the number of events to keep (e.g. DI4108_PROFILE=65536) - and then costs
+the instrumented code one test of a local variable per stage:
+
+    prof=di4108_profile.PROFILER
+    if not prof is None : t=prof.now()
+    ...stage...
+    if not prof is None : t=prof.mark('stage',t,n_bytes)
+
+Events may be exported as a summary - count, total, mean, percentiles, and a histogram of
+durations of each stage - or as a Chrome trace (JSON), to load into chrome://tracing or
+Perfetto.  Servers export them with the profile command.
+
+USAGE:
+    prof=di4108_profile.enable(65536)
+    ...acquire...
+    print(json.dumps(prof.summary(),indent=1))
+    json.dump(prof.chrome_trace(),open('trace.json','w'))
+'''
+import os
+import time
+import array
+import itertools
+import threading
+import numpy
+
+#Upper bounds of the bins of the duration histograms [s]
+HISTOGRAM_BOUNDS=(1E-6,1E-5,1E-4,1E-3,1E-2,1E-1,1.0,10.0,float('inf'))
+MAX_CAPACITY=1<<20 #Most events a Profiler may keep - 34 bytes each, so about 36 MB
+
+class Profiler:
+    '''
+    Fixed-size ring of timed events - see module documentation.
+    '''
+    def __init__(self,capacity=65536):
+        self.capacity=int(capacity)
+        if self.capacity<1 or self.capacity>MAX_CAPACITY :
+            raise ValueError("Profiler capacity must be from 1 to {} events - you entered {}".format(MAX_CAPACITY,capacity))
+        self.starts=array.array('d',bytes(8*self.capacity))
+        self.ends=array.array('d',bytes(8*self.capacity))
+        self.stage_ids=array.array('H',bytes(2*self.capacity))
+        self.threads=array.array('Q',bytes(8*self.capacity))
+        self.values=array.array('d',bytes(8*self.capacity))
+        self.stages={} #Stage id by name - ids index stage_names
+        self.stage_names=[]
+        self.lock=threading.Lock() #Only for registering new stages
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget all events.
+        '''
+        self.counter=itertools.count() #next() is atomic, so threads never share a slot
+        self.n_events=0
+        self.t0=time.perf_counter()
+
+    @staticmethod
+    def now():
+        return time.perf_counter()
+
+    def stage_id(self,stage):
+        stage_id=self.stages.get(stage)
+        if stage_id is None :
+            with self.lock :
+                if not stage in self.stages :
+                    self.stages[stage]=len(self.stage_names)
+                    self.stage_names.append(stage)
+                stage_id=self.stages[stage]
+        return stage_id
+
+    def add(self,stage,start,end,value=0.0):
+        '''
+        Record that stage ran from start to end (time.perf_counter) - with value, e.g. a
+        number of bytes.
+        '''
+        i=next(self.counter)
+        self.n_events=i+1
+        i%=self.capacity
+        self.starts[i]=start
+        self.ends[i]=end
+        self.stage_ids[i]=self.stage_id(stage)
+        self.threads[i]=threading.get_ident()
+        self.values[i]=value
+
+    def mark(self,stage,start,value=0.0):
+        '''
+        Record that stage ran from start until now, and return now - the start of the next
+        stage.
+        '''
+        end=time.perf_counter()
+        self.add(stage,start,end,value)
+        return end
+
+    def events(self):
+        '''
+        Return the events held, oldest first, as a dictionary of numpy arrays: stage (index in
+        stage_names), start, end, thread, and value.
+        '''
+        n=min(self.n_events,self.capacity)
+        order=numpy.arange(self.n_events-n,self.n_events)%self.capacity
+        arrays={'stage':numpy.frombuffer(self.stage_ids,dtype=numpy.uint16),\
+            'start':numpy.frombuffer(self.starts),'end':numpy.frombuffer(self.ends),\
+            'thread':numpy.frombuffer(self.threads,dtype=numpy.uint64),\
+            'value':numpy.frombuffer(self.values)}
+        return dict([(k,v[order]) for (k,v) in arrays.items()])
+
+    def summary(self):
+        '''
+        Return dictionary, by stage, of the count of its events, the total, mean, minimum,
+        maximum, and 50th, 90th and 99th percentiles of their durations [s], the total of their
+        values, and a histogram of their durations: counts in bins with upper bounds
+        HISTOGRAM_BOUNDS.
+        '''
+        events=self.events()
+        durations=events['end']-events['start']
+        summary={}
+        for (stage_id,stage) in enumerate(list(self.stage_names)) :
+            selected=events['stage']==stage_id
+            d=durations[selected]
+            if len(d)==0 :
+                continue
+            (p50,p90,p99)=numpy.percentile(d,[50,90,99])
+            counts=numpy.histogram(d,[0.0]+list(HISTOGRAM_BOUNDS))[0]
+            summary[stage]={'count':int(len(d)),'total':float(d.sum()),'mean':float(d.mean()),\
+                'min':float(d.min()),'max':float(d.max()),'p50':float(p50),'p90':float(p90),\
+                'p99':float(p99),'value':float(events['value'][selected].sum()),\
+                'histogram':dict([(str(b),int(c)) for (b,c) in zip(HISTOGRAM_BOUNDS,counts)])}
+        return summary
+
+    def chrome_trace(self):
+        '''
+        Return the events as a Chrome trace: a dictionary to dump as JSON, holding one complete
+        event ('ph':'X') per event, timed in microseconds since the profiler was reset.
+        '''
+        events=self.events()
+        pid=os.getpid()
+        trace=[]
+        for i in range(len(events['stage'])) :
+            trace.append({'name':self.stage_names[events['stage'][i]],'ph':'X','pid':pid,\
+                'tid':int(events['thread'][i]),'ts':(events['start'][i]-self.t0)*1E6,\
+                'dur':(events['end'][i]-events['start'][i])*1E6,'args':{'value':float(events['value'][i])}})
+        return {'traceEvents':trace,'displayTimeUnit':'ms'}
+
+PROFILER=None #The enabled Profiler, or None
+
+def enable(capacity=65536):
+    '''
+    Start profiling into a new Profiler holding capacity events (at most MAX_CAPACITY), and
+    return it.
+    '''
+    global PROFILER
+    PROFILER=Profiler(capacity)
+    return PROFILER
+
+def disable():
+    global PROFILER
+    PROFILER=None
+
+if os.getenv('DI4108_PROFILE') :
+    enable(int(os.getenv('DI4108_PROFILE')))
@@ -0,0 +1,172 @@
+'''
+Framed binary command protocol for the DI-4108 server.
+
+A client selects this protocol by sending the single negotiation byte, NEGOTIATE, as the first
+byte on a new connection.  The server answers with one byte holding PROTOCOL_VERSION.  Any other
+first byte (in practice, '<') selects the legacy <init>/<trig_pulse>/<store> tag grammar.
+
+After negotiation, every request and every reply is a frame: a fixed HEADER followed by a body
+of exactly the length given in the header.
+
+    HEADER=opcode (uint8), flags (uint8), request id (uint32), body length (uint64), network byte order
+
+The request id is chosen by the client and echoed on every reply frame for that request.  The
+body is JSON (FLAG_JSON set) or raw binary.  Replies with FLAG_ERROR carry an error message;
+replies with FLAG_MORE are followed by further frames for the same request id.
+'''
+import json
+import struct
+
+NEGOTIATE=b'\xd4' #First byte sent by a framed-protocol client; legacy requests start with '<'
+PROTOCOL_VERSION=2
+
+HEADER=struct.Struct('!BBIQ') #opcode, flags, request id, body length
+
+#Largest request body a server accepts [bytes].  Requests are small JSON; a header asking for
+#more is refused with an error frame, and the connection closed, before anything is allocated
+MAX_REQUEST_BODY=1024*1024
+
+FLAG_JSON=0x01 #Body is utf-8 JSON
+FLAG_MORE=0x02 #More frames follow for this request id
+FLAG_ERROR=0x04 #Body is an error message
+
+class OP:
+    """opcodes for framed requests
+    Command opcodes correspond to the command of the same name in the legacy tag grammar."""
+    INIT = 1
+    TRIG_PULSE = 2
+    STORE = 3
+    GET_SETTINGS = 4
+    QUERY_DATA_LENGTH = 5
+    SUBSCRIBE = 6 #Streaming service (AcqPorts.STREAM) only
+    STREAM_DATA = 7 #Sent by streaming service; request id holds the chunk sequence number
+    GET_SEG = 8
+    WAIT = 9
+    STATUS = 10
+    METRICS = 11
+    PING = 12
+    SHM = 13
+    POSTPROC = 14
+    PROFILE = 15
+
+    names={INIT:'init',TRIG_PULSE:'trig_pulse',STORE:'store',GET_SETTINGS:'get_settings',\
+        QUERY_DATA_LENGTH:'query_data_length',SUBSCRIBE:'subscribe',STREAM_DATA:'stream_data',\
+        GET_SEG:'get_seg',WAIT:'wait',STATUS:'status',METRICS:'metrics',\
+        PING:'ping',SHM:'shm',POSTPROC:'postproc',PROFILE:'profile'}
+    codes={v:k for (k,v) in names.items()}
+
+class ProtocolError(IOError):
+    '''
+    Raised when a frame cannot be decoded, or when a peer closes the connection mid-frame.
+    '''
+    pass
+
+def encode_header(opcode,flags,request_id,length):
+    '''
+    Pack a frame header.
+
+    USAGE:
+        header=encode_header(opcode,flags,request_id,length)
+    '''
+    return HEADER.pack(opcode,flags,request_id,length)
+
+def decode_header(header):
+    '''
+    Unpack a frame header.
+
+    USAGE:
+        (opcode,flags,request_id,length)=decode_header(header)
+
+    INPUT:
+        header=bytes-like object of exactly HEADER.size bytes
+    '''
+    if len(header)!=HEADER.size :
+        raise ProtocolError("Frame header must be {} bytes - received {}".format(HEADER.size,len(header)))
+    return HEADER.unpack(header)
+
+def check_request_length(length):
+    '''
+    Raise ProtocolError if a request body of length bytes exceeds MAX_REQUEST_BODY.
+    '''
+    if length>MAX_REQUEST_BODY :
+        raise ProtocolError("Request body of {} bytes exceeds the limit of {} bytes".format(length,MAX_REQUEST_BODY))
+
+def encode_body(body):
+    '''
+    Convert a request or reply body to (bytes-like body, flags).  Dictionaries and lists are
+    JSON-encoded; strings are ascii-encoded; bytes-like objects pass through untouched.
+    '''
+    if body is None :
+        return (b'',0)
+    if isinstance(body,(dict,list)) :
+        return (json.dumps(body).encode(),FLAG_JSON)
+    if isinstance(body,str) :
+        return (body.encode('ascii'),0)
+    return (body,0)
+
+def decode_body(body,flags):
+    '''
+    Inverse of encode_body: returns decoded JSON for FLAG_JSON bodies, else the raw body.
+    '''
+    if flags & FLAG_JSON :
+        return json.loads(bytes(body).decode())
+    return body
+
+def recv_into_exactly(sock,view):
+    '''
+    Fill the writable buffer, view, from sock, looping over recv_into until it is full.
+
+    Raises ProtocolError if the connection closes first.
+    '''
+    view=memoryview(view).cast('B')
+    n_total=len(view)
+    n_read=0
+    while n_read<n_total :
+        n=sock.recv_into(view[n_read:])
+        if n==0 :
+            raise ProtocolError("Connection closed after {} of {} bytes".format(n_read,n_total))
+        n_read+=n
+    return view
+
+def recv_exactly(sock,n):
+    '''
+    Receive exactly n bytes from sock into a new bytearray.
+    '''
+    buf=bytearray(n)
+    recv_into_exactly(sock,buf)
+    return buf
+
+def send_frame(sock,opcode,body=None,request_id=0,flags=0):
+    '''
+    Send one frame over sock.
+
+    USAGE:
+        send_frame(sock,OP.INIT,{'fs':1000},request_id=7)
+    '''
+    (body,body_flags)=encode_body(body)
+    sock.sendall(encode_header(opcode,flags|body_flags,request_id,len(body)))
+    if len(body)>0 :
+        sock.sendall(body)
+
+def recv_frame(sock,max_length=None):
+    '''
+    Receive one frame from sock.  Raises ProtocolError, before receiving the body, if it is
+    longer than max_length bytes (default=no limit).
+
+    USAGE:
+        (opcode,flags,request_id,body)=recv_frame(sock)
+    '''
+    (opcode,flags,request_id,length)=decode_header(recv_exactly(sock,HEADER.size))
+    if not max_length is None and length>max_length :
+        raise ProtocolError("Frame body of {} bytes exceeds the limit of {} bytes".format(length,max_length))
+    return (opcode,flags,request_id,recv_exactly(sock,length))
+
+def negotiate(sock):
+    '''
+    Select the framed protocol on a freshly-connected socket.  Returns the server protocol version.
+    '''
+    sock.sendall(NEGOTIATE)
+    version=recv_exactly(sock,1)[0]
+    if version!=PROTOCOL_VERSION :
+        raise ProtocolError("Server speaks protocol version {}, expected {}".format(version,PROTOCOL_VERSION))
+    return version
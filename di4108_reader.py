@@ -0,0 +1,171 @@
+'''
+Run a DI-4108's reader in a process of its own, so that the timing of USB reads never depends
+on the server's threads - socket handlers, request parsing, compression - competing for the
+GIL.  The server process is then only a front end: it sends control commands (configure,
+trigger) to the reader process over a pipe, and the reader process writes each chunk it reads
+into a shared-memory ring (see di4108_shm.ShmRing), sending just its position back.
+
+ReaderProxy stands in for DI4108_WRAPPER in the server (see DI4108Site): it takes the same
+settings, mirrors the device's settings, record layout and start times, and its
+trig_data_pulse calls on_read with each chunk as the reader process reads it.
+
+USAGE:
+    device=ReaderProxy(fs=10000,chans=8)
+    (data,elapsed_time,raw_data)=device.trig_data_pulse(1.0,on_read=my_callback)
+    device.close()
+or, from the command line,
+    python3 di4108_server.py --reader-process [port[:serial_number] ...]
+'''
+import multiprocessing
+import numpy
+from di4108_shm import ShmRing, create_segment, attach
+
+def reader_main(conn,ring_name,device_match,simulate,settings):
+    '''
+    Entry point of the reader process.  Owns the device; answers commands from conn:
+        ('configure',settings) - re-initialize the device; replies ('ready',description)
+        ('trig',pulse_duration) - acquire a pulse, sending ('chunk',position,length,read_time)
+            for each chunk written to the ring, then ('done',elapsed_time,t_start,
+            t_start_uncertainty,length,segment) or ('error',message)
+        ('stop',) - exit
+    '''
+    from digitizer_models import DI4108_WRAPPER
+    from di4108_sim import SimulatedDI4108
+    from di4108_server import DI4108_SETTING_KEYS
+    ring=ShmRing(ring_name,create=False)
+
+    def describe(device):
+        return {'settings':dict([(k,device.__dict__['_'+k]) for k in DI4108_SETTING_KEYS]),\
+            'layout':device.record_layout()}
+
+    try :
+        dev=None if simulate is None else SimulatedDI4108(**simulate)
+        device=DI4108_WRAPPER(device_match=device_match,dev=dev,**settings)
+        conn.send(('ready',describe(device)))
+    except Exception as e :
+        conn.send(('error',repr(e)))
+        return
+    while True :
+        command=conn.recv()
+        if command[0]=='stop' :
+            break
+        if command[0]=='configure' :
+            try :
+                device.__init__(device_match=device_match,**command[1])
+                conn.send(('ready',describe(device)))
+            except Exception as e :
+                conn.send(('error',repr(e)))
+            continue
+        #Trigger
+        n_chunks=[0]
+        def on_read(chunk,read_time):
+            (position,n)=ring.write(chunk)
+            conn.send(('chunk',position,n,read_time))
+            n_chunks[0]+=n
+        try :
+            (data,elapsed_time,raw_data)=device.trig_data_pulse(command[1],on_read=on_read)
+        except Exception as e :
+            conn.send(('error',repr(e)))
+            continue
+        segment=None
+        if len(raw_data)!=n_chunks[0] :
+            #Shot holds more than the chunks read (e.g. pre-trigger samples) - hand it over whole
+            segment=create_segment(None,max(len(raw_data),1))
+            segment.buf[:len(raw_data)]=raw_data
+        conn.send(('done',elapsed_time,device.t_start,device.t_start_uncertainty,len(raw_data),\
+            None if segment is None else segment.name))
+        if not segment is None :
+            conn.recv() #Front end has copied it
+            segment.close()
+            segment.unlink()
+    ring.close()
+
+class ReaderProxy:
+    '''
+    Front end to a DI-4108 owned by a reader process.  See module documentation.
+    '''
+    ring_capacity=64*1024*1024 #Live data the front end may fall behind the reader by [bytes]
+
+    def __init__(self,device_match=None,simulate=None,**settings):
+        '''
+        Start the reader process with settings, as keyword arguments of DI4108_WRAPPER, or, if
+        already started, re-initialize its device with them.  With simulate (a dictionary of
+        keyword arguments of SimulatedDI4108), the reader process simulates the device.
+        '''
+        if not hasattr(self,'process') :
+            self.ring=ShmRing(capacity=ReaderProxy.ring_capacity)
+            context=multiprocessing.get_context('spawn') #Inherit none of the server's threads
+            (self.conn,child_conn)=context.Pipe()
+            self.process=context.Process(target=reader_main,name='di4108-reader',daemon=True,\
+                args=(child_conn,self.ring.name,device_match,simulate,settings))
+            self.process.start()
+            child_conn.close()
+            self.t_start=None
+            self.t_start_uncertainty=None
+        else :
+            self.conn.send(('configure',settings))
+        self.update(self.receive())
+
+    def receive(self):
+        try :
+            message=self.conn.recv()
+        except EOFError :
+            raise IOError("Reader process exited")
+        if message[0]=='error' :
+            raise IOError("Reader process failed: {}".format(message[1]))
+        return message
+
+    def update(self,message):
+        '''
+        Mirror the device's settings, as DI4108_WRAPPER stores them (in attributes named
+        '_'+setting), and record layout.
+        '''
+        description=message[1]
+        for (k,v) in description['settings'].items() :
+            self.__dict__['_'+k]=v
+        self.layout=description['layout']
+
+    @property
+    def fs(self):
+        return self._fs
+
+    def record_layout(self):
+        return dict(self.layout)
+
+    def trig_data_pulse(self,pulse_duration,on_read=None):
+        '''
+        As DI4108_WRAPPER.trig_data_pulse, but the first output is the raw data as an array of
+        unsigned 16-bit integers (the values of convert_bytes_to_int), not a list.
+        '''
+        self.conn.send(('trig',pulse_duration))
+        chunks=[]
+        while True :
+            message=self.receive()
+            if message[0]=='chunk' :
+                (position,n,read_time)=message[1:]
+                chunk=bytearray(n)
+                self.ring.read_into(position,chunk)
+                chunks.append(chunk)
+                if not on_read is None :
+                    on_read(chunk,read_time)
+                continue
+            (elapsed_time,self.t_start,self.t_start_uncertainty,length,segment_name)=message[1:]
+            break
+        if segment_name is None :
+            raw_data=b''.join(chunks)
+        else :
+            segment=attach(segment_name)
+            raw_data=bytes(segment.buf[:length])
+            segment.close()
+            self.conn.send(('copied',))
+        return (numpy.frombuffer(raw_data,dtype='<u2'),elapsed_time,raw_data)
+
+    def close(self):
+        '''
+        Stop the reader process, releasing the device.
+        '''
+        if self.process.is_alive() :
+            self.conn.send(('stop',))
+            self.process.join(5.0)
+        self.conn.close()
+        self.ring.close()
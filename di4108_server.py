@@ -6,87 +6,75 @@ T. Golfinopoulos, 7 Sept. 2018
 
 #See https://docs.python.org/3.4/library/socketserver.html
 
+import os
+import sys
+import atexit
 import socket
 import threading
 import socketserver
 import time
+import itertools
+import weakref
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 from digitizer_models import DI4108_WRAPPER
 import json
 
 from html.parser import HTMLParser#For decoding commands
+from di4108_stream import DataRing, StreamTCPServer, StatusRequestHandler
+from di4108_metrics import REGISTRY, METRICS_PORT, MetricsHTTPServer, label_key
+from di4108_shm import ShmRing, ShmShotStore
+from di4108_postproc import PostProcessor, parse_stages
+from di4108_reader import ReaderProxy
+from di4108_sim import SimulatedDI4108
+import di4108_profile
+import di4108_log
+from di4108_log import get_logger, debugging
+from di4108_decode import raw_to_int16, demux, reduce_records, format_array, record_scales, pack_array, \
+    encode_chunks, ENCODINGS
+from di4108_protocol import NEGOTIATE, PROTOCOL_VERSION, HEADER, FLAG_JSON, FLAG_MORE, FLAG_ERROR, OP, ProtocolError, \
+    encode_header, decode_header, check_request_length
 
 
-def debugging():
-    import os
-    return os.getenv("DEBUG_DEVICES")
-    
+LOG=get_logger('server')
+
 # create a subclass and override the handler methods
 class MyHTMLParser(HTMLParser):
     def __init__(self,*args,**kwargs):
-        self.start_tags=[]
-        self.attr=[]
-        self.data=[]
-        self.end_tags=[]
-        self.abs_pos=0
+        self.items=[]
         super(MyHTMLParser,self).__init__(*args,**kwargs)
     
     def feed(self,data):
         '''
-        Override feed method so that tags, attributes, and data populate lists, which are then
-        returned at end of close.
+        Override feed method so that tags and data populate a list, which is then returned.
         
         USAGE:
-            (start_tags_list,attr_list,data_list,end_tags_list)=my_parser.feed(data)
-        
-        Output is a tuple of lists of tuples.
-        The latter grouping of tuples consists of an HTML item and its absolute position in the ordering of items,
-            pair of, e.g. [(title,1),(body,3),...]
-        attr_list is a list of attribute lists.
-        '''
-        #Empty tag lists for filling
-        self.start_tags=[]
-        self.attr=[]
-        self.data=[]
-        self.end_tags=[]
-        self.abs_pos=0 #Zero position counter
+            items=my_parser.feed(data)
+        
+        items holds every item in order as (kind,value) pairs, with kind one of 'start',
+        'data', or 'end', so that item n is simply items[n], e.g.
+            [('start','init'),('data','{"fs":1000}'),('end','init'),('start','trig_pulse')]
+        It is also kept in the items attribute.
+        '''
+        self.items=[] #Empty item list for filling
         super(MyHTMLParser,self).feed(data)
-        return (self.start_tags,self.attr,self.data,self.end_tags)
+        return self.items
 
     def handle_starttag(self, tag, attrs):
-        attr_list=[]
         if debugging():
-            print("Encountered a start tag:", tag)
-            for attr in attrs :
-                if debugging():
-                    print(attr)            
-                attr_list+=attr #List of attributes
-        self.attr+=(attr_list,self.abs_pos)
-        self.start_tags+=[(tag,self.abs_pos)]
-        self.abs_pos+=1
+            LOG.debug("Encountered a start tag: %s %s",tag,attrs)
+        self.items.append(('start',tag))
 
     def handle_endtag(self, tag):
         if debugging():
-            print("Encountered an end tag :", tag)
-        self.end_tags+=[(tag,self.abs_pos)]
-        self.abs_pos+=1
+            LOG.debug("Encountered an end tag : %s",tag)
+        self.items.append(('end',tag))
 
     def handle_data(self, data):
         if debugging():
-            print("Encountered some data  :", data)
-        self.data+=[(data,self.abs_pos)]
-        self.abs_pos+=1
-    
-    def get_start_tags(self):
-        return self.start_tags
-    
-    def get_attr(self):
-        return self.attr
-    
-    def get_end_tags(self):
-        return self.end_tags
-    
-    def get_data(self):
-        return self.data
+            LOG.debug("Encountered some data  : %s",data)
+        self.items.append(('data',data))
 
 # instantiate the parser and fed it some HTML
 
@@ -155,25 +143,635 @@ class STORE_DATA:
     Store data globally - shrug - might also use file-based storage for non-volatility
     but take penalty on i/o
     '''
-    data={AcqPorts.SITE0:None}
-    elapsed_time={AcqPorts.SITE0:None}
+    shot={AcqPorts.SITE0:None} #Last Shot of each port - published and read through its DI4108Site
+
+class Shot:
+    '''
+    One acquired shot: its raw data as contiguous, immutable bytes, the elapsed time of the
+    pulse, the record layout (see DI4108_WRAPPER.record_layout), the id of the job that
+    acquired it, and the time its acquisition started, t_start (time.time() of the server),
+    within t_start_uncertainty [s].  Clients place t_start on their own clocks with the ping
+    command - see di4108_clock.  A shot is never modified once published, so any number of readers send
+    straight from data, without copying and without holding a lock while they send.  A reader
+    keeps its own reference to the shot, so a shot replaced while its replies are still being
+    sent stays whole until they are done, and is then freed like any other object.
+
+    USAGE:
+        shot=site.last_shot()
+        ...send memoryview(shot.data)...
+    '''
+    live=weakref.WeakSet() #All shots still in memory, for monitoring
+    live_lock=threading.Lock()
+
+    def __init__(self,data,elapsed_time,layout,job_id=None,t_start=None,t_start_uncertainty=None):
+        self.data=data
+        self.elapsed_time=elapsed_time
+        self.layout=layout
+        self.job_id=job_id
+        self.t_start=t_start
+        self.t_start_uncertainty=t_start_uncertainty
+        with Shot.live_lock :
+            Shot.live.add(self)
+
+class RWLock:
+    '''
+    Readers-writer lock: any number of readers at once, or a single writer.  Waiting writers
+    go ahead of new readers, so a steady stream of readers cannot starve a writer.
+
+    USAGE:
+        with my_lock.read_locked() :
+            ...
+        with my_lock.write_locked() :
+            ...
+    '''
+    def __init__(self):
+        self.cond=threading.Condition()
+        self.readers=0
+        self.writer=False
+        self.writers_waiting=0
+
+    def acquire_read(self):
+        with self.cond :
+            self.cond.wait_for(lambda : not self.writer and self.writers_waiting==0)
+            self.readers+=1
+
+    def release_read(self):
+        with self.cond :
+            self.readers-=1
+            if self.readers==0 :
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond :
+            self.writers_waiting+=1
+            self.cond.wait_for(lambda : not self.writer and self.readers==0)
+            self.writers_waiting-=1
+            self.writer=True
+
+    def release_write(self):
+        with self.cond :
+            self.writer=False
+            self.cond.notify_all()
+
+    @contextmanager
+    def read_locked(self):
+        self.acquire_read()
+        try :
+            yield
+        finally :
+            self.release_read()
+
+    @contextmanager
+    def write_locked(self):
+        self.acquire_write()
+        try :
+            yield
+        finally :
+            self.release_write()
         
-class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
+#Settings of DI4108_WRAPPER - its properties.  Found once, rather than on every request
+DI4108_SETTING_KEYS=[k for k in DI4108_WRAPPER.__dict__.keys() if type(DI4108_WRAPPER.__dict__[k]) is property]
+
+class SettingsCache:
+    '''
+    Process-wide, versioned copy of one site's settings, as the JSON string that get_settings
+    returns.  Connections read settings from here instead of from the settings file; the
+    version counter tells them cheaply whether settings changed since they last looked.  The
+    file is only written when settings change, atomically (temporary file, then rename), so
+    that it survives restarts and is never seen half-written.
+
+    USAGE:
+        cache=SettingsCache('settings_4220.json')
+        cache.load() #Returns False if there is no settings file yet
+        (version,settings_json)=cache.get()
+        version=cache.update(new_settings_json)
+    '''
+    def __init__(self,file_name):
+        self.file_name=file_name
+        self.lock=threading.Lock()
+        self.version=0
+        self.settings_json=None
+
+    def load(self):
+        '''
+        Read settings from file, if not already loaded.  Returns True if settings are available.
+        '''
+        with self.lock :
+            if self.settings_json is None and os.path.exists(self.file_name) :
+                f=open(self.file_name,'r')
+                self.settings_json=f.read()
+                f.close()
+                self.version+=1
+            return not self.settings_json is None
+
+    def get(self):
+        with self.lock :
+            return (self.version,self.settings_json)
+
+    def update(self,settings_json):
+        '''
+        Replace settings, bumping the version and saving to file only if they changed.
+        Returns the current version.
+        '''
+        with self.lock :
+            if settings_json!=self.settings_json :
+                self.settings_json=settings_json
+                self.version+=1
+                f=open(self.file_name+'.tmp','w')
+                f.write(settings_json)
+                f.close()
+                os.replace(self.file_name+'.tmp',self.file_name)
+            return self.version
+
+class AcqJob:
+    '''
+    One triggered pulse, run in the background on its site's executor.  The acquisition loop
+    counts the bytes it reads into the job as they arrive, so progress can be reported at any
+    time without touching the device or the reader.
+
+    USAGE:
+        job=AcqJob(site,pulse_duration)
+        job.future=site.executor.submit(job.run)
+        job.status() #Dictionary of job state and progress
+    '''
+    QUEUED='queued'
+    RUNNING='running'
+    DONE='done'
+    FAILED='failed'
+
+    ids=itertools.count(1) #Job ids are unique across all ports
+
+    #Fraction of the expected samples between broadcasts of progress on TSTAT
+    milestone_fraction=0.1
+
+    def __init__(self,site,pulse_duration,data_file_name=None,n_samps_pre=0,share_shots=False,share_live=False,\
+        postproc=None):
+        '''
+        INPUTS:
+            site=DI4108Site whose device is triggered
+            pulse_duration=duration of pulse [s]
+            data_file_name=file to which the shot is persisted, or None to keep it in memory only
+            n_samps_pre=number of pre-trigger samples, for status reports
+            share_shots, share_live=whether to copy the shot, and the live data as they are
+                read, into shared memory for processes on this host - see DI4108Site.share_shot
+            postproc=post-processing pipeline run on the shot in a worker process, or None - see
+                di4108_postproc.  The shot is shared, whatever share_shots
+        '''
+        self.id=next(AcqJob.ids)
+        self.site=site
+        self.port=site.port
+        self.pulse_duration=pulse_duration
+        self.data_file_name=data_file_name
+        self.share_shots=share_shots
+        self.share_live=share_live
+        self.postproc=postproc
+        self.expected_samples=site.expected_samples(pulse_duration) #None if not known in advance
+        self.n_samps_pre=int(n_samps_pre)
+        self.milestone=max(1,int((self.expected_samples or 0)*AcqJob.milestone_fraction))
+        self.next_milestone=self.milestone
+        self.state=AcqJob.QUEUED
+        self.error=None
+        self.future=None
+        self.bytes_read=0
+        self.bytes_per_sample=2
+        self.frame_offset=0 #Bytes read into the current sample
+        self.elapsed_time=None
+        self.t_queued=time.time()
+        self.t_start=None
+
+    def on_read(self,chunk,read_time):
+        '''
+        Called by the acquisition loop with each chunk read from the device, and the time
+        spent reading it [s].
+        '''
+        n=len(chunk)
+        USB_BYTES.inc(n,site=self.port)
+        READ_SECONDS.observe(read_time,site=self.port)
+        if bytes(chunk[:4])==b'stop' :
+            OVERFLOWS.inc(site=self.port) #Device reports buffer overflow in place of data
+        else :
+            #Reads come in whole packets, so a sample may straddle two reads - but never a
+            #16-bit record.  Only a read that leaves the stream off a record boundary has lost
+            #frame alignment
+            frame_offset=(self.frame_offset+n)%self.bytes_per_sample
+            if frame_offset%2!=self.frame_offset%2 :
+                RESYNCS.inc(site=self.port)
+            self.frame_offset=frame_offset
+        self.bytes_read+=n
+        USB_RATE.set(self.bytes_read/max(time.time()-self.t_start,1E-6),site=self.port)
+        self.site.stream_ring.publish(chunk)
+        if self.share_live :
+            self.site.share_chunk(chunk)
+        samples=self.samples
+        if samples>=self.next_milestone :
+            self.next_milestone=(samples//self.milestone+1)*self.milestone
+            self.site.publish_status(elapsed=samples)
+
+    def run(self):
+        '''
+        Perform soft-trigger of digitizer and record data for pulse_duration, then store the shot.
+        '''
+        self.t_start=time.time()
+        device=self.site.device
+        self.bytes_per_sample=2*device.record_layout()['number_records']
+        self.state=AcqJob.RUNNING
+        self.site.publish_status(STATE.ARM,pre=self.n_samps_pre,post=self.expected_samples,elapsed=0)
+        self.site.publish_status(STATE.RUNPOST,pre=self.n_samps_pre,post=self.expected_samples,elapsed=0)
+        try :
+            try :
+                (data,elapsed_time,bytes_data)=device.trig_data_pulse(self.pulse_duration,on_read=self.on_read)
+            finally :
+                self.site.stream_ring.mark_end()
+
+            self.site.publish_status(STATE.POPROCESS,elapsed=len(bytes_data)//self.bytes_per_sample)
+            prof=di4108_profile.PROFILER
+            if not prof is None : tp=prof.now()
+            if not self.data_file_name is None :
+                #Write to temporary file and rename, so a reader never sees a partial shot
+                f=open(self.data_file_name+'.tmp','wb')
+                f.write(bytes_data) #Write data as bytes
+                f.close()
+                os.replace(self.data_file_name+'.tmp',self.data_file_name)
+                if not prof is None : tp=prof.mark('persist',tp,len(bytes_data))
+            shot=Shot(bytes_data,elapsed_time,device.record_layout(),self.id,device.t_start,device.t_start_uncertainty)
+            self.site.publish_shot(shot)
+            if not prof is None : tp=prof.mark('publish',tp)
+            if self.share_shots or not self.postproc is None :
+                desc=self.site.share_shot(shot)
+                if not self.postproc is None :
+                    self.site.postprocess(self.id,desc,self.postproc) #Queued - never waited on here
+                if not prof is None : prof.mark('share',tp,len(bytes_data))
+        except Exception as e :
+            self.error=repr(e)
+            self.state=AcqJob.FAILED
+            self.site.publish_status(STATE.IDLE)
+            raise
+        self.bytes_read=len(bytes_data)
+        self.elapsed_time=elapsed_time
+        SHOT_SECONDS.observe(elapsed_time,site=self.port)
+        self.state=AcqJob.DONE
+        self.site.publish_status(STATE.IDLE)
+        if debugging():
+            LOG.debug('Pulse completed and data recorded - job %s, elapsed time=%s s, %s elements recorded',self.id,elapsed_time,len(data))
+
+    @property
+    def samples(self):
+        return self.bytes_read//self.bytes_per_sample
+
+    def status(self):
+        '''
+        Return dictionary describing the job: its id, state, samples read so far, samples
+        expected, elapsed time [s] (of the pulse, once done; else since the job started), and
+        error message if it failed.
+        '''
+        if not self.elapsed_time is None :
+            elapsed_time=self.elapsed_time
+        elif not self.t_start is None :
+            elapsed_time=time.time()-self.t_start
+        else :
+            elapsed_time=0.0
+        return {'job':self.id,'state':self.state,'samples':self.samples,\
+            'expected_samples':self.expected_samples,'elapsed_time':elapsed_time,'error':self.error}
+
+class JobRegistry:
+    '''
+    The most recent acquisition jobs of a site, by job id.
+    '''
+    def __init__(self,max_jobs=64):
+        self.max_jobs=max_jobs
+        self.jobs=OrderedDict()
+        self.lock=threading.Lock()
+
+    def add(self,job):
+        with self.lock :
+            self.jobs[job.id]=job
+            while len(self.jobs)>self.max_jobs :
+                self.jobs.popitem(last=False)
+
+    def get(self,job_id=None):
+        '''
+        Return the job with the given id, or the most recent job if job_id is None.
+        '''
+        with self.lock :
+            if len(self.jobs)==0 :
+                raise ValueError("No acquisition jobs - trigger a pulse first")
+            if job_id is None :
+                return next(reversed(self.jobs.values()))
+            if not job_id in self.jobs :
+                raise ValueError("Unknown job id {} - known jobs are {}".format(job_id,list(self.jobs.keys())))
+            return self.jobs[job_id]
+
+class DI4108Site:
+    '''
+    Everything belonging to one digitizer, served on one site port (AcqPorts.SITE0, SITE0+1,
+    ...): its device, settings, acquisition jobs and worker thread, live data ring, and status.
+    Its state and last shot are kept under its port in STATE.states and STORE_DATA.  Its
+    streaming and state broadcast services are on AcqPorts.STREAM and AcqPorts.TSTAT plus the
+    same offset as its port from AcqPorts.SITE0.
+
+    The device is opened on first use, with the site's saved settings.  With several DI-4108s
+    attached, device_match selects the site's device - see DI4108_WRAPPER.  Commands that use
+    or change the device (acquisitions, and init) are queued on the site's executor, which runs
+    them one at a time, in order.  With reader_process, the device is read in a process of its
+    own, and the site talks to it through a ReaderProxy - see di4108_reader.  With simulate (a
+    dictionary of keyword arguments of SimulatedDI4108), the device is simulated - see
+    di4108_sim.
+
+    USAGE:
+        site=DI4108Site(AcqPorts.SITE0+1,{'serial_number':'5A3B1C2D'})
+        site.device.fs
+        site.executor.submit(fn)
+    '''
+    def __init__(self,port,device_match=None,reader_process=False,simulate=None):
+        self.port=port
+        self.reader_process=reader_process
+        self.simulate=simulate
+        self.stream_port=AcqPorts.STREAM+port-AcqPorts.SITE0
+        self.tstat_port=AcqPorts.TSTAT+port-AcqPorts.SITE0
+        self.device_match=device_match
+        self._device=None
+        self.device_lock=threading.Lock()
+        self.settings=SettingsCache('settings_{}.json'.format(port))
+        self.jobs=JobRegistry()
+        #Single worker thread on which the site's device acquisition runs, so device I/O never
+        #blocks socket I/O, and sites never wait on each other
+        self.executor=ThreadPoolExecutor(max_workers=1,thread_name_prefix='di4108-acq-{}'.format(port))
+        #Ring of live data chunks, published by the acquisition loop and read by streaming subscribers
+        self.stream_ring=DataRing()
+        #acq400-style status - a list of fields indexed by SF - and ring of status lines
+        #broadcast to TSTAT listeners - see publish_status
+        self.status=[-1,0,0,0,0,0]
+        self.status_lock=threading.Lock()
+        self.tstat_ring=DataRing(capacity=64)
+        STATE.states.setdefault(port,-1)
+        STORE_DATA.shot.setdefault(port,None)
+        self.shot_lock=RWLock()
+        #Shared-memory copies of shots and live data, created on first use - see share_shot
+        self.shared_shots=None
+        self.shared_live=None
+        self.shared_lock=threading.Lock()
+        #Worker processes for post-processing, started on first use, and futures of their results by job id
+        self.postprocessor=None
+        self.postproc_results=OrderedDict()
+        self.max_postproc_results=64
+
+    @property
+    def device(self):
+        with self.device_lock :
+            if self._device is None :
+                settings={}
+                if self.settings.load() :
+                    saved=json.loads(self.settings.get()[1])
+                    settings=dict([(k,saved[k]) for k in DI4108_SETTING_KEYS if k in saved])
+                self._device=self.open_device(**settings)
+            return self._device
 
-    def __init__(self,*arg,**kwargs):
+    def expected_samples(self,pulse_duration):
+        '''
+        Return the number of samples a pulse of pulse_duration [s] records.
+        '''
+        return int(round(pulse_duration*self.device.fs))
+
+    def open_device(self,**settings):
+        if self.reader_process :
+            return ReaderProxy(device_match=self.device_match,simulate=self.simulate,**settings)
+        dev=None if self.simulate is None else SimulatedDI4108(**self.simulate)
+        return DI4108_WRAPPER(device_match=self.device_match,dev=dev,**settings)
+
+    def configure(self,**settings):
+        '''
+        (Re-)initialize the site's device with new settings.
+        '''
+        with self.device_lock :
+            if self._device is None :
+                self._device=self.open_device(**settings)
+            else :
+                self._device.__init__(device_match=self.device_match,**settings)
+
+    def publish_shot(self,shot):
+        '''
+        Make shot the site's last shot.  Replies already being sent from the previous shot
+        carry on from it undisturbed, through their own references to it.
+        '''
+        with self.shot_lock.write_locked() :
+            STORE_DATA.shot[self.port]=shot
+
+    def last_shot(self):
+        '''
+        Return the site's last shot, or None if there is no shot in memory.
+        '''
+        with self.shot_lock.read_locked() :
+            return STORE_DATA.shot[self.port]
+
+    def share_shot(self,shot):
+        '''
+        Copy shot into shared memory (see di4108_shm.ShmShotStore), for processes on this host
+        to map without a TCP transfer.  Returns its descriptor, which the shm command sends.
+        '''
+        with self.shared_lock :
+            if self.shared_shots is None :
+                self.shared_shots=ShmShotStore('di4108_{}'.format(self.port))
+                atexit.register(self.shared_shots.close)
+        return self.shared_shots.publish(shot.data,layout=shot.layout,job=shot.job_id,\
+            elapsed_time=shot.elapsed_time,t_start=shot.t_start,t_start_uncertainty=shot.t_start_uncertainty)
+
+    def share_chunk(self,chunk):
+        '''
+        Append a chunk of live data to the site's shared-memory ring (see di4108_shm.ShmRing).
+        '''
+        with self.shared_lock :
+            if self.shared_live is None :
+                self.shared_live=ShmRing()
+                atexit.register(self.shared_live.close)
+        self.shared_live.write(chunk)
+
+    def postprocess(self,job_id,desc,stages):
+        '''
+        Queue post-processing pipeline stages on a shared shot, with descriptor desc, in a
+        worker process (see di4108_postproc), returning at once.  Results are kept by job id,
+        for the postproc command.
+        '''
+        with self.shared_lock :
+            if self.postprocessor is None :
+                self.postprocessor=PostProcessor()
+            future=self.postprocessor.submit(desc,stages)
+            self.postproc_results[job_id]=future
+            while len(self.postproc_results)>self.max_postproc_results :
+                self.postproc_results.popitem(last=False)
+        future.add_done_callback(lambda f : postproc_done(f,self.port))
+        return future
+
+    def postproc_result(self,job_id=None):
+        '''
+        Return (job id, future) of the post-processing of a job (default=the most recent).
+        '''
+        with self.shared_lock :
+            if len(self.postproc_results)==0 :
+                raise ValueError("No shots post-processed - init with a postproc pipeline")
+            if job_id is None :
+                job_id=next(reversed(self.postproc_results.keys()))
+            if not job_id in self.postproc_results :
+                raise ValueError("No post-processing of job {} - known jobs are {}".format(job_id,list(self.postproc_results.keys())))
+            return (job_id,self.postproc_results[job_id])
+
+    def publish_status(self,state=None,pre=None,post=None,elapsed=None):
+        '''
+        Update the status of the site, and broadcast it to TSTAT listeners as an acq400 status line,
+            "state pre post elapsed 0 demux\\n"
+        with pre, post, and elapsed counted in samples.  Fields given as None keep their values.
+        STATE.states follows the state.
+
+        USAGE:
+            site.publish_status(STATE.RUNPOST,pre=0,post=10000,elapsed=0)
+            site.publish_status(elapsed=5000)
+        '''
+        with self.status_lock :
+            status=self.status
+            for (field,value) in ((SF.STATE,state),(SF.PRE,pre),(SF.POST,post),(SF.ELAPSED,elapsed)) :
+                if not value is None :
+                    status[field]=int(value)
+            if not state is None :
+                STATE.states[self.port]=state
+            self.tstat_ring.publish(bytes(' '.join([str(v) for v in status])+'\n','ascii'))
+
+#Sites served by this process, keyed by port - see get_site
+SITES={}
+SITES_LOCK=threading.Lock()
+
+def add_site(port,device_match=None,reader_process=False,simulate=None):
+    '''
+    Register a site, whose device is selected by device_match, read in a process of its own if
+    reader_process, and simulated if simulate is given (see DI4108Site).  Returns the
+    DI4108Site.
+    '''
+    with SITES_LOCK :
+        if port in SITES :
+            raise ValueError("Site on port {} already exists".format(port))
+        SITES[port]=DI4108Site(port,device_match,reader_process,simulate)
+        return SITES[port]
+
+def get_site(port):
+    '''
+    Return the site served on port, registering it (with the first DI-4108 found) if need be.
+    '''
+    with SITES_LOCK :
+        if not port in SITES :
+            SITES[port]=DI4108Site(port)
+        return SITES[port]
+
+def parse_sites(args):
+    '''
+    Register the sites given on the command line, each as port or port:serial_number.  With
+    the flag --reader-process, each site's device is read in a process of its own (see
+    di4108_reader); with --simulate, each is a simulated DI-4108 (see di4108_sim).  Returns
+    list of sites - by default, a single site on AcqPorts.SITE0.
+
+    USAGE:
+        sites=parse_sites(sys.argv[1:]) #e.g. ['4220:5A3B1C2D','4221:5A3B1C3E']
+    '''
+    reader_process='--reader-process' in args
+    simulate={} if '--simulate' in args else None
+    args=[arg for arg in args if not arg in ('--reader-process','--simulate')]
+    if len(args)==0 :
+        args=[str(AcqPorts.SITE0)]
+    sites=[]
+    for arg in args :
+        (port,sep,serial_number)=arg.partition(':')
+        sites.append(add_site(int(port),{'serial_number':serial_number} if sep else None,reader_process,simulate))
+    return sites
+
+def start_site_services(host,site):
+    '''
+    Serve the streaming and state broadcast services of site, each on a daemon thread.
+    Returns list of the servers.
+    '''
+    servers=[StreamTCPServer((host,site.stream_port),site.stream_ring),\
+        StreamTCPServer((host,site.tstat_port),site.tstat_ring,StatusRequestHandler)]
+    for server in servers :
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+    LOG.info("Site %s: streaming service on port %s, state broadcast service on port %s",site.port,site.stream_port,site.tstat_port)
+    return servers
+
+#Performance counters - see di4108_metrics
+USB_BYTES=REGISTRY.counter('di4108_usb_bytes_total','Bytes read from the device')
+USB_RATE=REGISTRY.gauge('di4108_usb_bytes_per_second','Rate of reading from the device over the current or last shot')
+READ_SECONDS=REGISTRY.histogram('di4108_read_seconds','Time spent in each read from the device')
+OVERFLOWS=REGISTRY.counter('di4108_overflows_total','Device buffer overflows, reported by the device in place of data')
+RESYNCS=REGISTRY.counter('di4108_resyncs_total','Reads that broke off within a 16-bit record, misaligning the records after them')
+SHOT_SECONDS=REGISTRY.histogram('di4108_shot_seconds','Duration of each acquired shot',(0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0,60.0))
+REQUEST_SECONDS=REGISTRY.histogram('di4108_request_seconds','Time to run each command, including sending its reply in the threaded server')
+REQUEST_ERRORS=REGISTRY.counter('di4108_request_errors_total','Commands that failed')
+BYTES_SENT=REGISTRY.counter('di4108_bytes_sent_total','Bytes sent to each client host')
+POSTPROC_SECONDS=REGISTRY.histogram('di4108_postproc_seconds','Time to post-process each shot in a worker process',\
+    (0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0))
+POSTPROC_ERRORS=REGISTRY.counter('di4108_postproc_errors_total','Shots whose post-processing failed')
+
+def postproc_done(future,port):
+    if future.cancelled() or not future.exception() is None :
+        POSTPROC_ERRORS.inc(site=port)
+    else :
+        POSTPROC_SECONDS.observe(future.result()['seconds'],site=port)
+
+def site_values(fn):
+    '''
+    Return {labels of site: fn(site)} over all sites, for gauges computed when scraped.
+    '''
+    with SITES_LOCK :
+        sites=list(SITES.values())
+    return dict([(label_key({'site':site.port}),fn(site)) for site in sites])
+
+def shot_memory():
+    with Shot.live_lock :
+        return {():sum([len(shot.data) for shot in Shot.live])}
+
+REGISTRY.gauge('di4108_shot_memory_bytes','Memory held by shots - the last shot of each site, and replaced shots still being sent',shot_memory)
+REGISTRY.gauge('di4108_stream_subscribers','Streaming subscribers connected',\
+    lambda : site_values(lambda site : len(site.stream_ring.backlogs())))
+REGISTRY.gauge('di4108_stream_backlog_chunks','Backlog of the furthest-behind streaming subscriber',\
+    lambda : site_values(lambda site : max([b for (b,d) in site.stream_ring.backlogs()]+[0])))
+REGISTRY.gauge('di4108_stream_dropped_chunks','Chunks dropped by the policies of connected streaming subscribers',\
+    lambda : site_values(lambda site : sum([d for (b,d) in site.stream_ring.backlogs()])))
+
+class DI4108Commands:
+    '''
+    Implementation of the server commands, independent of how requests arrive.  Connection
+    handlers (ThreadedTCPRequestHandler, and the asyncio session in di4108_async_server) mix
+    this in, call init_commands, decode requests into dispatch_frame or dispatch_legacy, and
+    provide send_raw, send_file, and send_iter to carry replies back to the client.
+    '''
+    job_class=AcqJob #Class of the jobs queued by trig_pulse - see handle_trig_pulse
+
+    def init_commands(self,this_port=AcqPorts.SITE0,client=None):
+        '''
+        Set up per-connection command state, for the site served on this_port, and a client
+        at host address client.  Called by each server's connection handler before any command
+        is dispatched.
+        '''
         if debugging():
-            print("Initing ThreadedTCPRequestHandler")
-        #    self.my_di4108=None #Additional 
-        this_port=AcqPorts.SITE0 #For now, keep constant port - eventually, figure out how to parse
+            LOG.debug("Initing DI4108Commands")
+        self.site=self.find_site(this_port)
+        self.client=client
         self.parser=MyHTMLParser() #Try not to instantiate this every time....
         self._protocol_dict={'init':self.handle_init,\
                             'trig_pulse':self.handle_trig_pulse,\
                             'store':self.handle_store,\
                             'get_settings':self.handle_get_settings,\
-                            'query_data_length':self.handle_query_data_length}
+                            'query_data_length':self.handle_query_data_length,\
+                            'get_seg':self.handle_get_seg,\
+                            'wait':self.handle_wait,\
+                            'status':self.handle_status,\
+                            'metrics':self.handle_metrics,\
+                            'ping':self.handle_ping,\
+                            'shm':self.handle_shm,\
+                            'postproc':self.handle_postproc,\
+                            'profile':self.handle_profile}
                             #'start_stream':None,'stop':None,'n_samps_pre':None,'n_samps_post':None,\
-                            #'test':None,'get_seg':None]
+                            #'test':None]
         self.store_mode='pulse' #Alternative is "stream"
+        self.persist_shots=False #Whether to also write each shot to data_file_name
+        self.share_shots=False #Whether to also copy each shot to shared memory
+        self.share_live=False #Whether to also copy live data to shared memory
+        self.postproc=None #Post-processing pipeline run on each shot - see di4108_postproc
         self.n_samps_pre=0
         self.n_samps_post=1E4
         self.pulse_duration=1.0 #Default pulse length [s]
@@ -183,73 +781,75 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         self.data_file_name='last_data_{}.bin'.format(this_port)
         self.elapsed_time_file_name='last_pulse_elapsed_time_{}.txt'.format(this_port)
 
+        self.settings_cache=self.site.settings
+        self.settings_version=-1
+
         if STATE.str(STATE.states[this_port])=='UNDEF': #If state is not defined, use default settings and put in idle
-            try :
+            if not self.settings_cache.load() :
                 #Put initial settings into file
-                f=open(self.settings_file_name,'x')
-                f.write(self.settings_to_json())
-                f.close()
-
-                STATE.states[this_port]=STATE.ARM #Armed, since ready for trigger
-            except :
-                if debugging():
-                    print("Can't create new settings file - may exist already - try to open and use")
-        
-        '''
-        #Settings persist in class variable, my_di4108, which is non-extensible - could become a dictionary
-        #with port number as key.  Else read each time from json, whose name contains port.
-        #But still rely on persistence of my_di4108 class variable to get data.
-        try :
-            #Try to load existing settings
-            f=open(self.settings_file_name,'r')
-            current_settings=f.read(ThreadedTCPRequestHandler.max_size)
-            self.handle_init(current_settings)
-            if debugging():
-                print("Opened settings file - current settings: {}".format(current_settings))
-        except :
-            if debugging():
-                print("Can't open settings file - may exist already, or may have permissions error, etc.")
-        '''
+                self.settings_cache.update(self.settings_to_json())
+            self.site.publish_status(STATE.ARM) #Armed, since ready for trigger
         
         if debugging():
-            print("STATE="+str(STATE.states[this_port]))
+            LOG.debug("STATE=%s",STATE.states[this_port])
         
-        #Read settings from json, since this init is run on every new request....
+        #Apply current settings from the process-wide cache - no file i/o
         self.reinitialize()
-        
-        #This really has to be the last thing in the __init__ method of the subclass; it seems to
-        #run handle on its own.  And so any initializations have to be applied before this.
-        super(ThreadedTCPRequestHandler,self).__init__(*arg,**kwargs)
-        
-    #my_di4108=None
-    my_di4108=DI4108_WRAPPER() #Use default settings
+
+    def find_site(self,this_port):
+        '''
+        Return the site served on this_port - see get_site.
+        '''
+        return get_site(this_port)
+
     buffer_size=1024
     max_size=16*buffer_size
     MAX_FILE_SIZE=1024*1024*1024 #1 GB=maximum file size
 
-    def handle(self):
+    def dispatch_frame(self,opcode,request_id,body):
         '''
-        data = str(self.request.recv(1024), 'ascii')
-        cur_thread = threading.current_thread()
-        response = bytes("{}: {}".format(cur_thread.name, data), 'ascii')
-        print(response)
-        self.request.sendall(response)
-        self.request.close()
-    
+        Run the command for one framed request, replying with an error frame if it fails, or an
+        empty acknowledgement frame if the command itself sends nothing.
+        '''
+        self.opcode=opcode
+        self.request_id=request_id
+        self.replied=False
+        try :
+            self.reinitialize()
+            name=OP.names.get(opcode)
+            if not name in self._protocol_dict :
+                raise ProtocolError("Unsupported opcode {}".format(opcode))
+            if len(body)>0 :
+                self.run_command(name,bytes(body).decode())
+            else :
+                self.run_command(name)
+        except Exception as e :
+            LOG.error("Can't handle opcode %s, request id %s: %r",opcode,request_id,e,exc_info=debugging())
+            self.send_reply_frame(str(e).encode(),FLAG_ERROR)
+            return
+        if not self.replied :
+            self.send_reply_frame(b'') #Empty acknowledgement, so client knows command is complete
+
+    def check_frame(self,opcode,request_id,length):
+        '''
+        Check the body length in a request header before the body is read.  Returns False,
+        having replied with an error frame, if the request is refused - the transport then
+        closes the connection, since the body is never read.
         '''
-        #Use recv - loop until transmission is complete and socket returns empty
-        this_data = str(self.request.recv(ThreadedTCPRequestHandler.buffer_size), 'ascii')
-        data=this_data
-        #while len(this_data) > 0 and len(data)<ThreadedTCPRequestHandler.max_size :
-        #    this_data = str(self.request.recv(ThreadedTCPRequestHandler.buffer_size).strip(), 'ascii')
-        #    data+=this_data
-        #Use readline to read request until newline character is encountered
-        #data = str(self.rfile.readline(), 'ascii')
+        try :
+            check_request_length(length)
+        except ProtocolError as e :
+            LOG.warning("Refusing request from %s: %s",self.client,e)
+            self.opcode=opcode
+            self.request_id=request_id
+            self.send_reply_frame(str(e).encode(),FLAG_ERROR)
+            return False
+        return True
 
-        #Get thread
-        cur_thread = threading.current_thread()
-        response = bytes("{}: {}".format(cur_thread.name, data), 'ascii') #Convert to bytes format first
-        
+    def dispatch_legacy(self,data):
+        '''
+        Run the commands in a request in the legacy tag grammar, e.g. <init>{"fs":1000}</init><trig_pulse>
+        '''
         #Parse data
         #data can be
         #1. a store rqeuest, "store"
@@ -259,78 +859,181 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         #4. a "start" command (soft trigger)
         #5. a "stop" command (soft close)
         try :
-            (start_tags,attr,content,end_tags)=self.parser.feed(data)
-            
-            start_tag_pos=[t[1] for t in start_tags]
-            end_tag_pos=[t[1] for t in end_tags]
-            content_pos=[c[1] for c in content]
-            
-            content_tags=[]
-            
-            #Traverser through start_tags.
-            #If a start tag is followed by content, and a matching
-            #end tag, pass this as an argument to function.
-            #Else, just run without argument.
-            for start_tag in start_tags :
-                #Recall that tags are stored as tuples, with first element the string,
-                #and second the absolute position in the transmission
-                if debugging():
-                    print(start_tag)
-                    print(self._protocol_dict.keys())
-                    print(start_tags)
-                    print(content)
-                    print(end_tags)
-                if start_tag[0] in self._protocol_dict.keys() :
-                    if (start_tag[1]+1) in content_pos and (start_tag[1]+2) in end_tag_pos :
-                        if end_tags[end_tag_pos.index(start_tag[1]+2)][0]==start_tag[0] :
-                            #Call with content as argument
-                            self._protocol_dict[start_tag[0]](content[content_pos.index(start_tag[1]+1)][0])
-                    else :
-                        self._protocol_dict[start_tag[0]]()
+            self.reinitialize()
+            for (name,args) in self.legacy_commands(data) :
+                self.run_command(name,*args)
         except:
-            print("Error - can't handle "+data)
+            LOG.error("Can't handle %r",data)
             raise
-            
-        #Return data for debugging purposes
-        if debugging():
-            print('Done - ready to send shutdown message')
-        #self.request.sendall(response)
-        #self.request.sendall(''.encode()) #Send empty to close
-        self.request.shutdown(socket.SHUT_RDWR)
-        self.request.close()
-        if debugging():    
-            print('Done handling request')
-        
-    
+
+    def legacy_commands(self,data):
+        '''
+        Return list of (command name, tuple of its arguments) of the commands in a request in
+        the legacy tag grammar, in order.
+        '''
+        items=self.parser.feed(data)
+        commands=[]
+        #Traverse items in order.
+        #If a start tag is followed by content, and a matching
+        #end tag, pass this as an argument to function.
+        #Else, just run without argument.
+        for i in range(len(items)) :
+            (kind,tag)=items[i]
+            if kind!='start' or not tag in self._protocol_dict :
+                continue
+            if debugging():
+                LOG.debug("Command items: %s",items[i:i+3])
+            if i+2<len(items) and items[i+1][0]=='data' and items[i+2][0]=='end' :
+                if items[i+2][1]==tag :
+                    #Call with content as argument
+                    commands.append((tag,(items[i+1][1],)))
+            else :
+                commands.append((tag,()))
+        return commands
+
+    def run_command(self,name,*args):
+        '''
+        Run the named command, timing it for the request latency metrics.
+        '''
+        t_start=time.perf_counter()
+        try :
+            self._protocol_dict[name](*args)
+        except Exception :
+            REQUEST_ERRORS.inc(site=self.site.port,command=name)
+            raise
+        finally :
+            REQUEST_SECONDS.observe(time.perf_counter()-t_start,site=self.site.port,command=name)
+
+    def count_sent(self,n):
+        '''
+        Record n bytes sent to the client - called by transports.
+        '''
+        BYTES_SENT.inc(n,client=self.client)
+
+    def reply(self,*payload):
+        '''
+        Send a command's response payload (a bytes-like object) to the requester.  In the legacy
+        protocol, the payload is written raw; in the framed protocol, it is wrapped in a reply frame
+        carrying the request id.  The payload may be given in several pieces, which are sent back
+        to back as one response, e.g. self.reply(header,data).
+        '''
+        if self.framed :
+            self.replied=True
+            self.send_raw(encode_header(self.opcode,0,self.request_id,sum([memoryview(p).nbytes for p in payload])))
+        for p in payload :
+            if memoryview(p).nbytes>0 :
+                self.send_raw(p)
+
+    def reply_file(self,f):
+        '''
+        Send the contents of the open binary file, f, as a command's response, letting the
+        kernel copy it to the socket.  Takes ownership of f, which is closed once sent.
+        '''
+        if self.framed :
+            self.replied=True
+            self.send_raw(encode_header(self.opcode,0,self.request_id,os.fstat(f.fileno()).st_size))
+        self.send_file(f)
+
+    def reply_json(self,obj):
+        '''
+        Send obj, JSON-encoded, as a command's response.
+        '''
+        payload=json.dumps(obj).encode()
+        if self.framed :
+            self.send_reply_frame(payload,FLAG_JSON)
+        else :
+            self.send_raw(payload)
+
+    def reply_frames(self,frames):
+        '''
+        Send a multi-frame response (framed protocol only): each (payload, flags) pair from the
+        iterable frames becomes one reply frame.  Frames are produced only as the transport
+        sends them, so a response need never be held in memory all at once.  The last frame
+        must not have FLAG_MORE set.
+        '''
+        self.replied=True
+        opcode=self.opcode
+        request_id=self.request_id
+        def pieces() :
+            for (payload,flags) in frames :
+                yield encode_header(opcode,flags,request_id,len(payload))
+                if len(payload)>0 :
+                    yield payload
+        self.send_iter(pieces())
+
+    def send_reply_frame(self,payload,flags=0):
+        self.replied=True
+        self.send_raw(encode_header(self.opcode,flags,self.request_id,len(payload)))
+        if len(payload)>0 :
+            self.send_raw(payload)
+
     def handle_trig_pulse(self):
         '''
-        On a <trig_pulse> command, perform soft-trigger of digitizer
-        and record data per pulse duration in settings.
+        On a <trig_pulse> command, queue an acquisition job (a job_class), which performs
+        soft-trigger of digitizer and records data per pulse duration in settings.  In the
+        framed protocol, the reply is sent at once: the job status (see AcqJob.status), holding
+        the job id for wait and status commands.  Legacy requests block until the pulse is
+        complete, so that a following <store> returns its data, and send no reply, as before.
         '''
         if debugging():
-            print('Received trigger request - about to perform soft trigger, pulse duration={}...'.format(self.pulse_duration))
-        
-        this_port=AcqPorts.SITE0
-        
-        STATE.states[this_port]=STATE.RUNPOST
+            LOG.debug('Received trigger request - queueing soft trigger, pulse duration=%s...',self.pulse_duration)
         
-        #(self.data,self.elapsed_time)=ThreadedTCPRequestHandler.my_di4108.trig_data_pulse(self.pulse_duration)
-        (data,elapsed_time,bytes_data)=ThreadedTCPRequestHandler.my_di4108.trig_data_pulse(self.pulse_duration)
+        job=self.job_class(self.site,self.pulse_duration,self.data_file_name if self.persist_shots else None,self.n_samps_pre,\
+            self.share_shots,self.share_live,self.postproc)
+        #Submit before registering, so no other connection finds the job without its future
+        job.future=self.site.executor.submit(job.run)
+        self.site.jobs.add(job)
+        if self.framed :
+            self.reply_json(job.status())
+        else :
+            self.wait_pulse(job)
+
+    def wait_pulse(self,job):
+        '''
+        Block until the job of a legacy trig_pulse is complete, raising its error if it failed.
+        '''
+        job.future.result()
         
-        STATE.states[this_port]=STATE.POPROCESS
-        #f=open(self.data_file_name,'w')
-        #f.write(bytes(data)) #Write data as bytes
-        #f.close()
-        #f=open(self.elapsed_time_file_name,'w')
-        #f.write(elapsed_time) #Write data as text
-        #f.close()
-        STORE_DATA.data[this_port]=bytes_data
-        STORE_DATA.elapsed_time[this_port]=elapsed_time
+    def find_job(self,job_json=None):
+        '''
+        Return (job, timeout) requested by a wait or status command, whose optional JSON
+        dictionary holds job=job id (default=most recent job) and timeout [s].
+        '''
+        args={} if job_json is None else json.loads(job_json)
+        job_id=args.get('job')
+        timeout=args.get('timeout')
+        return (self.site.jobs.get(None if job_id is None else int(job_id)),\
+            None if timeout is None else float(timeout))
+
+    def wait_job(self,job,timeout):
+        '''
+        Block until job finishes or timeout [s] elapses (timeout=None waits indefinitely).
+        '''
+        wait_futures([job.future],timeout)
+
+    def handle_wait(self,job_json=None):
+        '''
+        On a <wait> command, long-poll: reply with the job status once the job has finished,
+        or once timeout has elapsed, whichever comes first.  A job that is still queued or
+        running on the reply timed out.  E.g.
+            <wait>{"job":3,"timeout":5}</wait>
+        '''
+        (job,timeout)=self.find_job(job_json)
         if debugging():
-            print('Pulse completed and data recorded - elapsed time={} s, {} elements recorded'.format(elapsed_time,len(data)))
-        
-    
-    def handle_store(self):
+            LOG.debug("Received wait request - job %s, timeout=%s",job.id,timeout)
+        self.wait_job(job,timeout)
+        self.reply_json(job.status())
+
+    def handle_status(self,job_json=None):
+        '''
+        On a <status> command, reply at once with the job status, including samples read so
+        far.  E.g.
+            <status>{"job":3}</status>
+        '''
+        (job,timeout)=self.find_job(job_json)
+        self.reply_json(job.status())
+
+    def handle_store(self,store_json=None):
         '''
         Return data obtained from recent pulse.  Send through socket as bytes array.
         Except for digital input data, data are stored as twos-complement signed integers.
@@ -338,46 +1041,292 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         on the setup of the device.  The best way to convert the data is via the di4108 digitizer model
         "convert_data" method.  You can synchronize device settings by using the "<get_settings>" command
         to pull the current on-board settings.
+
+        The stored buffer is sent as-is through a memoryview, without copying.  If no shot is
+        held in memory but one was persisted to disk (e.g. before a server restart), the file
+        is sent with sendfile.
+
+        Alternatively (acq400 SF.DEMUX), the server can demultiplex and decode the data, with
+        store_json a JSON dictionary holding
+            format='raw' (default - as above), 'int16' (channel-major raw values), or 'float32'
+                (channel-major values scaled to physical units, as by convert_data)
+            byteorder='little' (default), 'big', or 'native' (that of the server)
+        The response is then an array header and the array data (see di4108_decode.unpack_array),
+        with the header also holding the scale factors of each record (see
+        di4108_decode.record_scales), the record layout, the elapsed time of the pulse, and its
+        start time and uncertainty on the server's clock (see Shot).  E.g.
+            <store>{"format":"float32"}</store>
+
+        Over the framed protocol, the data of any format may also be sent in chunks, compressed
+        or not, with store_json holding
+            encoding='raw' (uncompressed chunks) or 'zlib'.  Without encoding, the data are sent
+                whole, as above
+            level=zlib compression level, 0-9.  Default=6
+            delta=whether to delta-encode each channel before compressing (not for float32).
+                Default=False
+            chunk_samples=number of samples compressed and sent at a time.  Default=65536
+        The data are then compressed a chunk at a time while they are sent (see
+        di4108_decode.encode_chunks), in a multi-frame response: a JSON frame describing the
+        encoded array (as the array header above, plus its time axis and the encoding), one
+        frame per encoded chunk, then a final JSON frame of transfer statistics - raw and wire
+        bytes, compression ratio, time spent compressing, and throughput.  E.g.
+            {"format":"int16","encoding":"zlib","level":1,"delta":true}
         
         T. Golfinopoulos, 12 Sept. 2018
         '''
         
-        this_port=AcqPorts.SITE0
-        
-        if debugging():
-            print("Received store request - about to send data, {} elements...".format(len(STORE_DATA.data[this_port])))
-        #time.sleep(3)
-        
-        #self.request.sendall(bytes(self.data))
-        #Read data from file
-        #f=open(self.data_file_name)
-        #data=f.read(ThreadedTCPRequestHandler.MAX_FILE_SIZE)
-        #f.close()
-        #self.request.sendall(bytes(data))
-        #print(STORE_DATA.data[this_port])
-        self.request.sendall(bytes(STORE_DATA.data[this_port]))
+        shot=self.site.last_shot()
+        args={} if store_json is None else json.loads(store_json)
+        fmt=args.get('format','raw')
+
+        encoding=args.get('encoding')
+        if not encoding is None and (self.framed or encoding!='raw') :
+            if not self.framed :
+                raise ValueError("Compressed store requires the framed protocol")
+            if shot is None :
+                raise ValueError("No data stored - trigger a pulse first")
+            self.reply_frames(self.encoded_store_frames(shot,fmt,args))
+        elif fmt!='raw' :
+            if debugging():
+                LOG.debug("Received store request - about to send demultiplexed %s data...",fmt)
+            if shot is None :
+                raise ValueError("No data stored - trigger a pulse first")
+            layout=shot.layout
+            chan_data=format_array(demux(shot.data,layout['number_records']),layout,None,fmt,args.get('byteorder','little'))
+            (header,array_data)=pack_array(chan_data,format=fmt,scales=record_scales(layout),layout=layout,\
+                elapsed_time=shot.elapsed_time,t_start=shot.t_start,t_start_uncertainty=shot.t_start_uncertainty)
+            self.reply(header,array_data)
+        elif shot is None and os.path.exists(self.data_file_name) :
+            if debugging():
+                LOG.debug("Received store request - about to send data from %s...",self.data_file_name)
+            self.reply_file(open(self.data_file_name,'rb'))
+        elif shot is None :
+            raise ValueError("No data stored - trigger a pulse first")
+        else :
+            if debugging():
+                LOG.debug("Received store request - about to send data, %s elements...",len(shot.data))
+            self.reply(memoryview(shot.data))
         
         if debugging():
-            print("...sent stored data")
+            LOG.debug("...sent stored data")
     
+    def encoded_store_frames(self,shot,fmt,args):
+        '''
+        Return generator of the (payload, flags) reply frames of a compressed store - see
+        handle_store.  Each chunk is compressed only when the previous one has been handed to
+        the transport.  Requests are checked here, before the response starts.
+        '''
+        t_start=time.perf_counter()
+        layout=shot.layout
+        if fmt=='raw' :
+            #Interleaved samples, one row per sample
+            n_samps=len(shot.data)//(2*layout['number_records'])
+            samples=raw_to_int16(shot.data)[:n_samps*layout['number_records']].reshape(n_samps,layout['number_records'])
+            axis=0
+        else :
+            samples=format_array(demux(shot.data,layout['number_records']),layout,None,fmt,args.get('byteorder','little'))
+            axis=1
+        level=int(args.get('level',6))
+        delta=bool(args.get('delta',False))
+        chunk_samples=int(args.get('chunk_samples',65536))
+        if not args['encoding'] in ENCODINGS :
+            raise ValueError("encoding must be one of {} - you entered {}".format(ENCODINGS,args['encoding']))
+        if level<0 or level>9 :
+            raise ValueError("level must be between 0 and 9 - you entered {}".format(level))
+        if chunk_samples<1 :
+            raise ValueError("chunk_samples must be an integer >= 1 - you entered {}".format(chunk_samples))
+        if delta and fmt=='float32' :
+            raise ValueError("Delta encoding requires integer samples - use format raw or int16")
+        chunks=encode_chunks(samples,axis,chunk_samples,args['encoding'],level,delta)
+        desc={'format':fmt,'dtype':samples.dtype.str,'shape':list(samples.shape),'axis':axis,\
+            'encoding':args['encoding'],'level':level,'delta':delta,'chunk_samples':chunk_samples,\
+            'scales':record_scales(layout),'layout':layout,'elapsed_time':shot.elapsed_time,\
+            't_start':shot.t_start,'t_start_uncertainty':shot.t_start_uncertainty}
+        return self.encoded_frames(desc,chunks,t_start)
+
+    def encoded_frames(self,desc,chunks,t_start):
+        '''
+        Generator of the frames of a compressed store: description, chunks, then statistics.
+        '''
+        yield (json.dumps(desc).encode(),FLAG_JSON|FLAG_MORE)
+
+        raw_bytes=0
+        wire_bytes=0
+        compress_seconds=0.0
+        while True :
+            t_chunk=time.perf_counter()
+            try :
+                (encoded,n)=next(chunks)
+            except StopIteration :
+                break
+            compress_seconds+=time.perf_counter()-t_chunk
+            raw_bytes+=n
+            wire_bytes+=len(encoded)
+            yield (encoded,FLAG_MORE)
+
+        elapsed=time.perf_counter()-t_start
+        stats={'raw_bytes':raw_bytes,'wire_bytes':wire_bytes,\
+            'ratio':raw_bytes/wire_bytes if wire_bytes>0 else None,\
+            'compress_seconds':compress_seconds,'seconds':elapsed,\
+            'throughput':raw_bytes/elapsed if elapsed>0 else None} #Raw bytes/s
+        if debugging():
+            LOG.debug("Sent compressed store - %s",stats)
+        yield (json.dumps(stats).encode(),FLAG_JSON)
+
+    def handle_get_seg(self,seg_json=None):
+        '''
+        On a <get_seg> command, return part of the data from the recent pulse, demultiplexed into
+        channel-major order and reduced on the server, so that only what is needed crosses the network.
+
+        seg_json is an optional JSON dictionary with any of the keys
+            offset=first sample to return.  Default=0
+            length=number of samples to return.  Default=all samples from offset
+            chans=list of record indices to return - analog channels first, in the order of the
+                device chans setting, then digital input, rate, and counter records.  Default=all
+            dec=decimation factor.  Default=1
+            mode=reduction over each decimation window - 'stride' (keep first sample), 'mean', or
+                'minmax'.  Default='stride'
+            format='int16' (raw values; float32 for mean) or 'float32' (scaled to physical units).
+                Default='int16'
+            byteorder='little', 'big', or 'native'.  Default='little'
+
+        The response is an array header and the array data (see di4108_decode.unpack_array).  The
+        header also carries the request parameters, the sampling frequency after decimation, the
+        record layout of the shot, and the server-clock time of the segment's first sample
+        (t_start, with t_start_uncertainty).  E.g.
+            <get_seg>{"offset":10000,"length":1000,"chans":[3],"dec":10,"mode":"minmax"}</get_seg>
+        '''
+        args={} if seg_json is None else json.loads(seg_json)
+        offset=int(args.get('offset',0))
+        length=args.get('length')
+        chans=args.get('chans')
+        dec=int(args.get('dec',1))
+        mode=args.get('mode','stride')
+
+        if debugging():
+            LOG.debug("Received get_seg request - %s",args)
+        shot=self.site.last_shot()
+        if shot is None :
+            raise ValueError("No data stored - trigger a pulse first")
+        layout=shot.layout
+
+        chan_data=demux(shot.data,layout['number_records'],offset,None if length is None else int(length),chans)
+        if chans is None :
+            chans=list(range(layout['number_records']))
+        fmt=args.get('format','int16')
+        reduced=reduce_records(chan_data,layout,chans,dec,mode,fmt,args.get('byteorder','little'))
+        (header,array_data)=pack_array(reduced,offset=offset,dec=dec,mode=mode,chans=chans,\
+            fs=layout['fs']/dec,format=fmt,scales=[record_scales(layout)[c] for c in chans],layout=layout,\
+            t_start=None if shot.t_start is None else shot.t_start+offset/layout['fs'],\
+            t_start_uncertainty=shot.t_start_uncertainty)
+        self.reply(header,array_data)
+
+        if debugging():
+            LOG.debug("...sent segment, shape=%s",reduced.shape)
+
     def handle_query_data_length(self) :
         '''
         Send length of last data read (number of bytes) to requester.
         
         T. Golfinopoulos, 12 Sept. 2018
         '''
-        this_port=AcqPorts.SITE0
-        
         if debugging():
-            print("Received query_data_length request...")
-        data_length=len(STORE_DATA.data[this_port])
+            LOG.debug("Received query_data_length request...")
+        shot=self.site.last_shot()
+        if shot is None and os.path.exists(self.data_file_name) :
+            data_length=os.path.getsize(self.data_file_name)
+        elif shot is None :
+            raise ValueError("No data stored - trigger a pulse first")
+        else :
+            data_length=len(shot.data)
         #data_length_bytes=data_length.to_bytes((data_length.bit_length()+7)//8,'big')
         #self.request.sendall(data_length_bytes) #// = integer divide
-        self.request.sendall(bytes(str(data_length),'ascii'))
+        self.reply(bytes(str(data_length),'ascii'))
         
         if debugging():
-            print("...sent data length")
+            LOG.debug("...sent data length")
             
+    def handle_metrics(self):
+        '''
+        On a <metrics> command, send the server's performance counters, as text in the
+        Prometheus exposition format (see di4108_metrics).  The same text is served over HTTP
+        on METRICS_PORT.
+        '''
+        self.reply(REGISTRY.exposition().encode())
+
+    def handle_ping(self):
+        '''
+        On a <ping> command, reply at once with the server's clock (time.time()) on receiving
+        the request and on replying, as JSON {"t_recv":..., "t_send":...}, for clients to
+        estimate the offset of their clocks from it - see di4108_clock.
+        '''
+        t_recv=time.time()
+        self.reply_json({'t_recv':t_recv,'t_send':time.time()})
+
+    def handle_shm(self):
+        '''
+        On a <shm> command, send, as JSON, where processes on this host find the site's data in
+        shared memory (see di4108_shm):
+            shot=descriptor of the last shot shared (for di4108_shm.SharedShot), or None
+            live=name and capacity of the ring of live data (for di4108_shm.ShmRing), and the
+                writer's position in it, or None
+        Shots and live data are shared if the share_shots and share_live settings are set.
+        '''
+        site=self.site
+        shot=None if site.shared_shots is None else site.shared_shots.latest
+        live=None
+        if not site.shared_live is None :
+            live={'name':site.shared_live.name,'capacity':site.shared_live.capacity,'written':site.shared_live.written}
+        self.reply_json({'shot':shot,'live':live})
+
+    def handle_postproc(self,job_json=None):
+        '''
+        On a <postproc> command, reply at once with the state of the post-processing of a job,
+        whose optional JSON dictionary holds job=job id (default=most recent job post-processed):
+            {"job":3,"state":"pending"|"done"|"failed","results":{...},"error":...}
+        results are those of the pipeline (see di4108_postproc), once done.  Post-processing runs
+        on each shot if the postproc setting holds a pipeline, e.g.
+            <init>{"postproc":["calibrate",["decimate",{"dec":10}],"summary"]}</init>
+        '''
+        args={} if job_json is None else json.loads(job_json)
+        (job_id,future)=self.site.postproc_result(None if args.get('job') is None else int(args['job']))
+        reply={'job':job_id,'state':'pending','results':None,'error':None}
+        if future.done() :
+            error=future.exception()
+            if error is None :
+                reply.update({'state':'done','results':future.result()})
+            else :
+                reply.update({'state':'failed','error':repr(error)})
+        self.reply_json(reply)
+
+    def handle_profile(self,args_json=None):
+        '''
+        On a <profile> command, reply with the profile of the acquisition path (see
+        di4108_profile), as JSON.  Its optional JSON dictionary holds
+            format="summary" (default - statistics of each stage) or "trace" (Chrome trace)
+            reset=true to forget the events once sent
+            enable=number of events to keep (at most di4108_profile.MAX_CAPACITY) - start
+                profiling, if not already on
+            disable=true to stop profiling, once the events are sent
+        Profiling is process-wide, covering all sites.  With --reader-process, the device's
+        stages are recorded in the reader processes, so only the server's own appear here.
+        '''
+        args={} if args_json is None else json.loads(args_json)
+        prof=di4108_profile.PROFILER
+        if prof is None :
+            if args.get('enable') is None :
+                raise ValueError("Profiling is off - enable it with enable=number of events, or DI4108_PROFILE")
+            prof=di4108_profile.enable(int(args['enable']))
+        if args.get('format','summary')=='trace' :
+            reply=prof.chrome_trace()
+        else :
+            reply={'capacity':prof.capacity,'events':prof.n_events,'stages':prof.summary()}
+        if args.get('reset') :
+            prof.reset()
+        if args.get('disable') :
+            di4108_profile.disable()
+        self.reply_json(reply)
+
     def handle_get_settings(self):
         '''
         Send current settings as encoded json file to requester.
@@ -385,16 +1334,14 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         T. Golfinopoulos, 12 Sept. 2018
         '''
         if debugging():
-            print("Received get_settings request - about to send current settings as json file...")
+            LOG.debug("Received get_settings request - about to send current settings as json file...")
         
         #current_settings_json_string=self.settings_to_json()
-        f=open(self.settings_file_name,'r') #Read from file
-        current_settings=f.read(ThreadedTCPRequestHandler.max_size)
-        f.close()
-        self.request.sendall(bytes(current_settings_json_string,'ascii'))
+        (version,current_settings)=self.settings_cache.get()
+        self.reply(bytes(current_settings,'ascii'))
         
         if debugging():
-            print("Sent settings\n{}".format(current_settings_json_string))
+            LOG.debug("Sent settings\n%s",current_settings)
     
     def config_from_json_string(self,settings_json):
         '''
@@ -407,15 +1354,10 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         T. Golfinopoulos, 23 Oct. 2018
         '''
         #Parse, and remove any keys that are not keywords of DI4108
-        all_keys=DI4108_WRAPPER.__dict__.keys()
-        setting_keys=[]
-        for k in all_keys :
-            if type(DI4108_WRAPPER.__dict__[k]) is property :
-                setting_keys.append(k)
+        setting_keys=DI4108_SETTING_KEYS
         
         if debugging():
-            print("Setting keys:")
-            print(setting_keys)
+            LOG.debug("Setting keys: %s",setting_keys)
         #Decode transmitted setting
         new_settings=json.loads(settings_json)
         
@@ -429,13 +1371,27 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         if 'n_samps_post' in new_settings.keys() :
             self.n_samps_post=new_settings['n_samps_post']
 
+        if 'persist_shots' in new_settings.keys() :
+            self.persist_shots=bool(new_settings['persist_shots'])
+
+        if 'share_shots' in new_settings.keys() :
+            self.share_shots=bool(new_settings['share_shots'])
+
+        if 'share_live' in new_settings.keys() :
+            self.share_live=bool(new_settings['share_live'])
+
+        if 'postproc' in new_settings.keys() :
+            if not new_settings['postproc'] is None :
+                parse_stages(new_settings['postproc']) #Check pipeline
+            self.postproc=new_settings['postproc']
+
         #Calculate new post-trigger pulse length based on number of samples and sampling frequency
-        self.pulse_duration=self.n_samps_post/ThreadedTCPRequestHandler.my_di4108.fs
+        self.pulse_duration=self.n_samps_post/self.site.device.fs
         if debugging():
-            print("Pulse duration: {} s".format(self.pulse_duration))
+            LOG.debug("Pulse duration: %s s",self.pulse_duration)
 
         if debugging():
-            print("New settings: {}".format(new_settings))
+            LOG.debug("New settings: %s",new_settings)
         
         #Remove settings that are not properties of DI4108
         #Do this with a list of tuples as an intermediate set,
@@ -448,8 +1404,7 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         new_settings=dict(prop_pairs)
         
         if debugging():
-            print("New settings:")
-            print(new_settings)
+            LOG.debug("New settings: %s",new_settings)
         
         return new_settings
 
@@ -457,76 +1412,64 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         '''
         my_server.reinitialize()
         
-        Read json settings file and re-apply settings - for threaded servers, this seems to be necessary.
+        Re-apply settings from the process-wide settings cache if they have changed since this
+        connection last applied them (e.g. after an init on another connection).  This costs
+        one integer comparison when they have not, and never touches the settings file.
         
-        Returns dictionary of settings.
+        Returns dictionary of settings, or None if nothing changed.
         
         T. Golfinopoulos, 23 Oct. 2018
         '''
-        f=open(self.settings_file_name,'r') #Read from file
-        current_settings_json=f.read(ThreadedTCPRequestHandler.max_size)
-        f.close()
+        if self.settings_cache.version==self.settings_version :
+            return None
+        (self.settings_version,current_settings_json)=self.settings_cache.get()
 
         return self.config_from_json_string(current_settings_json)
         
     def handle_init(self,settings_json):
         if debugging():
-            print("Received init request - about to initialize device...")
+            LOG.debug("Received init request - about to initialize device...")
         
         new_settings=self.config_from_json_string(settings_json)
         
-        try :        
-            if ThreadedTCPRequestHandler.my_di4108 is None :
-                #Digitizer object - to implement: multiple digitizer support, singleton
-                ThreadedTCPRequestHandler.my_di4108=DI4108_WRAPPER(**new_settings)
-            else : #Re-initialize device
-                ThreadedTCPRequestHandler.my_di4108.__init__(**new_settings)
+        try :
+            #Queue behind any acquisition in progress, rather than reconfigure the device under it
+            self.site.executor.submit(self.site.configure,**new_settings).result()
         except :
-             print("Can't configure DI4108") 
+             LOG.error("Can't configure DI4108")
              raise
              
-        #Write current settings to file
-        f=open(self.settings_file_name,'w')
-        f.write(self.settings_to_json())
-        f.close()
+        #Publish current settings to other connections, and write to file if changed,
+        #then re-apply them here, so pulse_duration follows the new sampling frequency
+        self.settings_cache.update(self.settings_to_json())
+        self.reinitialize()
         
         if debugging():
-            print("Initialization complete!")
+            LOG.debug("Initialization complete!")
              
     def settings_to_json(self):
-        #all_keys=ThreadedTCPRequestHandler.my_di4108.__dict__.keys() #DI4108_WRAPPER.__dict__.keys()
-        all_keys=DI4108_WRAPPER.__dict__.keys()
         if debugging():
-            print("All keys:")
-            print(all_keys)
-            print("Instance keys")
-            print(ThreadedTCPRequestHandler.my_di4108.__dict__.keys())
+            LOG.debug("Setting keys: %s",DI4108_SETTING_KEYS)
+            LOG.debug("Instance keys: %s",list(self.site.device.__dict__.keys()))
         settings={}
-        for k in all_keys :
-            #if type(ThreadedTCPRequestHandler.my_di4108.__dict__[k]) is property :
-            if type(DI4108_WRAPPER.__dict__[k]) is property :
-                settings[k]=ThreadedTCPRequestHandler.my_di4108.__dict__['_'+k]
+        device=self.site.device
+        for k in DI4108_SETTING_KEYS :
+            settings[k]=device.__dict__['_'+k]
         
         #Add settings that are not part of di4108 object
         #Add these settings to di4108 object
         settings['store_mode']=self.store_mode
         settings['n_samps_pre']=self.n_samps_pre
         settings['n_samps_post']=self.n_samps_post
+        settings['persist_shots']=self.persist_shots
+        settings['share_shots']=self.share_shots
+        settings['share_live']=self.share_live
+        settings['postproc']=self.postproc
         
         if debugging():
-            print("Settings:")
-            print(settings)
+            LOG.debug("Settings: %s",settings)
         return json.dumps(settings,sort_keys=True)
         
-    def serve_forever(self,*argv,**kwargs):
-        print("Serving")
-        #Default configuration regarding whether to store data in one complete pulse, or to stream data as it comes
-        self._n_samps_pre=0
-        self._n_sampes_post=10000
-        self._store_mode='pulse'
-        self.parser = MyHTMLParser()
-        super().serve_forever(*argv,**kwargs)
-    
     @property
     def  n_samps_pre(self):
         return self._n_samps_pre
@@ -551,9 +1494,102 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
     def store_mode(self,store_mode):
         self._store_mode=store_mode
 
+class ThreadedTCPRequestHandler(DI4108Commands,socketserver.StreamRequestHandler):
+
+    def __init__(self,request,client_address,server):
+        self.init_commands(server.server_address[1],client_address[0]) #Site is given by the port the client connected to
+        
+        #This really has to be the last thing in the __init__ method of the subclass; it seems to
+        #run handle on its own.  And so any initializations have to be applied before this.
+        super(ThreadedTCPRequestHandler,self).__init__(request,client_address,server)
+        
+    disable_nagle_algorithm=True #Small pipelined replies should not wait on Nagle
+
+    def handle(self):
+        '''
+        Serve one connection.  The first byte selects the protocol: the framed protocol of
+        di4108_protocol if it is NEGOTIATE, else the legacy <tag>content</tag> grammar.
+        Legacy connections carry a single request; framed connections stay open for any
+        number of requests.
+        '''
+        self.framed=self.rfile.peek(1)[:1]==NEGOTIATE
+        try :
+            if self.framed :
+                self.rfile.read(1) #Consume negotiation byte
+                self.request.sendall(bytes([PROTOCOL_VERSION]))
+                #Persistent connection - process requests in order until the client closes.
+                #Clients may pipeline several requests without waiting for replies; each
+                #reply carries the request id of the request it answers.
+                while self.handle_frame() :
+                    pass
+            else :
+                self.handle_legacy()
+        finally :
+            #Return data for debugging purposes
+            if debugging():
+                LOG.debug('Done - ready to send shutdown message')
+            try :
+                self.request.shutdown(socket.SHUT_RDWR)
+            except OSError :
+                pass #Peer may already have gone away
+            self.request.close()
+            if debugging():    
+                LOG.debug('Done handling request')
+
+    def handle_frame(self):
+        '''
+        Read and dispatch one framed request.  Returns False when the peer has closed the connection.
+
+        Decoding is a fixed-size header unpack and a dictionary lookup on the opcode; the body is
+        read in full according to the length in the header, up to MAX_REQUEST_BODY bytes.
+        '''
+        header=self.rfile.read(HEADER.size)
+        if len(header)<HEADER.size :
+            return False
+        (opcode,flags,request_id,length)=decode_header(header)
+        if not self.check_frame(opcode,request_id,length) :
+            return False
+        body=self.rfile.read(length)
+        if len(body)<length :
+            raise ProtocolError("Connection closed after {} of {} body bytes".format(len(body),length))
+        self.dispatch_frame(opcode,request_id,body)
+        return True
+
+    def handle_legacy(self):
+        '''
+        Read and dispatch a request in the legacy tag grammar, e.g. <init>{"fs":1000}</init><trig_pulse>
+        '''
+        #Use recv - a single read, as in the original protocol
+        data = str(self.rfile.read1(DI4108Commands.buffer_size), 'ascii')
+        self.dispatch_legacy(data)
+
+    def send_raw(self,payload):
+        self.request.sendall(payload)
+        self.count_sent(memoryview(payload).nbytes)
+
+    def send_file(self,f):
+        try :
+            self.count_sent(self.request.sendfile(f))
+        finally :
+            f.close()
+
+    def send_iter(self,pieces):
+        for p in pieces :
+            self.send_raw(p)
+    
+    def serve_forever(self,*argv,**kwargs):
+        LOG.info("Serving on port %s",self.server_address[1])
+        #Default configuration regarding whether to store data in one complete pulse, or to stream data as it comes
+        self._n_samps_pre=0
+        self._n_sampes_post=10000
+        self._store_mode='pulse'
+        self.parser = MyHTMLParser()
+        super().serve_forever(*argv,**kwargs)
+
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads=True #Persistent client connections must not keep the process alive
     def serve_forever(self,*argv,**kwargs):
-        print("Serving")
+        LOG.info("Serving on port %s",self.server_address[1])
         #super().serve_forever(*argv,**kwargs)
         super(ThreadedTCPServer,self).serve_forever(*argv,**kwargs)
     #pass
@@ -561,24 +1597,46 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 if __name__ == "__main__":
     # Use SITE0 Port - this appears to be the main port for the acq400 class devices for i/o
     #HOST, PORT = "198.125.177.3", AcqPorts.SITE0
-    HOST, PORT = "localhost", AcqPorts.SITE0
-    
-    host_addr=(HOST,PORT)
+    #One site per DI-4108 - give sites on the command line as port or port:serial_number
+    #e.g. python3 di4108_server.py 4220:5A3B1C2D 4221:5A3B1C3E
+    #Add --reader-process to read each device in a process of its own, clear of the server's threads,
+    #and --simulate to serve simulated devices
+    HOST = "localhost"
     ThreadedTCPServer.allow_reuse_address = True
-    server = ThreadedTCPServer(host_addr, ThreadedTCPRequestHandler)
-    ip, port = server.server_address
+    di4108_log.configure()
     
-    print("IP: {}".format(ip))
-    print("PORT: {}".format(port))
-
-    # Start a thread with the server -- that thread will then start one
-    # more thread for each request
-    server_thread = threading.Thread(target=server.serve_forever)
-    # Exit the server thread when the main thread terminates
-    #server_thread.daemon = True
-    print("Ready to start")
-    server_thread.start()
-    print("DI4108 server loop running in thread:", server_thread.name)
+    server_threads=[]
+    for site in parse_sites(sys.argv[1:]) :
+        host_addr=(HOST,site.port)
+        server = ThreadedTCPServer(host_addr, ThreadedTCPRequestHandler)
+        ip, port = server.server_address
+        
+        print("IP: {}".format(ip))
+        print("PORT: {}".format(port))
+
+        # Start a thread with the server -- that thread will then start one
+        # more thread for each request
+        server_thread = threading.Thread(target=server.serve_forever)
+        # Exit the server thread when the main thread terminates
+        #server_thread.daemon = True
+        print("Ready to start")
+        server_thread.start()
+        server_threads.append(server_thread)
+        print("DI4108 server loop running in thread:", server_thread.name)
+
+        #Live data streaming and state broadcast services
+        start_site_services(HOST,site)
+
+    #Performance counters, for all sites
+    metrics_server=MetricsHTTPServer((HOST,METRICS_PORT))
+    threading.Thread(target=metrics_server.serve_forever,daemon=True).start()
+    print("DI4108 metrics on http://{}:{}/metrics".format(HOST,METRICS_PORT))
+
+    #Keep the main thread alive while the servers run: once it ends, the interpreter starts
+    #shutting down, and the sites' executors refuse new work ("cannot schedule new futures
+    #after interpreter shutdown"), failing every init and trigger
+    for server_thread in server_threads :
+        server_thread.join()
 
     #server.shutdown()
     #server.server_close()
@@ -0,0 +1,253 @@
+'''
+Shared-memory handoff of DI-4108 data to other processes on the same host - e.g. analysis or
+plotting on the Pi itself - without copying it through the kernel as a TCP store does.
+
+Two structures, each in multiprocessing.shared_memory segments that readers attach to by
+name:
+
+    ShmShotStore - the server's last few completed shots, one segment per slot.  Each shot is
+        described by a small dictionary (segment name, sequence number, length, and the
+        shot's layout and times), which the server hands out with its shm command.  Readers
+        map the shot with SharedShot, without copying.
+    ShmRing - a ring of bytes, written by one process and read by any number of others, each
+        at its own position - for live data as it is read from the device.
+
+A slot or ring is overwritten as new data arrive; readers check afterwards that what they
+read was not overwritten under them (SharedShot.valid, and ShmOverrun from ShmRing.read).
+
+USAGE:
+    shot=SharedShot(desc) #desc from the server's shm command
+    samples=shot.array() #Interleaved raw samples, one row per sample, without copying
+    ...use samples...
+    ok=shot.valid() #False if the server has since reused the slot
+    del samples
+    shot.close()
+'''
+import os
+import struct
+import itertools
+import threading
+import numpy
+from multiprocessing import shared_memory, resource_tracker
+
+TRACKER_LOCK=threading.Lock() #Held while attach bypasses the resource tracker
+
+def create_segment(name,size):
+    '''
+    Create a shared-memory segment, owned by this process.
+    '''
+    with TRACKER_LOCK :
+        return shared_memory.SharedMemory(name=name,create=True,size=size)
+
+def attach(name):
+    '''
+    Attach to an existing shared-memory segment, without taking ownership of it: it is not
+    unlinked when this process exits.
+    '''
+    try :
+        return shared_memory.SharedMemory(name=name,track=False)
+    except TypeError :
+        pass
+    #Before Python 3.13, every attachment is registered with the resource tracker, which
+    #unlinks it at exit.  Unregistering afterwards is no cure - the tracker may be shared with
+    #the owner (e.g. by pool workers), and would forget the owner's registration - so don't
+    #register at all.
+    with TRACKER_LOCK :
+        register=resource_tracker.register
+        resource_tracker.register=lambda name,rtype : None
+        try :
+            return shared_memory.SharedMemory(name=name)
+        finally :
+            resource_tracker.register=register
+
+class ShmOverrun(IOError):
+    '''
+    Raised when a reader of a ShmRing falls more than the ring's capacity behind the writer.
+    '''
+    pass
+
+RING_HEADER=struct.Struct('<QQ') #Capacity, total bytes ever written
+
+class ShmRing:
+    '''
+    Ring of bytes in shared memory, with one writer.  Positions count bytes written since the
+    ring was created, so a reader keeps its own position and knows, from the writer's, both
+    how much is waiting and whether it has been overwritten.
+
+    USAGE:
+        ring=ShmRing(capacity=16*1024*1024) #Writer - creates the segment
+        (position,length)=ring.write(chunk)
+
+        ring=ShmRing(name,create=False) #Reader, in another process
+        (data,position)=ring.read(position)
+    '''
+    def __init__(self,name=None,capacity=16*1024*1024,create=True):
+        if create :
+            self.shm=create_segment(name,RING_HEADER.size+capacity)
+            RING_HEADER.pack_into(self.shm.buf,0,capacity,0)
+        else :
+            self.shm=attach(name)
+            capacity=RING_HEADER.unpack_from(self.shm.buf,0)[0]
+        self.owner=create
+        self.capacity=capacity
+        self.data=self.shm.buf[RING_HEADER.size:RING_HEADER.size+capacity]
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def written(self):
+        '''
+        Position of the writer: total bytes written.
+        '''
+        return RING_HEADER.unpack_from(self.shm.buf,0)[1]
+
+    def write(self,chunk):
+        '''
+        Append chunk (a bytes-like object no longer than the capacity).  Returns (position,
+        length) of the chunk in the ring.
+        '''
+        view=memoryview(chunk).cast('B')
+        n=len(view)
+        if n>self.capacity :
+            raise ValueError("Chunk of {} bytes is larger than the ring, {} bytes".format(n,self.capacity))
+        position=self.written
+        i=position%self.capacity
+        first=min(n,self.capacity-i)
+        self.data[i:i+first]=view[:first]
+        self.data[:n-first]=view[first:]
+        #Publish only once the bytes are in place
+        struct.pack_into('<Q',self.shm.buf,8,position+n)
+        return (position,n)
+
+    def read_into(self,position,out):
+        '''
+        Copy the bytes from position into the writable buffer, out, which they must fill.
+        Raises ShmOverrun if they have been overwritten, or ValueError if not all written yet.
+        '''
+        view=memoryview(out).cast('B')
+        n=len(view)
+        if position+n>self.written :
+            raise ValueError("Bytes {} to {} not written yet - writer is at {}".format(position,position+n,self.written))
+        i=position%self.capacity
+        first=min(n,self.capacity-i)
+        view[:first]=self.data[i:i+first]
+        view[first:]=self.data[:n-first]
+        #Check after copying, since the writer may have lapped the reader during the copy
+        written=self.written
+        if written-position>self.capacity :
+            raise ShmOverrun("Reader at {} overrun - writer at {}, ring holds {} bytes".format(position,written,self.capacity))
+        return view
+
+    def read(self,position,n=None):
+        '''
+        Return (data, next position): a copy of the n bytes from position (default=all
+        written since it).
+        '''
+        if n is None :
+            n=self.written-position
+        data=bytearray(n)
+        self.read_into(position,data)
+        return (data,position+n)
+
+    def close(self):
+        '''
+        Detach, and, for the writer, remove the segment.
+        '''
+        self.data.release()
+        self.shm.close()
+        if self.owner :
+            self.shm.unlink()
+
+SLOT_HEADER=struct.Struct('<QQ') #Sequence number of the shot in the slot (0 while it is written), length
+
+class ShmShotStore:
+    '''
+    The last n_slots shots of one site, in shared memory, for readers on the same host.  A
+    slot's segment is reused for later shots while they fit, and replaced by a larger one when
+    they do not.
+
+    USAGE:
+        store=ShmShotStore('di4108_4220')
+        desc=store.publish(shot.data,layout=shot.layout,job=shot.job_id)
+    '''
+    def __init__(self,prefix,n_slots=2):
+        self.prefix='{}_{}'.format(prefix,os.getpid()) #Segment names must not collide with those of a previous run
+        self.slots=[None]*n_slots
+        self.seq=0
+        self.generation=itertools.count()
+        self.latest=None
+        self.lock=threading.Lock()
+
+    def publish(self,data,**meta):
+        '''
+        Copy data (a bytes-like object) into the next slot, and return its descriptor: meta,
+        plus name (of the segment), offset and length (of the data in it), and seq (sequence
+        number of the shot).
+        '''
+        view=memoryview(data).cast('B')
+        n=len(view)
+        with self.lock :
+            self.seq+=1
+            i=self.seq%len(self.slots)
+            shm=self.slots[i]
+            if shm is None or shm.size<SLOT_HEADER.size+n :
+                if not shm is None :
+                    shm.close()
+                    shm.unlink() #Readers still attached keep their mapping
+                shm=create_segment('{}_{}'.format(self.prefix,next(self.generation)),SLOT_HEADER.size+max(n,1))
+                self.slots[i]=shm
+            SLOT_HEADER.pack_into(shm.buf,0,0,n)
+            shm.buf[SLOT_HEADER.size:SLOT_HEADER.size+n]=view
+            SLOT_HEADER.pack_into(shm.buf,0,self.seq,n)
+            desc=dict(meta)
+            desc.update({'name':shm.name,'offset':SLOT_HEADER.size,'length':n,'seq':self.seq})
+            self.latest=desc
+            return desc
+
+    def close(self):
+        with self.lock :
+            for shm in self.slots :
+                if not shm is None :
+                    shm.close()
+                    shm.unlink()
+            self.slots=[None]*len(self.slots)
+            self.latest=None
+
+class SharedShot:
+    '''
+    A shot in a ShmShotStore, attached from its descriptor.  See module documentation.
+    '''
+    def __init__(self,desc):
+        self.desc=desc
+        self.shm=attach(desc['name'])
+
+    @property
+    def data(self):
+        '''
+        memoryview of the shot's raw bytes, in shared memory.
+        '''
+        return self.shm.buf[self.desc['offset']:self.desc['offset']+self.desc['length']]
+
+    def valid(self):
+        '''
+        Whether the slot still holds this shot, i.e. what was read from it is the shot.
+        '''
+        return SLOT_HEADER.unpack_from(self.shm.buf,0)[0]==self.desc['seq']
+
+    def array(self):
+        '''
+        Map the raw data as int16 samples, one row per sample, one column per record, without
+        copying.  Use di4108_decode to demultiplex or convert it.
+        '''
+        n_records=self.desc['layout']['number_records']
+        samples=numpy.frombuffer(self.shm.buf,dtype='<i2',count=self.desc['length']//2,offset=self.desc['offset'])
+        n_samps=len(samples)//n_records
+        return samples[:n_samps*n_records].reshape(n_samps,n_records)
+
+    def close(self):
+        '''
+        Detach.  Arrays and views of the shot must be deleted first.
+        '''
+        self.shm.close()
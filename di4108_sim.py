@@ -0,0 +1,306 @@
+'''
+Simulated DATAQ DI-4108, standing in for the USB device so that DI4108_WRAPPER, the servers
+and clients can be run and benchmarked without hardware.  The simulated device has the parts
+of a pyusb device DI4108_WRAPPER uses - a configuration, whose interface holds an out and an
+in endpoint (also its ep_out and ep_in) - and speaks the part of the device's ASCII protocol
+the wrapper uses:
+
+    info n - replies 'info n <value>' (info 0 replies 'info 0 DATAQ')
+    slist i code - sets record i of the scan list: an analog channel (code&0xF<8, voltage
+        range code<<8), digital inputs (8), rate on D2 (9, range code<<8) or counter on D3 (10)
+    srate n, dec n - sampling frequency is 60 MHz/(srate*dec)
+    ps n - packet size is 2**(n+4) bytes
+    filter, ffl - accepted, but not modelled: each sample is the waveform's value at its time
+    led n - sets led
+    start 0, stop - start and stop scanning
+
+Commands other than start are echoed, terminated by a carriage return, as the device does;
+scanning discards any echoes not yet read.  Once started, ep_in.read returns interleaved
+little-endian int16 frames in whole packets - at the configured rate, as they would be
+sampled (realtime=True), or as fast as they are asked for.  A read with nothing to return
+raises a timeout at once, rather than after the read's timeout.
+
+Each sample holds, in scan list order:
+    analog channels - waveform of the channel, in volts, scaled by the channel's range
+    digital inputs - digital_bits, with D6 (bit 6, as the trigger input) high from each time
+        in trigger_times [s after start] for trigger_width [s]; the inputs are in the upper
+        byte, as the device sends them
+    rate - rate [Hz], a number or function of time, scaled by the rate range
+    counter - number of counter_rate [Hz] edges counted since start, modulo 2**16
+
+Waveforms are given per channel, each as a function of time [s, numpy array] returning volts,
+or as (shape, {parameters}), with shape one of
+    'sine' - amplitude, freq, phase, offset
+    'square' - amplitude, freq, duty, offset
+    'ramp' - amplitude, freq, offset (sawtooth from -amplitude to amplitude)
+    'noise' - amplitude (standard deviation), offset
+    'dc' - offset
+By default, channel c is a 1 V sine at 100*(c+1) Hz.
+
+Faults may be injected:
+    misalign_at - byte offset in the data stream at which misalign_bytes bytes (default=1) are
+        lost in transfer: the read holding them comes back short, and every later record is
+        misread
+    overflow_at - time [s after start] at which the device's buffer overflows, losing
+        overflow_samples samples (default=buffer_samples)
+In realtime, the buffer also overflows if samples are left unread for longer than it holds -
+buffer_samples samples (default=whatever fills 64 kB) - losing the oldest.  Lost samples are
+counted in overflows.  Each overflow is reported as the device reports it, by STOP_MESSAGE in
+place of the data of one read; the simulated device then carries on scanning, so the rest of
+the pulse is still read.
+
+Rate and counter records are encoded as the device sends them (see its protocol, pages 15-16):
+two's complement counts, with rate=rate range*(counts+32768)/65536 and counter=counts+32768.
+
+USAGE:
+    from digitizer_models import DI4108_WRAPPER
+    device=DI4108_WRAPPER(fs=10000,chans=4,dev=SimulatedDI4108(waveforms={0:('square',{'freq':50})}))
+    (data,elapsed_time,raw_data)=device.trig_data_pulse(0.5)
+'''
+import time
+import array
+import collections
+from math import floor
+import numpy
+
+STOP_MESSAGE=b'stop 01\r' #Sent by the device, in place of data, when its buffer overflows
+
+RATE_RANGES=[50E3,20E3,10E3,5E3,2E3,1E3,500,200,100,50,20,10] #Rate range by code-1 - see DI4108_WRAPPER.process_rate_range
+V_RANGES=[10,5,2,1,0.5,0.2] #Voltage range by code - see DI4108_WRAPPER.process_v_range
+
+try :
+    from usb.core import USBTimeoutError as ReadTimeout #As pyusb raises when a read times out
+except ImportError :
+    ReadTimeout=IOError
+
+def waveform_function(spec):
+    '''
+    Return a function of time (numpy array, [s]) returning volts, for a waveform given as a
+    function, a number (constant), or (shape, {parameters}) - see module documentation.
+    '''
+    if callable(spec) :
+        return spec
+    if isinstance(spec,(int,float)) :
+        return lambda t : numpy.full(len(t),float(spec))
+    (shape,params)=(spec[0],dict(spec[1]) if len(spec)>1 else {})
+    amplitude=params.get('amplitude',1.0)
+    freq=params.get('freq',100.0)
+    offset=params.get('offset',0.0)
+    if shape=='sine' :
+        phase=params.get('phase',0.0)
+        return lambda t : offset+amplitude*numpy.sin(2*numpy.pi*freq*t+phase)
+    if shape=='square' :
+        duty=params.get('duty',0.5)
+        return lambda t : offset+numpy.where((t*freq)%1.0<duty,amplitude,-amplitude)
+    if shape=='ramp' :
+        return lambda t : offset+amplitude*(2.0*((t*freq)%1.0)-1.0)
+    if shape=='noise' :
+        rng=numpy.random.default_rng(params.get('seed'))
+        return lambda t : offset+amplitude*rng.standard_normal(len(t))
+    if shape=='dc' :
+        return lambda t : numpy.full(len(t),float(offset))
+    raise ValueError("Unknown waveform shape {} - shapes are sine, square, ramp, noise and dc".format(shape))
+
+class SimulatedEndpointOut:
+    def __init__(self,device):
+        self.device=device
+        self.bEndpointAddress=0x01
+
+    def write(self,data,timeout=None):
+        command=data if isinstance(data,str) else bytes(data).decode()
+        self.device.command(command)
+        return len(data)
+
+class SimulatedEndpointIn:
+    def __init__(self,device):
+        self.device=device
+        self.bEndpointAddress=0x81
+
+    def read(self,size_or_buffer,timeout=None):
+        return self.device.read(size_or_buffer if isinstance(size_or_buffer,int) else len(size_or_buffer))
+
+class SimulatedInterface(list):
+    '''
+    Configuration and interface of a SimulatedDI4108: indexed by (interface, alternate
+    setting), and iterated over for endpoints, as by usb.util.find_descriptor.
+    '''
+    def __getitem__(self,index):
+        if isinstance(index,tuple) :
+            return self
+        return list.__getitem__(self,index)
+
+class SimulatedDI4108:
+    '''
+    Simulated DI-4108 - see module documentation.
+    '''
+    def __init__(self,waveforms=None,realtime=True,trigger_times=(),trigger_width=1E-3,digital_bits=0,\
+        rate=1000.0,counter_rate=1000.0,buffer_samples=None,misalign_at=None,misalign_bytes=1,\
+        overflow_at=None,overflow_samples=None,serial_number='SIM4108'):
+        self.waveforms=dict([(c,waveform_function(('sine',{'freq':100.0*(c+1)}))) for c in range(8)])
+        if not waveforms is None :
+            for (c,spec) in waveforms.items() :
+                self.waveforms[int(c)]=waveform_function(spec)
+        self.realtime=realtime
+        self.trigger_times=list(trigger_times)
+        self.trigger_width=trigger_width
+        self.digital_bits=digital_bits
+        self.rate=rate
+        self.counter_rate=counter_rate
+        self.buffer_samples=buffer_samples
+        self.misalign_at=misalign_at
+        self.misalign_bytes=misalign_bytes
+        self.overflow_at=overflow_at
+        self.overflow_samples=overflow_samples
+        self.serial_number=serial_number
+        self.ep_out=SimulatedEndpointOut(self)
+        self.ep_in=SimulatedEndpointIn(self)
+        self.interface=SimulatedInterface([self.ep_out,self.ep_in])
+        self.slist={}
+        self.srate=60000 #Device defaults - 1 kHz
+        self.dec=1
+        self.packet_size=512
+        self.led=None
+        self.running=False
+        self.replies=bytearray()
+        self.commands=collections.deque(maxlen=1000) #Commands received, most recent last
+        self.overflows=0
+
+    def set_configuration(self):
+        pass
+
+    def get_active_configuration(self):
+        return self.interface
+
+    def command(self,command):
+        '''
+        Act on one ASCII command - see module documentation.
+        '''
+        self.commands.append(command)
+        words=command.strip().split()
+        if len(words)==0 :
+            return
+        (name,args)=(words[0],words[1:])
+        if name=='info' :
+            n=int(args[0]) if args else 0
+            value={0:'DATAQ',1:'4108',6:self.serial_number}.get(n,'0')
+            self.replies+='info {} {}\r'.format(n,value).encode()
+            return
+        if name=='start' :
+            self.start()
+            return
+        if name=='stop' :
+            self.running=False
+        elif name=='slist' :
+            if int(args[0])==0 :
+                self.slist={} #A new scan list - DI4108_WRAPPER always writes it from record 0
+            self.slist[int(args[0])]=int(args[1])
+        elif name=='srate' :
+            self.srate=int(args[0])
+        elif name=='dec' :
+            self.dec=int(args[0])
+        elif name=='ps' :
+            self.packet_size=2**(int(args[0])+4)
+        elif name=='led' :
+            self.led=int(args[0])
+        self.replies+=(command+'\r').encode()
+
+    @property
+    def fs(self):
+        return 60.0E6/(self.srate*self.dec)
+
+    @property
+    def scan_list(self):
+        return [self.slist[i] for i in sorted(self.slist.keys())]
+
+    def start(self):
+        self.running=True
+        self.replies=bytearray()
+        self.t0=time.time()
+        self.n_produced=0 #Samples generated since start, including any lost
+        self.n_bytes=0 #Bytes of the data stream read since start, before faults
+        self.pending=bytearray()
+        self.frame_bytes=2*max(len(self.slist),1)
+        if self.buffer_samples is None :
+            self.capacity=max(1,65536//self.frame_bytes)
+        else :
+            self.capacity=self.buffer_samples
+        self.overflowed=False
+
+    def frames(self,first,n):
+        '''
+        Return the raw bytes of samples first to first+n after start.
+        '''
+        t=(first+numpy.arange(n))/self.fs
+        scan_list=self.scan_list
+        out=numpy.empty((n,len(scan_list)),dtype='<i2')
+        for (j,code) in enumerate(scan_list) :
+            kind=code&0xFF
+            if kind<8 :
+                v_range=V_RANGES[(code>>8)&0xF]
+                volts=self.waveforms[kind](t)
+                out[:,j]=numpy.clip(numpy.round(volts/v_range*32768.0),-32768,32767)
+            elif kind==8 :
+                bits=numpy.full(n,self.digital_bits&0x7F,dtype=numpy.int32)
+                for t_trig in self.trigger_times :
+                    bits[(t>=t_trig)&(t<t_trig+self.trigger_width)]|=0b01000000
+                out[:,j]=bits<<8
+            elif kind==9 :
+                rate_range=RATE_RANGES[((code>>8)&0xF)-1]
+                rate=self.rate(t) if callable(self.rate) else numpy.full(n,float(self.rate))
+                out[:,j]=numpy.clip(numpy.round(rate/rate_range*65536.0-32768.0),-32768,32767)
+            elif kind==10 :
+                counts=numpy.floor(t*self.counter_rate).astype(numpy.int64)
+                out[:,j]=((counts&0xFFFF)-32768).astype(numpy.int16)
+            else :
+                raise ValueError("Unknown scan list code {}".format(code))
+        return out.tobytes()
+
+    def generate(self,n):
+        '''
+        Append the next n samples to the bytes waiting to be read.
+        '''
+        self.pending+=self.frames(self.n_produced,n)
+        self.n_produced+=n
+
+    def read(self,size):
+        if not self.running :
+            if len(self.replies)==0 :
+                raise ReadTimeout("Simulated read timed out - nothing to read")
+            out=self.replies[:size]
+            del self.replies[:size]
+            return array.array('B',out)
+        n_packets=max(1,size//self.packet_size)
+        if self.realtime :
+            #Wait for at least one packet's worth of samples
+            while True :
+                due=int(floor((time.time()-self.t0)*self.fs))
+                waiting=len(self.pending)+(due-self.n_produced)*self.frame_bytes
+                if waiting>=self.packet_size :
+                    break
+                time.sleep((self.packet_size-waiting)/(self.frame_bytes*self.fs))
+            if due-self.n_produced>self.capacity :
+                #Samples left unread beyond the buffer are lost
+                lost=due-self.n_produced-self.capacity
+                self.n_produced+=lost
+                self.overflows+=lost
+                return array.array('B',STOP_MESSAGE)
+            n_bytes=min(n_packets*self.packet_size,len(self.pending)+(due-self.n_produced)*self.frame_bytes)
+            n_bytes-=n_bytes%self.packet_size
+        else :
+            n_bytes=n_packets*self.packet_size
+        if not self.overflow_at is None and not self.overflowed and self.n_produced>=self.overflow_at*self.fs :
+            lost=self.capacity if self.overflow_samples is None else self.overflow_samples
+            self.n_produced+=lost
+            self.overflows+=lost
+            self.overflowed=True
+            return array.array('B',STOP_MESSAGE)
+        short=n_bytes-len(self.pending)
+        if short>0 :
+            self.generate(-(-short//self.frame_bytes))
+        out=self.pending[:n_bytes]
+        del self.pending[:n_bytes]
+        if not self.misalign_at is None and self.n_bytes<=self.misalign_at<self.n_bytes+n_bytes :
+            i=self.misalign_at-self.n_bytes
+            del out[i:i+self.misalign_bytes]
+        self.n_bytes+=n_bytes
+        return array.array('B',out)
@@ -0,0 +1,388 @@
+'''
+Live data streaming service for the DI-4108 server, on AcqPorts.STREAM.
+
+The acquisition loop publishes each raw chunk it reads from the device into a single shared
+DataRing.  Every subscriber reads from that ring through its own cursor, so adding subscribers
+costs no extra device reads and no copies of the data.  Each subscriber's queue is the window
+between its cursor and the newest chunk, bounded by max_backlog; when a slow consumer falls
+further behind than that, its policy decides what happens:
+
+    'drop'       - skip the oldest chunks in the backlog, keeping the newest max_backlog
+    'decimate'   - send only every n-th chunk of the backlog, so the consumer sees the whole
+                   time span at reduced density
+    'disconnect' - close the subscriber's connection
+
+A client subscribes by connecting, sending NEGOTIATE, and sending an OP.SUBSCRIBE frame whose
+optional JSON body holds {"policy":...,"max_backlog":...}.  Data then arrive as OP.STREAM_DATA
+frames whose request id is the chunk sequence number (gaps reveal dropped chunks); an empty
+frame marks the end of a shot.  A client that sends nothing on connecting instead receives the
+bare data bytes, in the manner of acq400 streaming ports, under the default policy.
+
+The same ring and subscriber machinery carries the state broadcast on AcqPorts.TSTAT, where
+each chunk is an acq400 status line - see StatusRequestHandler.
+
+Both services are served either by StreamTCPServer, a thread per subscriber, or on an asyncio
+event loop (see serve_subscriber and serve_status), a task per subscriber, woken by the ring's
+RingNotifier for that loop.
+'''
+import json
+import socket
+import asyncio
+import socketserver
+import threading
+import weakref
+from math import ceil
+from di4108_protocol import NEGOTIATE, PROTOCOL_VERSION, HEADER, OP, FLAG_ERROR, \
+    encode_header, decode_header, decode_body, check_request_length
+
+POLICIES=('drop','decimate','disconnect')
+
+class DataRing:
+    '''
+    Fixed-capacity ring of the most recent data chunks, each tagged with a sequence number.
+    Chunks are stored by reference, and must not be modified after publishing.
+
+    USAGE:
+        ring=DataRing(capacity=256)
+        ring.publish(chunk) #Producer
+        head=ring.wait(cursor,timeout) #Consumers
+        chunks=ring.take(cursor,head)
+    '''
+    def __init__(self,capacity=256):
+        self.capacity=capacity
+        self.chunks=[None]*capacity
+        self.head=0 #Sequence number of next chunk to be published
+        self.cond=threading.Condition()
+        self.subscribers=weakref.WeakSet() #Live subscribers, for monitoring
+        self.notifiers={} #RingNotifier of each event loop with subscribers, by loop
+
+    def publish(self,chunk):
+        with self.cond :
+            self.chunks[self.head%self.capacity]=chunk
+            self.head+=1
+            self.cond.notify_all()
+            for notifier in self.notifiers.values() :
+                notifier.notify()
+
+    def notifier(self,loop):
+        '''
+        Return the RingNotifier waking the subscribers of this ring on event loop, loop.
+        '''
+        with self.cond :
+            if not loop in self.notifiers :
+                self.notifiers[loop]=RingNotifier(self,loop)
+            return self.notifiers[loop]
+
+    def mark_end(self):
+        '''
+        Publish an empty chunk, marking the end of a shot.
+        '''
+        self.publish(b'')
+
+    def oldest(self):
+        '''
+        Sequence number of the oldest chunk still held.
+        '''
+        return max(0,self.head-self.capacity)
+
+    def wait(self,cursor,timeout=None):
+        '''
+        Block until a chunk with sequence number >= cursor is available, or timeout elapses.
+        Returns the current head.
+        '''
+        with self.cond :
+            self.cond.wait_for(lambda : self.head>cursor,timeout)
+            return self.head
+
+    def backlogs(self):
+        '''
+        Return list of (backlog in chunks, chunks dropped) of each live subscriber.
+        '''
+        with self.cond :
+            return [(self.head-s.cursor,s.dropped) for s in self.subscribers]
+
+    def take(self,start,stop,stride=1):
+        '''
+        Return list of (sequence number, chunk) for start<=sequence number<stop, limited to the
+        chunks still held.  With stride>1, only every stride-th chunk counting back from the
+        newest is returned, plus any end-of-shot markers.
+        '''
+        with self.cond :
+            start=max(start,self.oldest())
+            stop=min(stop,self.head)
+            return [(seq,self.chunks[seq%self.capacity]) for seq in range(start,stop) \
+                if (stop-1-seq)%stride==0 or len(self.chunks[seq%self.capacity])==0]
+
+class RingNotifier:
+    '''
+    Wakes the tasks of one event loop waiting on a DataRing, from the thread publishing into
+    it - one wake-up of the loop per burst of chunks, however many subscribers are waiting.
+    '''
+    def __init__(self,ring,loop):
+        self.ring=ring
+        self.loop=loop
+        self.published=loop.create_future() #Resolved, and replaced, once chunks are published
+        self.pending=False #Whether a wake-up is already scheduled
+
+    def notify(self):
+        '''
+        Schedule a wake-up of the loop's waiters - called by DataRing.publish, on any thread.
+        '''
+        if not self.pending :
+            self.pending=True
+            try :
+                self.loop.call_soon_threadsafe(self.wake)
+            except RuntimeError :
+                pass #Loop closed - no one left to wake
+
+    def wake(self):
+        self.pending=False
+        (published,self.published)=(self.published,self.loop.create_future())
+        published.set_result(None)
+
+    async def wait(self,cursor,timeout=None):
+        '''
+        Wait until a chunk with sequence number >= cursor is available, or timeout elapses.
+        Returns the current head.
+        '''
+        published=self.published
+        if self.ring.head<=cursor :
+            try :
+                await asyncio.wait_for(asyncio.shield(published),timeout)
+            except asyncio.TimeoutError :
+                pass
+        return self.ring.head
+
+class Subscriber:
+    '''
+    A consumer's cursor into a DataRing, with a bounded backlog and a slow-consumer policy.
+    '''
+    def __init__(self,ring,policy='drop',max_backlog=None):
+        if max_backlog is None :
+            max_backlog=min(64,ring.capacity)
+        if not policy in POLICIES :
+            raise ValueError("policy must be one of {} - you entered {}".format(POLICIES,policy))
+        if max_backlog<1 or max_backlog>ring.capacity :
+            raise ValueError("max_backlog must be between 1 and the ring capacity, {} - you entered {}".format(ring.capacity,max_backlog))
+        self.ring=ring
+        self.policy=policy
+        self.max_backlog=max_backlog
+        self.cursor=ring.head #Start from live data
+        self.dropped=0
+        self.sent=0
+        self.closed=False
+        with ring.cond :
+            ring.subscribers.add(self)
+
+    def next_chunks(self,timeout=1.0):
+        '''
+        Wait for new data and return a list of (sequence number, chunk), applying the policy
+        if the backlog exceeds max_backlog.  Returns an empty list on timeout, and sets closed
+        if the policy is 'disconnect' and the subscriber fell too far behind.
+        '''
+        return self.take_new(self.ring.wait(self.cursor,timeout))
+
+    async def next_chunks_async(self,notifier,timeout=1.0):
+        '''
+        As next_chunks, waiting on the event loop of notifier (see DataRing.notifier).
+        '''
+        return self.take_new(await notifier.wait(self.cursor,timeout))
+
+    def take_new(self,head):
+        '''
+        Return the chunks from the cursor up to head - see next_chunks.
+        '''
+        start=max(self.cursor,self.ring.oldest())
+        self.dropped+=start-self.cursor #Overwritten before they could be read
+        backlog=head-start
+        stride=1
+        if backlog>self.max_backlog :
+            if self.policy=='disconnect' :
+                self.closed=True
+                return []
+            elif self.policy=='drop' :
+                self.dropped+=backlog-self.max_backlog
+                start=head-self.max_backlog
+            else : #decimate
+                stride=ceil(backlog/self.max_backlog)
+        chunks=self.ring.take(start,head,stride)
+        if stride>1 :
+            self.dropped+=(head-start)-len(chunks)
+        self.cursor=head
+        self.sent+=len(chunks)
+        return chunks
+
+def subscribe(ring,opcode,flags,body):
+    '''
+    Return a Subscriber to ring, with the options of a subscribe request - see module
+    documentation.
+    '''
+    if opcode!=OP.SUBSCRIBE :
+        raise ValueError("Streaming service only accepts subscribe requests - received opcode {}".format(opcode))
+    options={}
+    if len(body)>0 :
+        options=decode_body(body,flags)
+        if not isinstance(options,dict) :
+            options=json.loads(bytes(body).decode())
+    return Subscriber(ring,**options)
+
+class StreamRequestHandler(socketserver.BaseRequestHandler):
+    '''
+    Serve one subscriber of the streaming service.  See module documentation.
+    '''
+    #How long to wait for a subscribe request before falling back to a bare data stream [s]
+    subscribe_timeout=0.5
+
+    def handle(self):
+        framed=False
+        self.request.settimeout(StreamRequestHandler.subscribe_timeout)
+        try :
+            framed=self.request.recv(1,socket.MSG_PEEK)==NEGOTIATE
+        except socket.timeout :
+            pass
+        self.request.settimeout(None)
+        self.request.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        if framed :
+            self.request.recv(1)
+            self.request.sendall(bytes([PROTOCOL_VERSION]))
+            rfile=self.request.makefile('rb')
+            (opcode,request_id)=(OP.SUBSCRIBE,0)
+            try :
+                header=rfile.read(HEADER.size)
+                if len(header)<HEADER.size :
+                    return #Client went away before subscribing
+                (opcode,flags,request_id,length)=decode_header(header)
+                check_request_length(length)
+                body=rfile.read(length)
+                if len(body)<length :
+                    return
+                subscriber=subscribe(self.server.ring,opcode,flags,body)
+            except Exception as e :
+                msg=str(e).encode()
+                try :
+                    self.request.sendall(encode_header(opcode,FLAG_ERROR,request_id,len(msg))+msg)
+                except OSError :
+                    pass #Client went away
+                return
+            self.request.sendall(encode_header(OP.SUBSCRIBE,0,request_id,0))
+        else :
+            subscriber=Subscriber(self.server.ring)
+
+        try :
+            while not subscriber.closed :
+                for (seq,chunk) in subscriber.next_chunks() :
+                    if framed :
+                        self.request.sendall(encode_header(OP.STREAM_DATA,0,seq&0xFFFFFFFF,len(chunk)))
+                    if len(chunk)>0 :
+                        self.request.sendall(chunk)
+        except OSError :
+            pass #Subscriber went away
+        finally :
+            self.request.close()
+
+class StatusRequestHandler(socketserver.BaseRequestHandler):
+    '''
+    Serve one listener of a status broadcast, in the manner of the acq400 TSTAT port: the
+    ring holds status lines, of which the listener receives the most recent at once, then
+    each new one as it is published.  A listener that falls behind skips to the newest lines.
+    Nothing is read from the listener.
+
+    USAGE:
+        tstat_server=StreamTCPServer((host,AcqPorts.TSTAT),status_ring,StatusRequestHandler)
+    '''
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        subscriber=Subscriber(self.server.ring,'drop')
+        try :
+            #Current status first, then changes
+            for (seq,line) in self.server.ring.take(subscriber.cursor-1,subscriber.cursor) :
+                self.request.sendall(line)
+            while True :
+                for (seq,line) in subscriber.next_chunks() :
+                    self.request.sendall(line)
+        except OSError :
+            pass #Listener went away
+        finally :
+            self.request.close()
+
+class StreamTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    '''
+    Streaming server - one thread per subscriber, all reading from the shared ring.
+
+    USAGE:
+        stream_server=StreamTCPServer((host,AcqPorts.STREAM),ring)
+    '''
+    daemon_threads=True
+    allow_reuse_address=True
+
+    def __init__(self,server_address,ring,handler_class=StreamRequestHandler,**kwargs):
+        self.ring=ring
+        super(StreamTCPServer,self).__init__(server_address,handler_class,**kwargs)
+
+async def serve_subscriber(reader,writer,ring):
+    '''
+    Serve one subscriber of the streaming service as a task on the running event loop - as
+    StreamRequestHandler does on a thread of its own.
+
+    USAGE:
+        await asyncio.start_server(lambda r,w : serve_subscriber(r,w,ring),host,AcqPorts.STREAM)
+    '''
+    notifier=ring.notifier(asyncio.get_running_loop())
+    try :
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        try :
+            first=await asyncio.wait_for(reader.read(1),StreamRequestHandler.subscribe_timeout)
+        except asyncio.TimeoutError :
+            first=None #Bare data stream
+        if first==b'' :
+            return #Client went away before subscribing
+        framed=first==NEGOTIATE
+        if framed :
+            writer.write(bytes([PROTOCOL_VERSION]))
+            (opcode,request_id)=(OP.SUBSCRIBE,0)
+            try :
+                (opcode,flags,request_id,length)=decode_header(await reader.readexactly(HEADER.size))
+                check_request_length(length)
+                subscriber=subscribe(ring,opcode,flags,await reader.readexactly(length))
+            except asyncio.IncompleteReadError :
+                return
+            except Exception as e :
+                msg=str(e).encode()
+                writer.write(encode_header(opcode,FLAG_ERROR,request_id,len(msg))+msg)
+                await writer.drain()
+                return
+            writer.write(encode_header(OP.SUBSCRIBE,0,request_id,0))
+        else :
+            subscriber=Subscriber(ring)
+        while not subscriber.closed :
+            for (seq,chunk) in await subscriber.next_chunks_async(notifier) :
+                if framed :
+                    writer.write(encode_header(OP.STREAM_DATA,0,seq&0xFFFFFFFF,len(chunk)))
+                if len(chunk)>0 :
+                    writer.write(memoryview(chunk).cast('B')) #Chunks may be arrays, as read from the device
+            await writer.drain() #A slow subscriber falls behind here, and its policy applies
+    except ConnectionError :
+        pass #Subscriber went away
+    finally :
+        writer.close()
+
+async def serve_status(reader,writer,ring):
+    '''
+    Serve one listener of a status broadcast as a task on the running event loop - as
+    StatusRequestHandler does on a thread of its own.
+    '''
+    notifier=ring.notifier(asyncio.get_running_loop())
+    subscriber=Subscriber(ring,'drop')
+    try :
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        #Current status first, then changes
+        for (seq,line) in ring.take(subscriber.cursor-1,subscriber.cursor) :
+            writer.write(line)
+        while True :
+            for (seq,line) in await subscriber.next_chunks_async(notifier) :
+                writer.write(line)
+            await writer.drain()
+    except ConnectionError :
+        pass #Listener went away
+    finally :
+        writer.close()
@@ -11,6 +11,10 @@ import usb.util
 import time
 import array
 from math import floor, ceil, log2
+import di4108_profile
+import di4108_log
+
+LOG=di4108_log.get_logger('device')
 #import numpy
 
 #
@@ -22,7 +26,7 @@ class DI4108_WRAPPER :
     def __init__(self,fs=10000,v_range=None,chans=None,dig_in=False, \
      rate_in=False, rate_range=None, ffl=None, counter_in=False,dec=1,filt_settings=None,\
      packet_size=None,packet_buffer_size=5,packet_time=0.005,store_mode='pulse',trig_mode='soft',n_samps_pre=0,\
-     n_samps_post=10000,max_samps=10E6):
+     n_samps_post=10000,max_samps=10E6,device_match=None,dev=None):
         '''
         Initialize instance of DI4108_WRAPPER object.  Attributes:
         def __init__(self,fs=10000,v_range=10,chans=8,dig_in=False,  \
@@ -74,9 +78,23 @@ class DI4108_WRAPPER :
         
         max_samps=maximum number of samples that can be stored.  Keyword argument, default=10E6
         
+        device_match=dictionary of additional keyword arguments to usb.core.find, selecting one
+            DI-4108 when several are connected - e.g. {'serial_number':'5A3B1C2D'} or
+            {'bus':1,'address':4}.  Default=None - first DI-4108 found
+
+        dev=device to use in place of one found over USB, with the same interface - e.g.
+            di4108_sim.SimulatedDI4108.  Kept when re-initialized without one.  Default=None -
+            find the device over USB
+        
         T. Golfinopoulos, 24 August 2018
         '''
-        self.debug=False #Debug flag
+        self.debug=None #Debug flag - None follows the DI-4108 log level (see di4108_log)
+        self.device_match={} if device_match is None else dict(device_match)
+        if dev is None and getattr(self,'injected',False) :
+            dev=self.dev #Re-initialized - keep the injected device
+        self.injected=not dev is None
+        self.t_start=None #Time (time.time()) the last pulse started - see trig_data_pulse
+        self.t_start_uncertainty=None
         
         self.fs=fs #Sampling frequency
         
@@ -85,7 +103,7 @@ class DI4108_WRAPPER :
              #+-10 V corresponds to voltage programming code of 0b0000
              #(four least-significant bits of channel slist program)
             if self.debugging():
-                print(self._v_code) #Debug
+                LOG.debug("v_code=%s",self._v_code)
             #self.v_code=0
         else :
             try :
@@ -138,15 +156,18 @@ class DI4108_WRAPPER :
         self.packet_size=packet_size #Size of packets transferred in each sample.
 
         if self.debugging():
-            print("Packet size={}".format(self.packet_size))
-            print("Poll time={} (adjusted to better fit packet size, and scaled by buffer size={})".format(self.poll_time,self.packet_buffer_size))
-            print("Ready to connect to a USB device")
+            LOG.debug("Packet size=%s",self.packet_size)
+            LOG.debug("Poll time=%s (adjusted to better fit packet size, and scaled by buffer size=%s)",self.poll_time,self.packet_buffer_size)
+            LOG.debug("Ready to connect to a USB device")
         
         try :
             #Establish connection to device
             #Make sure device is plugged into USB port ;)
-            #Find the device - the DATAQ DI-4108 has idVendor of 0683 and idProduct of 4108.  If there are multiple devices, you can use address and bus as unique identifiers
-            self.dev=usb.core.find(idVendor=0x0683,idProduct=0x4108)
+            #Find the device - the DATAQ DI-4108 has idVendor of 0683 and idProduct of 4108.  If there are multiple devices, you can use address and bus as unique identifiers - see device_match
+            if self.injected :
+                self.dev=dev
+            else :
+                self.dev=usb.core.find(idVendor=0x0683,idProduct=0x4108,**self.device_match)
 
             if self.dev is None :
                 raise ValueError('Device not found')
@@ -207,24 +228,26 @@ class DI4108_WRAPPER :
                 test_dev(self.ep_out,self.ep_in)
         
         except :
-            print("Can't create a new USB connection may exist already")
+            LOG.warning("Can't create a new USB connection - may exist already",exc_info=self.debugging())
         
         if self.debugging() :
-            print("Ready to set up device")
+            LOG.debug("Ready to set up device")
         
         #Configure device
         try :
             self.setup_device()
         except:
-            print("Can't setup device - may not be connected")
+            LOG.warning("Can't setup device - may not be connected",exc_info=self.debugging())
         
         if self.debugging() :
-            print("Done initializing device")
+            LOG.debug("Done initializing device")
     
     def setup_device(self) :
         '''
         Communicate with DATAQ DI-4108 device(s) to activate specified channels, set sampling rate and voltage range and filtering and decimation, etc.
         '''
+        prof=di4108_profile.PROFILER
+        if not prof is None : tp=prof.now()
         record_counter=0
         
         record_config_number=[]
@@ -259,18 +282,17 @@ class DI4108_WRAPPER :
         #with code corresponding to index in this list,
         #but starting at 1!
         if self.rate_in :
-            record_config_number.append( (self.rate_range<<8)+9 )
+            record_config_number.append( (self.rate_code<<8)+9 )
         
         #If counter input is requested, add to list with activation
         #code, 10
         if self.counter_in :
             record_config_number.append(10)
-        print('before assert')
         #Make sure number of records matches configured number of records
         assert(len(record_config_number)==self.number_records)
         
-        print("RECORD CONFIG NUMBER")
-        print(record_config_number)
+        if self.debugging() :
+            LOG.debug("Record config numbers: %s",record_config_number)
         
         #Invoke slist commands to configure device
         for record_counter in range(len(record_config_number)) :
@@ -317,20 +339,25 @@ class DI4108_WRAPPER :
         
         #Set LED to blue
         self.set_led(1)
+        if not prof is None : prof.mark('setup_device',tp)
     
     def clear_buffer(self,num_reads=5):
         '''
         Read several times to clear a buffer.
         '''
+        prof=di4108_profile.PROFILER
+        if not prof is None : tp=prof.now()
         
-        print("---CLEAR BUFFER---")
         for i in range(num_reads):
             try :
-                print("".join([chr(x) for x in self.read()]))
+                flushed=self.read()
             except:
-                print("Buffer clear after {} reads".format(i))
+                if self.debugging() :
+                    LOG.debug("Buffer clear after %d reads",i)
                 break
-        print("---")
+            if self.debugging() :
+                LOG.debug("Cleared from buffer: %r",bytes(flushed))
+        if not prof is None : prof.mark('clear_buffer',tp)
 
     def read(self):
         '''
@@ -347,27 +374,39 @@ class DI4108_WRAPPER :
         #but seems to be larger than a single packet
         return self.ep_in.read(self.packet_size*self.packet_buffer_size,self.timeout)
 
-    def trig_data_pulse(self,pulse_duration):
+    def trig_data_pulse(self,pulse_duration,on_read=None):
         '''
         Start data pulse and run for pulse_duration.  Poll data every poll_time seconds.
         Return data array.
 
         USAGE:
             (my_data,elapsed_time,raw_data)=my_di4108.trig_data_pulse(pulse_duration)
+            (my_data,elapsed_time,raw_data)=my_di4108.trig_data_pulse(pulse_duration,on_read=my_callback)
 
         INPUTS:
             pulse_duration=duration of data pulse in seconds
+            on_read=optional function, called as on_read(chunk,read_time) with the raw bytes array returned by
+                each read, as soon as it arrives - e.g. to stream data live - and the time spent in that
+                read [s].  The chunk must not be modified.
 
         OUTPUTS:
             my_data=array of raw integer data.  Each element corresponds to
                 two bytes of data from a single channel.
             elapsed_time=difference between start and stop times of digitizers.  Evaluated with
                 Python time library, so may not be very accurate.
-            raw_data=array of raw bytes data.  Each pair of elements, (0,1), (2,3), etc. comprise one
-                2-byte (16-bit) integer.  Length is twice that of my_data
+            raw_data=bytes object holding raw data.  Each pair of elements, (0,1), (2,3), etc. comprise one
+                2-byte (16-bit) little-endian integer.  Length is twice that of my_data
+
+        The time the start command was sent (time.time(), midway between just before and just after
+        sending it) is kept in t_start, and half the time taken to send it in t_start_uncertainty.
+
+        With profiling enabled (see di4108_profile), each stage - each read, on_read and sleep,
+        the start and stop commands, and joining and converting the data - is recorded.
 
         T. Golfinopoulos, 5 September 2018, 12 September 2018.
         '''
+        prof=di4108_profile.PROFILER
+        if not prof is None : tp=prof.now()
         self.ep_out.write('info 0')
         
         #Set LED to green
@@ -377,9 +416,17 @@ class DI4108_WRAPPER :
         raw_data=[None]*num_polls #Preallocate list
         pre_samps=[None]*self.n_samps_pre #Preallocate pre-trigger samples
 
+        if not prof is None : tp=prof.mark('prepare',tp)
         self.clear_buffer()
         
+        #Bracket the start command in time, to stamp the shot with when it started
+        if not prof is None : tp=prof.now()
+        ts=time.time()
         self.ep_out.write('start 0') #Start collecting data.
+        te=time.time()
+        if not prof is None : tp=prof.mark('start',tp)
+        self.t_start=(ts+te)/2.0
+        self.t_start_uncertainty=(te-ts)/2.0
         
         first_post_trig_data=None
 
@@ -429,41 +476,68 @@ class DI4108_WRAPPER :
         t0=time.time()
 
         for i in range(num_polls) :
+            ta=time.time()
             raw_data[i]=self.read() #Read data
+            if not prof is None : tp=prof.mark('read',tp,len(raw_data[i]))
+            if not on_read is None :
+                on_read(raw_data[i],time.time()-ta)
+                if not prof is None : tp=prof.mark('on_read',tp)
             tb=time.time()
             #Correct by removing transmission time
             wait_time=(i+1)*self.poll_time-(tb-t0)
             if wait_time>0:
                 time.sleep(wait_time) #Wait until next poll time, if there is time left to wait
+                if not prof is None : tp=prof.mark('sleep',tp)
 
         tf=time.time()
+        if not prof is None : tp=prof.now()
         self.ep_out.write('stop') #Stop data pulse
         
         #print(raw_data)
         #Set LED to red
         self.set_led(4)
+        if not prof is None : tp=prof.mark('stop',tp)
 
         #Collapse data into one-dimensional array
         if self.debugging():
-            print("Number of packets={}".format(len(raw_data)))
+            LOG.debug("Number of packets=%d",len(raw_data))
 
-        data=[]
+        parts=[]
         
         #Add pre-trigger samples and first post-trig samples
         if self.n_samps_pre>0 :
-            data+=pre_samps
+            parts.append(bytes(pre_samps))
         if first_post_trig_data != None :
-            data+=first_post_trig_data
+            parts.append(first_post_trig_data)
 
         #first_data_pt=''.join([chr(x) for x in raw_data[0]])
         #print(first_data_pt)
-        for elem in raw_data[0:] : #Skip first sample - from ps
-            data+=elem
+        #Join reads into one contiguous, immutable buffer - a single copy, rather
+        #than growing a list with one Python int per byte
+        data=b''.join(parts+raw_data)
+        if not prof is None : tp=prof.mark('join',tp,len(data))
 
         my_data=DI4108_WRAPPER.convert_bytes_to_int(data)
+        if not prof is None : prof.mark('convert_bytes_to_int',tp,len(my_data))
         
         return (my_data,tf-t0,data)
 
+    def record_layout(self):
+        '''
+        Describe how records are interleaved in the raw data, as a dictionary that can be stored
+        alongside a shot, so that the shot can be decoded after settings change.
+
+        USAGE:
+            layout=my_di4108.record_layout()
+
+        OUTPUT:
+            dictionary with number_records, nchans, chans, dig_in, rate_in, counter_in, v_range,
+            rate_range, and fs.  Records of each sample are ordered as in convert_data.
+        '''
+        return {'number_records':self.number_records,'nchans':self.nchans,'chans':list(self.chans),\
+            'dig_in':self.dig_in,'rate_in':self.rate_in,'counter_in':self.counter_in,\
+            'v_range':self.v_range,'rate_range':self.rate_range,'fs':self.fs}
+
     @staticmethod
     def twos_comp(val, bits):
         """compute the 2's complement of int value val"""
@@ -524,7 +598,7 @@ class DI4108_WRAPPER :
                     output_data_array[ptr]=DI4108_WRAPPER.twos_comp(raw_data_array[ptr],16)/32768.0*self.v_range
                 except :
                     if self.debugging():
-                        print(raw_data_array[ptr])
+                        LOG.debug("Can't convert value %r",raw_data_array[ptr])
                     raise 
             
             #After analog channels, data comes in as digital input, rate, and counter
@@ -537,12 +611,12 @@ class DI4108_WRAPPER :
             #Note: data are in two's complement.
             if self.rate_in :
                 ptr+=1
-                output_data_array[ptr]=(raw_data_array[ptr]+32768)/65536.0*self.rate_range
+                output_data_array[ptr]=(DI4108_WRAPPER.twos_comp(raw_data_array[ptr],16)+32768)/65536.0*self.rate_range
 
             #Note: data are in two's complement.
             if self.counter_in :
                 ptr+=1
-                output_data_array[ptr]=raw_data_array[ptr]+32768
+                output_data_array[ptr]=DI4108_WRAPPER.twos_comp(raw_data_array[ptr],16)+32768
         
         #Break up into array of size, self.number_records x num_samples
         split_data=[]
@@ -996,7 +1070,6 @@ class DI4108_WRAPPER :
             self.ep_out.write('led {}'.format(led_val))
     
     def debugging(self):
-        import os
-        if self.debug == None:
-            self.debug=os.getenv("DEBUG_DEVICES")
-        return(self.debug)
+        if self.debug is None :
+            return di4108_log.DEBUG #Resolved once, at import - see di4108_log
+        return self.debug
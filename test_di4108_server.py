@@ -9,6 +9,7 @@ import json
 from io import StringIO
 import socket
 import time
+from di4108_protocol import OP, FLAG_ERROR, negotiate, send_frame, recv_frame
 import numpy
 from numpy import fft, logical_and
 import matplotlib.pyplot as plt
@@ -51,14 +52,9 @@ print(settings_string)
 
 settings_loaded=json.loads(settings_string)
 
-init_command='<init>'+settings_string+'</init>'
-trig_command='<trig_pulse>'
-store_command='<store>'
-query_length_command='<query_data_length>'
-commands=[init_command,trig_command,query_length_command,store_command]
-#commands=[trig_command,'<query_data_length>',store_command]
-#commands=[store_command]
-#commands=[trig_command]
+#All commands go over one persistent, framed connection - see di4108_protocol
+#The trigger returns at once with a job id; wait (with no job id, on the most recent job) blocks until the pulse is done
+commands=[(OP.INIT,init_settings),(OP.TRIG_PULSE,None),(OP.WAIT,None),(OP.QUERY_DATA_LENGTH,None),(OP.STORE,None)]
 
 print(init_settings)
 print(settings_loaded)
@@ -73,41 +69,32 @@ host = '198.125.177.3' #'localhost'
 port = 4220
 server_addr=(host,port)
 
-max_reads=1024
-
 data_length=None
 
-for command in commands :
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    #Send settings to server
-    s.connect(server_addr)
-    print(command.encode())
-    try :
-        s.sendall(bytes(command,'ascii')) #ASCII encoding seems important, rather than sendall('command'.encode())
-        if command=='<store>' :
-            #print('Intended length={}'.format(int(response)))
-            response=s.recv(1024)
-            s.settimeout(2)
-            all_response=response
-            for i in range(max_reads) :
-                response=s.recv(1024)
-                if len(response) == 0 :
-                    break
-                all_response+=response #Add response
+s = socket.create_connection(server_addr)
+try :
+    negotiate(s)
+    #Pipeline all commands - each reply carries the request id of its command
+    for (request_id,(opcode,body)) in enumerate(commands) :
+        print(OP.names[opcode])
+        send_frame(s,opcode,body,request_id=request_id)
+    for request_id in range(len(commands)) :
+        (opcode,flags,reply_id,response)=recv_frame(s)
+        if flags & FLAG_ERROR :
+            raise IOError("{} failed: {}".format(OP.names[opcode],response.decode()))
+        if opcode==OP.QUERY_DATA_LENGTH :
+            data_length=int(response)
+            print("Queried data length={}".format(data_length))
+        elif opcode==OP.WAIT :
+            print("Acquisition job: {}".format(json.loads(bytes(response).decode())))
+        elif opcode==OP.STORE :
+            all_response=bytes(response)
             print("Length of response = {}".format(len(all_response)))
-            if not data_length is None :
-                print("Queried data length={}".format(data_length))
-                assert(data_length==len(all_response))
+            assert(data_length==len(all_response))
         else :
-            response = str(s.recv(1024), 'ascii')
-            print("Received: {}".format(response))
-        
-        if command=='<query_data_length>' :
-            data_length=int(response)
-    finally :
-        s.close()
-    #s.send(''.encode())
-    #s.shutdown(socket.SHUT_WR) #Stop writing
+            print("Received: {} reply to request {}".format(OP.names[opcode],reply_id))
+finally :
+    s.close()
 
 print(all_response[0:20])
 response_bytes=DI4108_WRAPPER.convert_bytes_to_int(all_response)
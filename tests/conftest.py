@@ -0,0 +1,118 @@
+'''
+Fixtures for the tests, which run against simulated DI-4108s (see di4108_sim), on the loopback
+interface, so they need no hardware.
+'''
+import os
+import sys
+import socket
+import threading
+import pytest
+
+ROOT=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not ROOT in sys.path :
+    sys.path.insert(0,ROOT)
+
+import di4108_server
+from di4108_server import AcqPorts
+
+def port_free(port):
+    with socket.socket() as s :
+        try :
+            s.bind(('localhost',port))
+        except OSError :
+            return False
+    return True
+
+def free_site_port(first=5300,last=5900):
+    '''
+    Return a site port whose own, streaming and state broadcast ports are all free.
+    '''
+    for port in range(first,last) :
+        ports=[port,AcqPorts.STREAM+port-AcqPorts.SITE0,AcqPorts.TSTAT+port-AcqPorts.SITE0]
+        if all([port_free(p) for p in ports]) :
+            return port
+    raise RuntimeError("No free site port between {} and {}".format(first,last))
+
+@pytest.fixture
+def site_port(tmp_path,monkeypatch):
+    '''
+    A free port, with the working directory (where servers keep settings and shots) a
+    temporary one.  Sites registered on it are forgotten afterwards.
+    '''
+    monkeypatch.chdir(tmp_path)
+    port=free_site_port()
+    yield port
+    with di4108_server.SITES_LOCK :
+        site=di4108_server.SITES.pop(port,None)
+        di4108_server.STATE.states.pop(port,None)
+        di4108_server.STORE_DATA.shot.pop(port,None)
+    if not site is None :
+        site.executor.shutdown(wait=True)
+        if not site._device is None and hasattr(site._device,'close') :
+            site._device.close()
+
+@pytest.fixture
+def sim_server(site_port):
+    '''
+    A threaded server of a simulated site, started as by di4108_server; yields its port.
+    '''
+    di4108_server.add_site(site_port,simulate={'realtime':False})
+    server=di4108_server.ThreadedTCPServer(('localhost',site_port),di4108_server.ThreadedTCPRequestHandler)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    yield site_port
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def async_sim_server(site_port):
+    '''
+    An asyncio server of a simulated site, on an event loop of its own thread; yields its port.
+    '''
+    import asyncio
+    import di4108_async_server
+    di4108_server.add_site(site_port,simulate={'realtime':False})
+    loop=asyncio.new_event_loop()
+    server=loop.run_until_complete(di4108_async_server.start_server('localhost',site_port))
+    thread=threading.Thread(target=loop.run_forever,daemon=True)
+    thread.start()
+    yield site_port
+
+    async def shutdown():
+        server.close()
+        tasks=[t for t in asyncio.all_tasks() if not t is asyncio.current_task()]
+        for t in tasks :
+            t.cancel()
+        await asyncio.gather(*tasks,return_exceptions=True)
+    asyncio.run_coroutine_threadsafe(shutdown(),loop).result(5.0)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5.0)
+    loop.close()
+
+@pytest.fixture(params=['threaded','async'])
+def any_server(request):
+    '''
+    Each of the servers of a simulated site in turn; yields its port.
+    '''
+    yield request.getfixturevalue('sim_server' if request.param=='threaded' else 'async_sim_server')
+
+@pytest.fixture
+def sim_nodes(site_port):
+    '''
+    Two threaded servers of simulated sites, on ports other than site_port; yields their ports.
+    '''
+    ports=[free_site_port(first,first+50) for first in (5900,5950)]
+    servers=[]
+    for port in ports :
+        di4108_server.add_site(port,simulate={'realtime':False})
+        servers.append(di4108_server.ThreadedTCPServer(('localhost',port),di4108_server.ThreadedTCPRequestHandler))
+        threading.Thread(target=servers[-1].serve_forever,daemon=True).start()
+    yield ports
+    for server in servers :
+        server.shutdown()
+        server.server_close()
+    for port in ports :
+        with di4108_server.SITES_LOCK :
+            site=di4108_server.SITES.pop(port)
+            di4108_server.STATE.states.pop(port,None)
+            di4108_server.STORE_DATA.shot.pop(port,None)
+        site.executor.shutdown(wait=True)
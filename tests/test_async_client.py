@@ -0,0 +1,78 @@
+'''
+Tests of collecting shots from several servers at once (di4108_async_client.ShotCollector).
+'''
+import time
+import asyncio
+import threading
+import numpy
+from di4108_async_client import ShotCollector
+from di4108_client import DI4108Client
+
+def fetch(port,command):
+    with DI4108Client('localhost',port) as client :
+        return getattr(client,command)()
+
+def test_shot_from_each_node(sim_nodes):
+    collector=ShotCollector(['localhost:{}'.format(port) for port in sim_nodes],timeout=30.0)
+    try :
+        assert asyncio.run(collector.init(fs=10000,chans=3,n_samps_post=2000)).ok
+        results=asyncio.run(collector.shot())
+        assert results.ok,results.failed
+        for r in results :
+            assert r.array.shape[0]==3 and r.array.shape[1]>=2000
+            assert r.array.dtype==numpy.float32
+            assert r.clock['exchanges']>0 and not r.t_start is None
+    finally :
+        collector.close()
+
+def test_preallocated_buffers_reused(sim_nodes):
+    collector=ShotCollector(['localhost:{}'.format(port) for port in sim_nodes],timeout=30.0)
+    try :
+        asyncio.run(collector.init(fs=10000,chans=3,n_samps_post=2000))
+        asyncio.run(collector.shot())
+        n_bytes=max([fetch(port,'query_data_length') for port in sim_nodes])
+        collector.preallocate(n_bytes)
+        (buffers,values)=(list(collector.buffers),list(collector.values))
+        for k in range(2) :
+            results=asyncio.run(collector.shot())
+            assert results.ok,results.failed
+            #The header is received apart, so a buffer of exactly the data's length holds the shot
+            assert [b is b0 for (b,b0) in zip(collector.buffers,buffers)]==[True,True]
+            assert [v is v0 for (v,v0) in zip(collector.values,values)]==[True,True]
+            for (r,v) in zip(results,values) :
+                assert numpy.shares_memory(r.array,v)
+        for (r,port) in zip(results,sim_nodes) :
+            (expected,desc)=fetch(port,'get_shot')
+            assert numpy.array_equal(r.array,expected)
+    finally :
+        collector.close()
+
+def test_clocks_tracked_between_shots(sim_nodes):
+    collector=ShotCollector(['localhost:{}'.format(port) for port in sim_nodes],timeout=30.0,ping_interval=0.02)
+    try :
+        asyncio.run(collector.init(fs=10000,chans=1,n_samps_post=500))
+        asyncio.run(collector.shot())
+        exchanges=[client.clock.estimate()['exchanges'] for client in collector.clients]
+        time.sleep(0.5)
+        #Pinged in the background, with no command running
+        assert all([client.clock.estimate()['exchanges']>n+5 for (client,n) in zip(collector.clients,exchanges)])
+        results=asyncio.run(collector.shot())
+        assert all([r.clock['exchanges']>n+5 for (r,n) in zip(results,exchanges)])
+        thread=collector.clock_tracker.thread
+    finally :
+        collector.close()
+    assert not thread.is_alive()
+    assert not any([t.name=='di4108-clock' for t in threading.enumerate()])
+
+def test_tracker_survives_failed_node(sim_nodes):
+    collector=ShotCollector(['localhost:{}'.format(sim_nodes[0]),'localhost:1'],timeout=2.0,ping_interval=0.02)
+    try :
+        asyncio.run(collector.init(fs=10000,chans=1,n_samps_post=500))
+        results=asyncio.run(collector.shot())
+        assert [r.ok for r in results]==[True,False]
+        n=collector.clients[0].clock.estimate()['exchanges']
+        time.sleep(0.3)
+        assert collector.clients[0].clock.estimate()['exchanges']>n
+        assert collector.clock_tracker.thread.is_alive()
+    finally :
+        collector.close()
@@ -0,0 +1,80 @@
+'''
+Tests that the asyncio server keeps device and shot work off its event loop.
+'''
+import time
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import di4108_server
+import di4108_async_server
+from di4108_server import DI4108Commands
+from di4108_client import DI4108Client
+
+@pytest.fixture
+def threads(monkeypatch):
+    '''
+    Record the names of the threads that set up connections, demultiplex shots, and draw
+    compressed chunks.
+    '''
+    names={'init_commands':[],'demux':[],'encode':[]}
+    init_commands=DI4108Commands.init_commands
+    def recording_init_commands(self,*args,**kwargs) :
+        names['init_commands'].append(threading.current_thread().name)
+        return init_commands(self,*args,**kwargs)
+    monkeypatch.setattr(DI4108Commands,'init_commands',recording_init_commands)
+    demux=di4108_server.demux
+    def recording_demux(*args,**kwargs) :
+        names['demux'].append(threading.current_thread().name)
+        return demux(*args,**kwargs)
+    monkeypatch.setattr(di4108_server,'demux',recording_demux)
+    encode_chunks=di4108_server.encode_chunks
+    def recording_encode_chunks(*args,**kwargs) :
+        for chunk in encode_chunks(*args,**kwargs) :
+            names['encode'].append(threading.current_thread().name)
+            yield chunk
+    monkeypatch.setattr(di4108_server,'encode_chunks',recording_encode_chunks)
+    return names
+
+def test_work_runs_off_event_loop(async_sim_server,threads):
+    with DI4108Client('localhost',async_sim_server) as client :
+        client.init(fs=10000,chans=4,n_samps_post=5000)
+        client.acquire(30.0)
+        client.store('float32')
+        client.get_seg(format='float32',dec=10,mode='minmax')
+        client.store_compressed(format='int16',chunk_samples=1000)
+        client.ping()
+    assert len(threads['encode'])>=5
+    for (what,names) in threads.items() :
+        assert len(names)>0,what
+        #Worker threads of the server's command executor - never the loop's own thread
+        assert all([name.startswith('di4108-cmd') for name in names]),(what,names)
+
+def test_legacy_pulse_holds_no_thread(async_sim_server,monkeypatch):
+    executor=ThreadPoolExecutor(1,thread_name_prefix='di4108-cmd')
+    monkeypatch.setattr(di4108_async_server,'COMMAND_EXECUTOR',executor)
+    site=di4108_server.SITES[async_sim_server]
+    with DI4108Client('localhost',async_sim_server) as client :
+        client.init(fs=10000,chans=2,n_samps_post=500)
+        client.acquire(30.0)
+        n_jobs=len(site.jobs.jobs)
+        hold=threading.Event()
+        site.executor.submit(hold.wait,30.0) #The next pulse queues behind this
+        def legacy_pulse() :
+            with socket.create_connection(('localhost',async_sim_server),30.0) as sock :
+                sock.sendall(b'<trig_pulse>')
+                assert sock.recv(1)==b'' #No reply - closed once the pulse is complete
+        thread=threading.Thread(target=legacy_pulse)
+        thread.start()
+        try :
+            while len(site.jobs.jobs)==n_jobs :
+                time.sleep(0.01)
+            #The pulse is awaited on the loop, so the single command thread is free
+            assert len(client.store_raw())>0
+            assert thread.is_alive()
+        finally :
+            hold.set()
+        thread.join(30.0)
+        assert not thread.is_alive()
+        assert client.status()['state']=='done'
+    executor.shutdown()
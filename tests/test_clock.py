@@ -0,0 +1,60 @@
+'''
+Tests of the estimate of a remote clock from ping exchanges.
+'''
+import numpy
+import pytest
+from di4108_clock import ClockEstimator
+
+def exchange(t1,offset,drift,delay_out,delay_back,turnaround=1E-4):
+    '''
+    Return (t1,t2,t3,t4) of a ping sent at local time t1 to a server whose clock reads
+    offset+(1+drift)*t.
+    '''
+    remote=lambda t : offset+(1.0+drift)*t
+    t2=remote(t1+delay_out)
+    t3=remote(t1+delay_out+turnaround)
+    t4=t1+delay_out+turnaround+delay_back
+    return (t1,t2,t3,t4)
+
+def test_not_ready():
+    clock=ClockEstimator()
+    assert not clock.ready
+    with pytest.raises(ValueError) :
+        clock.to_local(0.0)
+
+def test_symmetric_offset():
+    clock=ClockEstimator()
+    (offset,delay)=clock.add(*exchange(100.0,2.5,0.0,1E-3,1E-3))
+    assert offset==pytest.approx(2.5)
+    assert delay==pytest.approx(2E-3)
+    (t_local,uncertainty)=clock.to_local(102.5)
+    assert t_local==pytest.approx(100.0)
+    assert uncertainty==pytest.approx(1E-3)
+
+def test_asymmetry_within_uncertainty():
+    clock=ClockEstimator()
+    clock.add(*exchange(100.0,-0.75,0.0,4E-3,0.5E-3))
+    (t_local,uncertainty)=clock.to_local(100.0-0.75)
+    assert abs(t_local-100.0)<=uncertainty
+
+def test_best_exchanges_and_drift():
+    rng=numpy.random.RandomState(1)
+    (offset,drift)=(0.3,50E-6)
+    clock=ClockEstimator(window=64,best_fraction=0.25,min_span=1.0)
+    for t in numpy.arange(1000.0,1020.0,0.25) :
+        #Mostly fast, symmetric exchanges; a few slow, lopsided ones, which the fit must ignore
+        slow=rng.rand()<0.2
+        clock.add(*exchange(t,offset,drift,0.05 if slow else 2E-4,2E-4))
+    estimate=clock.estimate()
+    assert estimate['exchanges']==64
+    assert estimate['drift']==pytest.approx(drift,rel=1E-3)
+    t=1010.0
+    (t_local,uncertainty)=clock.to_local(offset+(1.0+drift)*t)
+    assert abs(t_local-t)<=uncertainty
+    assert uncertainty<1E-3
+
+def test_no_drift_before_min_span():
+    clock=ClockEstimator(min_span=10.0)
+    for t in (0.0,0.5,1.0,1.5) :
+        clock.add(*exchange(t,1.0,1E-3,1E-4,1E-4))
+    assert clock.estimate()['drift']==0.0
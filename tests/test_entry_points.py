@@ -0,0 +1,75 @@
+'''
+Tests of the servers as started from the command line.
+'''
+import os
+import sys
+import time
+import socket
+import subprocess
+import pytest
+from conftest import ROOT, free_site_port, port_free
+from di4108_metrics import METRICS_PORT
+from di4108_client import DI4108Client
+
+def wait_for_port(port,process,timeout=20.0):
+    t_end=time.time()+timeout
+    while time.time()<t_end :
+        if not process.poll() is None :
+            raise AssertionError("Server exited with status {}: {}".format(process.returncode,process.stderr.read()))
+        try :
+            socket.create_connection(('localhost',port),0.5).close()
+            return
+        except OSError :
+            time.sleep(0.1)
+    raise AssertionError("Server not listening on port {} after {} s".format(port,timeout))
+
+@pytest.fixture
+def server_process(tmp_path):
+    if not port_free(METRICS_PORT) :
+        pytest.skip("Metrics port {} in use".format(METRICS_PORT))
+    port=free_site_port()
+    process=subprocess.Popen([sys.executable,os.path.join(ROOT,'di4108_server.py'),'--simulate',str(port)],\
+        cwd=str(tmp_path),stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,text=True)
+    try :
+        wait_for_port(port,process)
+        yield port
+    finally :
+        process.terminate()
+        process.wait(10)
+
+def legacy_request(port,request):
+    with socket.create_connection(('localhost',port),30.0) as sock :
+        sock.sendall(request.encode())
+        reply=bytearray()
+        while True :
+            data=sock.recv(65536)
+            if len(data)==0 :
+                return bytes(reply)
+            reply+=data
+
+def test_server_main_runs_commands_after_startup(server_process):
+    #The main thread ends its setup long before the first request; commands queued on the
+    #sites' executors must still run
+    time.sleep(0.5)
+    with DI4108Client('localhost',server_process,timeout=30.0) as client :
+        client.init(fs=10000,chans=2,n_samps_post=500)
+        status=client.acquire(30.0)
+        assert status['state']=='done'
+        assert client.query_data_length()>0
+    legacy_request(server_process,'<trig_pulse>')
+    assert int(legacy_request(server_process,'<query_data_length>'))>0
+    assert 'fs' in client.get_settings()
+
+def test_server_main_configures_and_post_processes(server_process):
+    #init and the post-processing pool are queued on executors too
+    with DI4108Client('localhost',server_process,timeout=30.0) as client :
+        client.init(fs=10000,chans=2,n_samps_post=500,postproc=['calibrate','summary'])
+        assert client.get_settings()['postproc']==['calibrate','summary']
+        job=client.acquire(30.0)['job']
+        t_end=time.time()+30.0
+        reply=client.postproc(job)
+        while reply['state']=='pending' and time.time()<t_end :
+            time.sleep(0.1)
+            reply=client.postproc(job)
+        assert reply['state']=='done',reply
+        assert len(reply['results']['summary']['mean'])==2
@@ -0,0 +1,109 @@
+'''
+Tests of the aggregation gateway (di4108_gateway).
+'''
+import threading
+import numpy
+import pytest
+import di4108_server
+from di4108_server import AcqJob
+from di4108_async_client import NodeResult
+from di4108_client import DI4108Client, CommandError
+from di4108_gateway import merge_shots, add_gateway, GatewayRequestHandler
+from di4108_decode import demux
+
+def node_result(node,records,fs=1000.0,t_start=None,t_start_uncertainty=None,job=1):
+    '''
+    A successful NodeResult of a shot whose record r holds records[r].
+    '''
+    result=NodeResult(node)
+    result.ok=True
+    result.array=numpy.array(records,dtype='<i2')
+    result.desc={'layout':{'number_records':len(records),'fs':fs},'elapsed_time':result.array.shape[1]/fs}
+    result.status={'job':job,'state':'done'}
+    (result.t_start,result.t_start_uncertainty)=(t_start,t_start_uncertainty)
+    return result
+
+def test_merge_aligns_on_latest_start():
+    fs=1000.0
+    #Each record holds the sample's time on the common clock, in ms
+    a=node_result('a:4220',[numpy.arange(100,200)]*2,fs,t_start=0.100,t_start_uncertainty=1E-4)
+    b=node_result('b:4220',[numpy.arange(103,253)],fs,t_start=0.103,t_start_uncertainty=2E-4,job=5)
+    shot=merge_shots([a,b],job_id=9)
+    merged=demux(shot.data,3)
+    assert merged.shape==(3,97)
+    assert numpy.array_equal(merged[0],numpy.arange(103,200))
+    assert numpy.array_equal(merged[1],merged[0])
+    assert numpy.array_equal(merged[2],merged[0])
+    assert shot.t_start==pytest.approx(0.103)
+    assert shot.t_start_uncertainty==pytest.approx(2E-4+0.5/fs)
+    assert shot.job_id==9
+    nodes=shot.layout['nodes']
+    assert [(n['node'],n['first_record'],n['shift'],n['samples'],n['job']) for n in nodes]==\
+        [('a:4220',0,3,100,1),('b:4220',2,0,150,5)]
+    assert (shot.layout['number_records'],shot.layout['fs'])==(3,fs)
+
+def test_merge_rounds_to_nearest_sample():
+    a=node_result('a',[numpy.arange(0,50)],t_start=1.0000,t_start_uncertainty=0.0)
+    b=node_result('b',[numpy.arange(0,50)],t_start=1.0026,t_start_uncertainty=0.0)
+    shot=merge_shots([a,b])
+    assert [n['shift'] for n in shot.layout['nodes']]==[3,0]
+    assert demux(shot.data,2).shape==(2,47)
+
+def test_merge_without_start_times():
+    a=node_result('a',[numpy.arange(0,60)],t_start=1.0,t_start_uncertainty=0.0)
+    b=node_result('b',[numpy.arange(0,40)])
+    shot=merge_shots([a,b])
+    assert (shot.t_start,shot.t_start_uncertainty)==(None,None)
+    merged=demux(shot.data,2)
+    assert numpy.array_equal(merged,numpy.array([numpy.arange(0,40)]*2))
+
+def test_merge_errors():
+    with pytest.raises(ValueError) :
+        merge_shots([node_result('a',[[0]*10],fs=1000.0),node_result('b',[[0]*10],fs=2000.0)])
+    with pytest.raises(ValueError) :
+        merge_shots([node_result('a',[[0]*10],t_start=0.0,t_start_uncertainty=0.0),\
+            node_result('b',[[0]*10],t_start=1.0,t_start_uncertainty=0.0)])
+
+@pytest.fixture
+def gateway(site_port,sim_nodes):
+    '''
+    A gateway on site_port, in front of two simulated servers; yields (gateway port, node ports).
+    '''
+    site=add_gateway(site_port,['localhost:{}'.format(port) for port in sim_nodes],timeout=30.0)
+    server=di4108_server.ThreadedTCPServer(('localhost',site_port),GatewayRequestHandler)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    yield (site,sim_nodes)
+    server.shutdown()
+    server.server_close()
+    site.close()
+
+def test_gateway_shot(gateway):
+    (site,node_ports)=gateway
+    with DI4108Client('localhost',site.port,timeout=60.0) as client :
+        client.init(fs=10000,chans=2,n_samps_post=2000)
+        job=client.trig_pulse()
+        assert job['state'] in (AcqJob.QUEUED,AcqJob.RUNNING) and job['expected_samples'] is None
+        status=client.wait(job['job'],timeout=60.0)
+        assert status['state']==AcqJob.DONE,status
+        assert [(n['node'],n['ok']) for n in status['nodes']]==[('localhost:{}'.format(p),True) for p in node_ports]
+        assert client.status(job['job'])==status
+        (array,desc)=client.store('int16')
+        settings=client.get_settings()
+    assert array.shape==(4,status['samples'])
+    assert [n['first_record'] for n in desc['layout']['nodes']]==[0,2]
+    assert all([n['clock']['exchanges']>0 for n in desc['layout']['nodes']])
+    assert sorted(settings.keys())==['localhost:{}'.format(p) for p in sorted(node_ports)]
+    assert all([s['fs']==10000 for s in settings.values()])
+
+def test_gateway_keeps_node_connections(gateway):
+    (site,node_ports)=gateway
+    with DI4108Client('localhost',site.port,timeout=60.0) as client :
+        client.init(fs=10000,chans=1,n_samps_post=500)
+        socks=[c.sock for c in site.collector.clients]
+        client.wait(client.trig_pulse()['job'],timeout=60.0)
+        client.get_settings()
+        #Every command ran on the site's one event loop, over the same connections
+        assert [c.sock for c in site.collector.clients]==socks and not None in socks
+        assert not site.loop.is_closed() and not site.loop.is_running()
+        with pytest.raises(CommandError) :
+            client.shm()
@@ -0,0 +1,103 @@
+'''
+Tests of acquisition jobs: their lifecycle, and the wait and status commands, on each server.
+'''
+import time
+import threading
+import pytest
+import di4108_server
+from di4108_server import AcqJob, JobRegistry
+from di4108_client import DI4108Client, CommandError
+from conftest import free_site_port
+
+def test_job_lifecycle(any_server):
+    release=threading.Event()
+    with DI4108Client('localhost',any_server) as client :
+        client.init(fs=10000,chans=2,n_samps_post=2000)
+        #Hold the site's executor busy, so the job stays queued until released
+        di4108_server.SITES[any_server].executor.submit(release.wait,30.0)
+        status=client.trig_pulse()
+        assert (status['state'],status['samples'],status['expected_samples'])==(AcqJob.QUEUED,0,2000)
+        assert client.status()['job']==status['job'] #Most recent job by default
+        start=time.time()
+        timed_out=client.wait(status['job'],timeout=0.2)
+        assert time.time()-start>=0.15
+        assert timed_out['state']==AcqJob.QUEUED
+        release.set()
+        done=client.wait(status['job'],timeout=10.0)
+        assert (done['job'],done['state'],done['error'])==(status['job'],AcqJob.DONE,None)
+        assert done['samples']>=2000 #Read in whole packets
+        assert client.status(status['job'])==done
+        assert client.query_data_length()==done['samples']*2*2
+
+def test_jobs_are_kept_by_id(any_server):
+    with DI4108Client('localhost',any_server) as client :
+        client.init(fs=10000,chans=1,n_samps_post=1000)
+        first=client.acquire(10.0)
+        second=client.acquire(10.0)
+        assert second['job']>first['job']
+        assert client.status(first['job'])['state']==AcqJob.DONE
+        assert client.wait()['job']==second['job']
+        with pytest.raises(CommandError) :
+            client.status(second['job']+1000)
+
+def test_wait_without_jobs(any_server):
+    with DI4108Client('localhost',any_server) as client :
+        with pytest.raises(CommandError) :
+            client.wait(timeout=1.0)
+        assert client.ping() #Connection still usable
+
+def test_failed_job(site_port):
+    site=di4108_server.add_site(site_port,simulate={'realtime':False})
+    site.device.trig_data_pulse=lambda *args,**kwargs : 1/0
+    job=AcqJob(site,0.1)
+    job.future=site.executor.submit(job.run)
+    with pytest.raises(ZeroDivisionError) :
+        job.future.result(10.0)
+    status=job.status()
+    assert status['state']==AcqJob.FAILED
+    assert 'ZeroDivisionError' in status['error']
+    assert di4108_server.STATE.states[site_port]==di4108_server.STATE.IDLE
+
+def test_registry_keeps_latest():
+    registry=JobRegistry(max_jobs=3)
+    class Job :
+        def __init__(self,id) :
+            self.id=id
+    for i in range(1,6) :
+        registry.add(Job(i))
+    assert list(registry.jobs.keys())==[3,4,5]
+    assert registry.get().id==5
+    with pytest.raises(ValueError) :
+        registry.get(1)
+
+def test_sites_acquire_concurrently(site_port):
+    #Two sites sampling in real time - each pulse takes 0.5 s, whichever site it is on
+    ports=[site_port,free_site_port(site_port+1)]
+    servers=[]
+    for port in ports :
+        di4108_server.add_site(port,simulate={'realtime':True})
+        servers.append(di4108_server.ThreadedTCPServer(('localhost',port),di4108_server.ThreadedTCPRequestHandler))
+        threading.Thread(target=servers[-1].serve_forever,daemon=True).start()
+    try :
+        clients=[DI4108Client('localhost',port) for port in ports]
+        for client in clients :
+            client.init(fs=10000,chans=2,n_samps_post=5000)
+        ids=[client.trig_pulse()['job'] for client in clients]
+        for (client,id) in zip(clients,ids) :
+            assert client.wait(id,30.0)['state']==AcqJob.DONE
+            client.close()
+        jobs=[di4108_server.SITES[port].jobs.get(id) for (port,id) in zip(ports,ids)]
+    finally :
+        for server in servers :
+            server.shutdown()
+            server.server_close()
+        with di4108_server.SITES_LOCK :
+            site=di4108_server.SITES.pop(ports[1])
+            di4108_server.STATE.states.pop(ports[1],None)
+            di4108_server.STORE_DATA.shot.pop(ports[1],None)
+        site.executor.shutdown(wait=True)
+        if not site._device is None and hasattr(site._device,'close') :
+            site._device.close()
+    #Each pulse ran while the other did, rather than after it
+    assert all([job.elapsed_time>=0.45 for job in jobs])
+    assert max([job.t_start for job in jobs])<min([job.t_start+job.elapsed_time for job in jobs])-0.3
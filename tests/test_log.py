@@ -0,0 +1,30 @@
+'''
+Tests of the cached debugging flag (di4108_log).
+'''
+import logging
+import pytest
+import di4108_log
+from di4108_client import DI4108Client
+
+@pytest.fixture
+def log_level():
+    level=di4108_log.LOGGER.level
+    yield
+    di4108_log.set_level(level)
+
+def server_debug_records(port,caplog):
+    caplog.clear()
+    with DI4108Client('localhost',port) as client :
+        client.get_settings()
+    return [r for r in caplog.records if r.name.startswith('di4108.') and r.levelno==logging.DEBUG]
+
+def test_cached_flag_gates_debug_output(sim_server,caplog,log_level):
+    caplog.set_level(logging.DEBUG) #Capture everything the guards let through
+    di4108_log.set_level('WARNING')
+    assert not di4108_log.debugging()
+    di4108_log.LOGGER.setLevel(logging.DEBUG) #The flag is cached - only set_level changes it
+    assert not di4108_log.debugging()
+    assert server_debug_records(sim_server,caplog)==[]
+    di4108_log.set_level('DEBUG')
+    assert di4108_log.debugging()
+    assert len(server_debug_records(sim_server,caplog))>0
@@ -0,0 +1,67 @@
+'''
+Tests of the acquisition counters the server exposes with its metrics command.
+'''
+import pytest
+import di4108_server
+from di4108_server import AcqJob, OVERFLOWS, RESYNCS, USB_BYTES
+from di4108_sim import STOP_MESSAGE
+from di4108_metrics import label_key
+from di4108_client import DI4108Client
+
+def run_job(site,pulse_duration=0.05):
+    '''
+    Run one acquisition job on site; returns (job, lengths of the chunks it read).
+    '''
+    lengths=[]
+    job=AcqJob(site,pulse_duration)
+    on_read=job.on_read
+    job.on_read=lambda chunk,read_time : (lengths.append(bytes(chunk)),on_read(chunk,read_time))
+    job.run()
+    assert job.state==AcqJob.DONE
+    return (job,lengths)
+
+def count(counter,port):
+    return counter.values.get(label_key({'site':port}),0)
+
+@pytest.fixture
+def counted(site_port):
+    '''
+    Function returning how much a counter of site_port has grown since the test started -
+    counters are process-wide, and ports are reused from test to test.
+    '''
+    start=dict([(c,count(c,site_port)) for c in (OVERFLOWS,RESYNCS,USB_BYTES)])
+    return lambda counter : count(counter,site_port)-start[counter]
+
+def test_clean_shot_has_no_resyncs(site_port,counted):
+    site=di4108_server.add_site(site_port,simulate={'realtime':False})
+    site.configure(fs=10000,chans=3)
+    (job,chunks)=run_job(site,0.1)
+    #Whole packets, which split samples of 3 records
+    assert sum([len(c)%6!=0 for c in chunks])>=3
+    assert counted(RESYNCS)==0
+    assert counted(OVERFLOWS)==0
+    assert counted(USB_BYTES)==job.bytes_read
+
+@pytest.mark.parametrize('misalign_bytes',[1,3])
+def test_lost_byte_counted_once(site_port,counted,misalign_bytes):
+    site=di4108_server.add_site(site_port,simulate={'realtime':False,'misalign_at':1001,'misalign_bytes':misalign_bytes})
+    site.configure(fs=10000,chans=3)
+    run_job(site,0.1)
+    assert counted(RESYNCS)==1
+
+def test_overflow_reported(site_port,counted):
+    site=di4108_server.add_site(site_port,simulate={'realtime':False,'overflow_at':0.01,'overflow_samples':100})
+    site.configure(fs=10000,chans=2)
+    (job,chunks)=run_job(site)
+    assert chunks.count(STOP_MESSAGE)==1
+    assert site.device.dev.overflows==100
+    assert counted(OVERFLOWS)==1
+    assert counted(RESYNCS)==0
+
+def test_metrics_command(sim_server):
+    with DI4108Client('localhost',sim_server) as client :
+        client.init(fs=10000,chans=3,n_samps_post=1000)
+        client.acquire(10.0)
+        text=client.metrics()
+    for name in ('di4108_usb_bytes_total','di4108_read_seconds_count','di4108_shot_seconds_count') :
+        assert '{}{{site="{}"}}'.format(name,sim_server) in text,name
@@ -0,0 +1,42 @@
+'''
+Tests of the post-processing pipeline stages (di4108_postproc).
+'''
+import os
+import numpy
+import pytest
+from di4108_postproc import parse_stages, stage_archive
+from di4108_client import DI4108Client, CommandError
+
+def archive(root,directory,job=4):
+    ctx={'records':numpy.zeros((2,10),dtype='<i2'),'fs':1000.0,'desc':{'job':job},'results':{},\
+        'archive_root':str(root)}
+    stage_archive(ctx,directory)
+    return ctx['results']['archive']
+
+def test_archive_under_root(tmp_path):
+    path=archive(tmp_path,'run1/day2')
+    assert path==os.path.join(str(tmp_path.resolve()),'run1','day2','shot_4.npz')
+    assert numpy.load(path)['records'].shape==(2,10)
+    assert os.path.dirname(archive(tmp_path,'.'))==str(tmp_path.resolve())
+
+@pytest.mark.parametrize('directory',['/tmp','..','../elsewhere','run1/../../elsewhere','run1\\..\\..',5])
+def test_archive_rejects_paths_out_of_root(tmp_path,directory):
+    with pytest.raises(ValueError) :
+        parse_stages([['archive',{'directory':directory}]])
+    with pytest.raises(ValueError) :
+        archive(tmp_path/'root',directory)
+    assert os.listdir(str(tmp_path))==[]
+
+def test_archive_rejects_link_out_of_root(tmp_path):
+    (tmp_path/'root').mkdir()
+    (tmp_path/'elsewhere').mkdir()
+    os.symlink(str(tmp_path/'elsewhere'),str(tmp_path/'root'/'link'))
+    with pytest.raises(ValueError) :
+        archive(tmp_path/'root','link')
+    assert os.listdir(str(tmp_path/'elsewhere'))==[]
+
+def test_init_rejects_archive_out_of_root(sim_server):
+    with DI4108Client('localhost',sim_server) as client :
+        with pytest.raises(CommandError) :
+            client.init(postproc=[['archive',{'directory':'/etc'}]])
+        assert client.get_settings()['postproc'] is None
@@ -0,0 +1,41 @@
+'''
+Tests of profiling the acquisition path (di4108_profile, and the server's profile command).
+'''
+import pytest
+import di4108_profile
+from di4108_client import DI4108Client, CommandError
+
+#Stages marked by the acquisition loop (digitizer_models) and the job publishing its shot (di4108_server)
+ACQUISITION_STAGES=['setup_device','clear_buffer','prepare','start','read','stop','join','publish']
+
+@pytest.fixture
+def profiled(sim_server):
+    di4108_profile.disable()
+    yield sim_server
+    di4108_profile.disable()
+
+def test_acquisition_marks(profiled):
+    with DI4108Client('localhost',profiled) as client :
+        client.profile(enable=4096)
+        client.init(fs=10000,chans=2,n_samps_post=2000)
+        client.acquire(30.0)
+        summary=client.profile()
+        trace=client.profile('trace',disable=True)
+    assert summary['capacity']==4096 and summary['events']>0
+    for stage in ACQUISITION_STAGES :
+        assert summary['stages'][stage]['count']>=1,stage
+    assert summary['stages']['read']['value']>=2*2000*2 #Bytes read
+    names=set([event['name'] for event in trace['traceEvents']])
+    assert set(ACQUISITION_STAGES)<=names
+    assert all([event['ph']=='X' and event['dur']>=0 for event in trace['traceEvents']])
+    assert di4108_profile.PROFILER is None
+
+def test_capacity_capped(profiled):
+    with pytest.raises(ValueError) :
+        di4108_profile.enable(di4108_profile.MAX_CAPACITY+1)
+    with DI4108Client('localhost',profiled) as client :
+        with pytest.raises(CommandError) :
+            client.profile(enable=di4108_profile.MAX_CAPACITY+1)
+        with pytest.raises(CommandError) :
+            client.profile(enable=0)
+    assert di4108_profile.PROFILER is None
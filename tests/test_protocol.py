@@ -0,0 +1,101 @@
+'''
+Tests of the framed and legacy protocols of the servers.
+'''
+import json
+import socket
+import pytest
+from di4108_protocol import NEGOTIATE, PROTOCOL_VERSION, HEADER, OP, FLAG_JSON, FLAG_ERROR, MAX_REQUEST_BODY, \
+    ProtocolError, encode_header, decode_header, negotiate, send_frame, recv_frame, check_request_length
+from di4108_server import MyHTMLParser
+
+def connect(port):
+    sock=socket.create_connection(('localhost',port),10.0)
+    negotiate(sock)
+    return sock
+
+def legacy_request(port,request):
+    with socket.create_connection(('localhost',port),10.0) as sock :
+        sock.sendall(request.encode())
+        reply=bytearray()
+        while True :
+            data=sock.recv(65536)
+            if len(data)==0 :
+                return bytes(reply)
+            reply+=data
+
+def test_header_round_trip():
+    header=encode_header(OP.STORE,FLAG_JSON,123456,2**40)
+    assert len(header)==HEADER.size
+    assert decode_header(header)==(OP.STORE,FLAG_JSON,123456,2**40)
+    with pytest.raises(ProtocolError) :
+        decode_header(header[:-1])
+
+def test_legacy_parser_items():
+    parser=MyHTMLParser()
+    items=parser.feed('<init>{"fs":1000}</init><trig_pulse>')
+    assert items==[('start','init'),('data','{"fs":1000}'),('end','init'),('start','trig_pulse')]
+    assert parser.feed('<store>')==parser.items==[('start','store')] #Each request starts afresh
+
+def test_request_length_limit():
+    check_request_length(MAX_REQUEST_BODY)
+    with pytest.raises(ProtocolError) :
+        check_request_length(MAX_REQUEST_BODY+1)
+
+def test_negotiation(any_server):
+    with socket.create_connection(('localhost',any_server),10.0) as sock :
+        sock.sendall(NEGOTIATE)
+        assert sock.recv(1)==bytes([PROTOCOL_VERSION])
+
+def test_framed_pipelined_requests(any_server):
+    with connect(any_server) as sock :
+        #Several requests before reading any reply - replies come back in order, by request id
+        send_frame(sock,OP.INIT,{'fs':10000,'chans':2,'n_samps_post':100},request_id=1)
+        send_frame(sock,OP.PING,request_id=2)
+        send_frame(sock,OP.GET_SETTINGS,request_id=3)
+        (opcode,flags,request_id,body)=recv_frame(sock)
+        assert (opcode,request_id,len(body))==(OP.INIT,1,0) #Empty acknowledgement
+        (opcode,flags,request_id,body)=recv_frame(sock)
+        assert (opcode,request_id)==(OP.PING,2)
+        assert flags & FLAG_JSON
+        assert set(json.loads(bytes(body)))=={'t_recv','t_send'}
+        (opcode,flags,request_id,body)=recv_frame(sock)
+        assert request_id==3
+        settings=json.loads(bytes(body))
+        assert (settings['fs'],settings['chans'],settings['n_samps_post'])==(10000,[0,1],100)
+
+def test_framed_error_keeps_connection(any_server):
+    with connect(any_server) as sock :
+        send_frame(sock,OP.GET_SEG,{'mode':'nonsense'},request_id=5)
+        (opcode,flags,request_id,body)=recv_frame(sock)
+        assert request_id==5
+        assert flags & FLAG_ERROR
+        send_frame(sock,99,request_id=6) #Unknown opcode
+        (opcode,flags,request_id,body)=recv_frame(sock)
+        assert request_id==6
+        assert flags & FLAG_ERROR
+        assert b'Unsupported opcode' in bytes(body)
+        send_frame(sock,OP.PING,request_id=7) #Still in step
+        (opcode,flags,request_id,body)=recv_frame(sock)
+        assert (request_id,flags & FLAG_ERROR)==(7,0)
+
+def test_oversized_request_refused(any_server):
+    with connect(any_server) as sock :
+        #Header alone, claiming an enormous body - refused at once, without reading the body
+        sock.sendall(encode_header(OP.INIT,FLAG_JSON,9,2**63))
+        (opcode,flags,request_id,body)=recv_frame(sock)
+        assert request_id==9
+        assert flags & FLAG_ERROR
+        assert b'exceeds' in bytes(body)
+        assert sock.recv(1)==b'' #Connection closed
+
+def test_legacy_commands(any_server):
+    legacy_request(any_server,'<init>{"fs":10000,"chans":2,"n_samps_post":100}</init>')
+    settings=json.loads(legacy_request(any_server,'<get_settings>'))
+    assert settings['n_samps_post']==100
+    legacy_request(any_server,'<trig_pulse>')
+    n_bytes=int(legacy_request(any_server,'<query_data_length>'))
+    assert n_bytes>0
+    assert len(legacy_request(any_server,'<store>'))==n_bytes
+    #Several commands in one request, run in order
+    reply=legacy_request(any_server,'<init>{"n_samps_post":200}</init><trig_pulse><query_data_length>')
+    assert int(reply)>0
@@ -0,0 +1,61 @@
+'''
+Tests of reading the device in a process of its own (di4108_reader).
+'''
+import threading
+import numpy
+import pytest
+import di4108_server
+from di4108_reader import ReaderProxy
+from di4108_decode import demux
+from di4108_client import DI4108Client
+
+@pytest.fixture
+def proxy():
+    proxy=ReaderProxy(simulate={'realtime':False},fs=10000,chans=2)
+    yield proxy
+    proxy.close()
+
+def test_settings_mirrored(proxy):
+    assert proxy.fs==10000
+    assert proxy.record_layout()['number_records']==2
+    proxy.__init__(fs=5000,chans=3,dig_in=True)
+    assert proxy.fs==5000
+    assert proxy.record_layout()['number_records']==4
+    assert proxy.process.is_alive()
+
+def test_pulse_through_ring(proxy):
+    chunks=[]
+    (data,elapsed_time,raw)=proxy.trig_data_pulse(0.1,on_read=lambda chunk,read_time : chunks.append(bytes(chunk)))
+    assert len(chunks)>1
+    assert b''.join(chunks)==raw
+    assert len(raw)>=1000*2*2
+    assert numpy.array_equal(data,numpy.frombuffer(raw,dtype='<u2'))
+    assert not proxy.t_start is None
+
+def test_reader_errors_reported(proxy):
+    with pytest.raises(IOError) :
+        proxy.__init__(fs=10000,chans=2,v_range='bad')
+    assert proxy.process.is_alive()
+
+def test_close_stops_process():
+    proxy=ReaderProxy(simulate={'realtime':False},fs=1000,chans=1)
+    process=proxy.process
+    proxy.close()
+    assert not process.is_alive()
+
+def test_server_site(site_port):
+    di4108_server.add_site(site_port,reader_process=True,simulate={'realtime':False})
+    server=di4108_server.ThreadedTCPServer(('localhost',site_port),di4108_server.ThreadedTCPRequestHandler)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    try :
+        with DI4108Client('localhost',site_port,timeout=60.0) as client :
+            client.init(fs=10000,chans=3,n_samps_post=3000)
+            status=client.acquire(60.0)
+            (array,desc)=client.store('int16')
+            raw=client.store_raw()
+        assert isinstance(di4108_server.SITES[site_port].device,ReaderProxy)
+        assert array.shape==(3,status['samples'])
+        assert numpy.array_equal(array,demux(raw,3))
+    finally :
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,49 @@
+'''
+Tests of the process-wide settings cache (di4108_server.SettingsCache).
+'''
+import os
+import di4108_server
+from di4108_server import SettingsCache
+from di4108_client import DI4108Client
+
+def test_version_bumped_on_change(tmp_path):
+    cache=SettingsCache(str(tmp_path/'settings.json'))
+    assert not cache.load() and cache.get()==(0,None)
+    assert cache.update('{"fs": 1000}')==1
+    assert cache.update('{"fs": 1000}')==1 #Unchanged
+    assert cache.update('{"fs": 2000}')==2
+    assert cache.get()==(2,'{"fs": 2000}')
+    #A fresh cache loads the saved settings once
+    reloaded=SettingsCache(str(tmp_path/'settings.json'))
+    assert reloaded.load() and reloaded.load()
+    assert reloaded.get()==(1,'{"fs": 2000}')
+
+def test_saved_atomically(tmp_path,monkeypatch):
+    path=str(tmp_path/'settings.json')
+    cache=SettingsCache(path)
+    cache.update('old')
+    renames=[]
+    replace=os.replace
+    def recording_replace(src,dst) :
+        #At the moment of the rename, the file still holds the old settings, complete
+        renames.append((src,dst,open(dst).read(),open(src).read()))
+        replace(src,dst)
+    monkeypatch.setattr(di4108_server.os,'replace',recording_replace)
+    cache.update('new')
+    cache.update('new')
+    assert renames==[(path+'.tmp',path,'old','new')]
+    assert open(path).read()=='new'
+    assert os.listdir(str(tmp_path))==['settings.json']
+
+def test_other_connection_reapplies(sim_server):
+    with DI4108Client('localhost',sim_server) as a, DI4108Client('localhost',sim_server) as b :
+        a.init(fs=10000,chans=2,n_samps_post=2000)
+        b.ping()
+        version=di4108_server.SITES[sim_server].settings.version
+        a.init(fs=10000,chans=2,n_samps_post=500)
+        assert di4108_server.SITES[sim_server].settings.version==version+1
+        #b re-applies the changed settings before its next command, so its pulse is a's length
+        job=b.trig_pulse()
+        assert job['expected_samples']==500
+        b.wait(job['job'],30.0)
+        assert b.get_settings()['n_samps_post']==500
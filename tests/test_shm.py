@@ -0,0 +1,85 @@
+'''
+Tests of the shared-memory handoff of shots and live data (di4108_shm).
+'''
+import multiprocessing
+import numpy
+import pytest
+from di4108_shm import ShmRing, ShmOverrun, ShmShotStore, SharedShot, attach
+
+@pytest.fixture
+def ring():
+    ring=ShmRing(capacity=1000)
+    yield ring
+    ring.close()
+
+def test_ring_wraps(ring):
+    reader=ShmRing(ring.name,create=False)
+    assert reader.capacity==1000
+    position=0
+    sent=b''
+    received=b''
+    for i in range(10) :
+        chunk=bytes([i])*(173+i)
+        ring.write(chunk)
+        sent+=chunk
+        (data,position)=reader.read(position)
+        received+=data
+    assert received==sent
+    assert position==ring.written==len(sent)
+    reader.close()
+    assert ring.read(position-10)[0]==sent[-10:] #Writer's segment survives a reader detaching
+
+def test_ring_overrun(ring):
+    ring.write(b'a'*600)
+    ring.write(b'b'*600)
+    with pytest.raises(ShmOverrun) :
+        ring.read(0,100)
+    with pytest.raises(ValueError) :
+        ring.read(1100,200) #Not written yet
+    with pytest.raises(ValueError) :
+        ring.write(b'c'*1001)
+
+def read_shared_shot(desc,queue):
+    shot=SharedShot(desc)
+    array=shot.array()
+    queue.put((array.sum(dtype=numpy.int64),array.shape,shot.valid()))
+    del array
+    shot.close()
+
+def test_shot_store_in_another_process():
+    store=ShmShotStore('di4108_test',n_slots=2)
+    try :
+        data=numpy.arange(3000,dtype='<i2')
+        desc=store.publish(data,layout={'number_records':3},job=7)
+        assert (desc['seq'],desc['job'],desc['length'])==(1,7,6000)
+        context=multiprocessing.get_context('spawn')
+        queue=context.Queue()
+        process=context.Process(target=read_shared_shot,args=(desc,queue))
+        process.start()
+        (total,shape,valid)=queue.get(timeout=30.0)
+        process.join(30.0)
+        assert (total,shape,valid)==(data.sum(),(1000,3),True)
+        #A reader's exit must not unlink the server's segment
+        SharedShot(desc).close()
+    finally :
+        store.close()
+
+def test_slot_reuse_invalidates():
+    store=ShmShotStore('di4108_test',n_slots=2)
+    try :
+        first=store.publish(b'\x01\x00'*10,layout={'number_records':1})
+        shot=SharedShot(first)
+        assert shot.valid() and bytes(shot.data)==b'\x01\x00'*10
+        second=store.publish(b'\x02\x00'*10,layout={'number_records':1})
+        assert second['name']!=first['name'] and shot.valid()
+        third=store.publish(b'\x03\x00'*5,layout={'number_records':1})
+        assert third['name']==first['name'] #Fits - slot reused
+        assert not shot.valid()
+        shot.close()
+        fourth=store.publish(b'\x04\x00'*50,layout={'number_records':1})
+        assert fourth['name']!=second['name'] #Outgrew slot - replaced
+        assert store.latest==fourth
+    finally :
+        store.close()
+    with pytest.raises(FileNotFoundError) :
+        attach(fourth['name'])
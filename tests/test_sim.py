@@ -0,0 +1,47 @@
+'''
+Tests of the simulated DI-4108, through DI4108_WRAPPER.
+'''
+import numpy
+import pytest
+from digitizer_models import DI4108_WRAPPER
+from di4108_sim import SimulatedDI4108
+from di4108_decode import demux, convert
+
+def shot_records(device,raw):
+    '''
+    Return (records as convert_data converts them, records as di4108_decode.convert
+    converts them) of whole samples of raw.
+    '''
+    n=device.number_records
+    raw=raw[:(len(raw)//(2*n))*2*n]
+    expected=numpy.array(device.convert_data(DI4108_WRAPPER.convert_bytes_to_int(raw)))
+    return (expected,convert(demux(raw,n),device.record_layout()))
+
+@pytest.mark.parametrize('rate',[40.0,1234.5,2600.0,4990.0])
+def test_rate_round_trip(rate):
+    device=DI4108_WRAPPER(fs=10000,chans=1,rate_in=True,rate_range=5000,\
+        dev=SimulatedDI4108(realtime=False,rate=rate))
+    (data,elapsed_time,raw)=device.trig_data_pulse(0.05)
+    (converted,vectorized)=shot_records(device,raw)
+    #Quantized to 1/65536 of the range
+    assert numpy.allclose(converted[1],rate,atol=5000/65536.0)
+    assert numpy.allclose(vectorized[1],rate,atol=5000/65536.0)
+
+def test_counter_round_trip():
+    device=DI4108_WRAPPER(fs=10000,chans=1,counter_in=True,dev=SimulatedDI4108(realtime=False,counter_rate=2000.0))
+    (data,elapsed_time,raw)=device.trig_data_pulse(0.05)
+    (converted,vectorized)=shot_records(device,raw)
+    t=numpy.arange(converted.shape[1])/10000.0
+    assert numpy.array_equal(converted[1],numpy.floor(t*2000.0+1E-9))
+    assert numpy.array_equal(vectorized[1],converted[1])
+
+def test_waveforms_and_trigger():
+    sim=SimulatedDI4108(realtime=False,waveforms={0:('dc',{'offset':1.5}),1:('square',{'freq':100,'amplitude':2})},\
+        trigger_times=[0.01],trigger_width=0.005)
+    device=DI4108_WRAPPER(fs=10000,chans=2,v_range=5,dig_in=True,dev=sim)
+    (data,elapsed_time,raw)=device.trig_data_pulse(0.05)
+    (converted,vectorized)=shot_records(device,raw)
+    assert numpy.allclose(converted[0],1.5,atol=5/32768.0)
+    assert set(numpy.round(converted[1],3))=={-2.0,2.0}
+    triggered=numpy.nonzero(converted[2].astype(int)&0b01000000)[0]
+    assert (triggered[0],len(triggered))==(100,50)
@@ -0,0 +1,121 @@
+'''
+Tests of the store and get_seg commands against DI4108_WRAPPER's own conversion, and of
+compressed transfers, and of readers of a shot while the next replaces it.
+'''
+import socket
+import threading
+import numpy
+import pytest
+import di4108_server
+from digitizer_models import DI4108_WRAPPER
+from di4108_sim import SimulatedDI4108
+from di4108_server import DI4108_SETTING_KEYS
+from di4108_client import DI4108Client, CommandError
+from di4108_decode import demux, reduce, raw_to_int16
+from di4108_protocol import OP, negotiate, send_frame, recv_frame
+
+SETTINGS={'fs':10000,'chans':4,'v_range':5,'dig_in':True,'rate_in':True,'counter_in':True,'n_samps_post':3000}
+
+@pytest.fixture
+def shot(sim_server):
+    '''
+    Client connected to a server holding one shot; yields (client, raw bytes of the shot,
+    the shot as convert_data converts it - one row per record).
+    '''
+    with DI4108Client('localhost',sim_server) as client :
+        client.init(**SETTINGS)
+        client.acquire(30.0)
+        raw=bytes(client.store_raw())
+        settings=client.get_settings()
+        #A device of the same settings, for its conversion
+        model=DI4108_WRAPPER(dev=SimulatedDI4108(realtime=False),\
+            **dict([(k,settings[k]) for k in DI4108_SETTING_KEYS if k in settings]))
+        n_samps=len(raw)//(2*model.number_records)
+        values=DI4108_WRAPPER.convert_bytes_to_int(raw[:2*n_samps*model.number_records])
+        yield (client,raw,numpy.array(model.convert_data(values),dtype=numpy.float64))
+
+def test_store_formats(shot):
+    (client,raw,expected)=shot
+    n_records=expected.shape[0]
+    (int16,desc)=client.store('int16')
+    assert numpy.array_equal(int16,demux(raw,n_records))
+    assert desc['layout']['number_records']==n_records
+    (float32,desc)=client.store('float32',byteorder='big')
+    assert float32.dtype==numpy.dtype('>f4')
+    assert numpy.allclose(float32,expected,rtol=1E-6,atol=1E-6*numpy.abs(expected).max())
+    (scaled,desc)=client.get_shot()
+    assert numpy.allclose(scaled,expected,rtol=1E-6,atol=1E-6*numpy.abs(expected).max())
+
+@pytest.mark.parametrize('mode',['stride','mean','minmax'])
+def test_get_seg(shot,mode):
+    (client,raw,expected)=shot
+    (offset,length,chans,dec)=(100,2000,[0,3,5],10)
+    (seg,desc)=client.get_seg(offset=offset,length=length,chans=chans,dec=dec,mode=mode,format='float32')
+    want=reduce(expected[chans,offset:offset+length],dec,mode)
+    assert seg.shape==want.shape
+    assert numpy.allclose(seg,want,rtol=1E-5,atol=1E-5*numpy.abs(expected).max())
+    assert desc['fs']==SETTINGS['fs']/dec
+    (seg,desc)=client.get_seg(offset=offset,length=length,chans=chans,dec=dec,mode=mode)
+    want=reduce(demux(raw,expected.shape[0])[chans,offset:offset+length],dec,mode)
+    if mode=='mean' :
+        assert numpy.allclose(seg,want)
+    else :
+        assert numpy.array_equal(seg,want)
+
+@pytest.mark.parametrize('format',['raw','int16','float32'])
+@pytest.mark.parametrize('encoding',['raw','zlib'])
+def test_store_compressed(shot,format,encoding):
+    (client,raw,expected)=shot
+    n_records=expected.shape[0]
+    (array,desc,stats)=client.store_compressed(format=format,encoding=encoding,chunk_samples=700)
+    assert desc['delta']==(format!='float32') #Default delta follows the format
+    if format=='raw' :
+        n_samps=len(raw)//(2*n_records)
+        assert numpy.array_equal(array,raw_to_int16(raw)[:n_samps*n_records].reshape(n_samps,n_records))
+    elif format=='int16' :
+        assert numpy.array_equal(array,demux(raw,n_records))
+    else :
+        (float32,desc)=client.store('float32')
+        assert numpy.array_equal(array,float32)
+    assert stats['server']['raw_bytes']==array.nbytes
+    if format!='float32' :
+        (array,desc,stats)=client.store_compressed(format=format,encoding=encoding,delta=False)
+        assert not desc['delta']
+        assert array.nbytes==stats['server']['raw_bytes']
+
+def test_store_compressed_rejects_float_delta(shot):
+    (client,raw,expected)=shot
+    with pytest.raises(CommandError) :
+        client.store_compressed(format='float32',delta=True)
+    assert client.ping() #Connection still usable
+
+def test_reader_not_blocked_by_new_shot(sim_server,monkeypatch):
+    site=di4108_server.SITES[sim_server]
+    #A slow reader: its reply of a whole shot stops halfway until released
+    sending=threading.Event()
+    release=threading.Event()
+    send_raw=di4108_server.ThreadedTCPRequestHandler.send_raw
+    def stalling_send_raw(self,payload) :
+        view=memoryview(payload).cast('B')
+        if len(view)>1000 :
+            send_raw(self,view[:len(view)//2])
+            sending.set()
+            release.wait(30.0)
+            view=view[len(view)//2:]
+        send_raw(self,view)
+    monkeypatch.setattr(di4108_server.ThreadedTCPRequestHandler,'send_raw',stalling_send_raw)
+    with DI4108Client('localhost',sim_server) as client, socket.create_connection(('localhost',sim_server),30.0) as sock :
+        client.init(fs=10000,chans=4,n_samps_post=2000)
+        client.acquire(30.0)
+        old=site.last_shot()
+        negotiate(sock)
+        send_frame(sock,OP.STORE,request_id=1)
+        assert sending.wait(30.0)
+        #Meanwhile, a new shot is acquired, swapped in, and read by another client
+        client.acquire(30.0)
+        assert not site.last_shot() is old
+        assert client.query_data_length()==len(site.last_shot().data)
+        release.set()
+        (opcode,flags,request_id,body)=recv_frame(sock)
+        assert (opcode,flags,request_id)==(OP.STORE,0,1)
+        assert bytes(body)==old.data #The shot as it was asked for, whole
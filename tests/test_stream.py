@@ -0,0 +1,211 @@
+'''
+Tests of the live data streaming service.
+'''
+import time
+import array
+import socket
+import asyncio
+import threading
+import pytest
+from conftest import free_site_port
+from di4108_stream import DataRing, Subscriber, StreamTCPServer, StreamRequestHandler, StatusRequestHandler, \
+    serve_subscriber, serve_status
+from di4108_protocol import OP, FLAG_ERROR, NEGOTIATE, HEADER, encode_header, negotiate, send_frame, recv_frame
+
+def threaded_service(ring,handler_class,errors):
+    class Server(StreamTCPServer) :
+        def handle_error(self,request,client_address) :
+            import sys
+            errors.append(sys.exc_info()[1])
+    server=Server(('localhost',0),ring,handler_class)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+def async_service(ring,serve,errors):
+    loop=asyncio.new_event_loop()
+    def exception_handler(loop,context) :
+        error=context.get('exception',context['message'])
+        if not isinstance(error,asyncio.CancelledError) : #Handlers cancelled on shutdown
+            errors.append(error)
+    loop.set_exception_handler(exception_handler)
+    server=loop.run_until_complete(asyncio.start_server(lambda r,w : serve(r,w,ring),'localhost',0))
+    thread=threading.Thread(target=loop.run_forever,daemon=True)
+    thread.start()
+    yield server.sockets[0].getsockname()[1]
+
+    async def shutdown():
+        server.close()
+        tasks=[t for t in asyncio.all_tasks() if not t is asyncio.current_task()]
+        for t in tasks :
+            t.cancel()
+        await asyncio.gather(*tasks,return_exceptions=True)
+    asyncio.run_coroutine_threadsafe(shutdown(),loop).result(5.0)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5.0)
+    loop.close()
+
+@pytest.fixture(params=['threaded','async'])
+def stream_server(request):
+    '''
+    Streaming service of a fresh ring, on threads and on an event loop in turn; yields (port,
+    ring, errors), errors being the exceptions raised in its handlers.
+    '''
+    errors=[]
+    ring=DataRing(capacity=16)
+    if request.param=='threaded' :
+        service=threaded_service(ring,StreamRequestHandler,errors)
+    else :
+        service=async_service(ring,serve_subscriber,errors)
+    yield (next(service),ring,errors)
+    next(service,None)
+
+@pytest.fixture(params=['threaded','async'])
+def status_server(request):
+    '''
+    State broadcast service of a fresh ring, as stream_server.
+    '''
+    errors=[]
+    ring=DataRing(capacity=64)
+    ring.publish(b'0 0 0 0 0 0\n')
+    if request.param=='threaded' :
+        service=threaded_service(ring,StatusRequestHandler,errors)
+    else :
+        service=async_service(ring,serve_status,errors)
+    yield (next(service),ring,errors)
+    next(service,None)
+
+def test_subscriber_policies():
+    ring=DataRing(capacity=16)
+    drop=Subscriber(ring,'drop',max_backlog=4)
+    decimate=Subscriber(ring,'decimate',max_backlog=4)
+    disconnect=Subscriber(ring,'disconnect',max_backlog=4)
+    for i in range(10) :
+        ring.publish(bytes([i]))
+    assert [c for (seq,c) in drop.next_chunks(0)]==[bytes([i]) for i in range(6,10)]
+    assert drop.dropped==6
+    chunks=decimate.next_chunks(0)
+    assert len(chunks)<=4 and chunks[-1][1]==bytes([9])
+    assert disconnect.next_chunks(0)==[] and disconnect.closed
+
+def test_subscribe_and_receive(stream_server):
+    (port,ring,errors)=stream_server
+    with socket.create_connection(('localhost',port),5.0) as sock :
+        negotiate(sock)
+        send_frame(sock,OP.SUBSCRIBE,{'policy':'drop','max_backlog':8},request_id=3)
+        (opcode,flags,request_id,body)=recv_frame(sock)
+        assert (opcode,flags,request_id)==(OP.SUBSCRIBE,0,3)
+        time.sleep(0.1)
+        ring.publish(array.array('B',b'abcd')) #As read from the device
+        ring.mark_end()
+        (opcode,flags,seq,body)=recv_frame(sock)
+        assert (opcode,bytes(body))==(OP.STREAM_DATA,b'abcd')
+        (opcode,flags,seq2,body)=recv_frame(sock)
+        assert (seq2,len(body))==(seq+1,0) #End of shot
+    assert errors==[]
+
+def test_bad_subscribe_request(stream_server):
+    (port,ring,errors)=stream_server
+    with socket.create_connection(('localhost',port),5.0) as sock :
+        negotiate(sock)
+        send_frame(sock,OP.STORE,request_id=4)
+        (opcode,flags,request_id,body)=recv_frame(sock)
+        assert flags & FLAG_ERROR and request_id==4
+    with socket.create_connection(('localhost',port),5.0) as sock :
+        negotiate(sock)
+        sock.sendall(encode_header(OP.SUBSCRIBE,0,5,2**40)) #Oversized body
+        (opcode,flags,request_id,body)=recv_frame(sock)
+        assert flags & FLAG_ERROR and b'exceeds' in bytes(body)
+    assert errors==[]
+
+def test_disconnect_before_subscribing(stream_server):
+    (port,ring,errors)=stream_server
+    #Negotiate, then close - with no header, and with a short one
+    for partial in (b'',encode_header(OP.SUBSCRIBE,0,1,0)[:HEADER.size-3]) :
+        with socket.create_connection(('localhost',port),5.0) as sock :
+            sock.sendall(NEGOTIATE)
+            assert len(sock.recv(1))==1
+            sock.sendall(partial)
+    time.sleep(0.3)
+    assert errors==[]
+
+def recv_exactly(sock,n):
+    data=b''
+    while len(data)<n :
+        piece=sock.recv(n-len(data))
+        assert len(piece)>0
+        data+=piece
+    return data
+
+def test_bare_stream(stream_server):
+    (port,ring,errors)=stream_server
+    with socket.create_connection(('localhost',port),5.0) as sock :
+        time.sleep(0.8) #Sends nothing - a bare data stream, after the subscribe timeout
+        ring.publish(b'abcd')
+        ring.publish(b'efgh')
+        assert recv_exactly(sock,8)==b'abcdefgh'
+    assert errors==[]
+
+def test_status_lines(status_server):
+    (port,ring,errors)=status_server
+    with socket.create_connection(('localhost',port),5.0) as sock :
+        rfile=sock.makefile('rb')
+        assert rfile.readline()==b'0 0 0 0 0 0\n' #Current status at once
+        ring.publish(b'1 0 100 0 0 0\n')
+        ring.publish(b'0 0 100 100 0 0\n')
+        assert [rfile.readline(),rfile.readline()]==[b'1 0 100 0 0 0\n',b'0 0 100 100 0 0\n']
+    assert errors==[]
+
+def test_async_subscribers_hold_no_thread():
+    errors=[]
+    ring=DataRing(capacity=16)
+    service=async_service(ring,serve_subscriber,errors)
+    port=next(service)
+    n_threads=threading.active_count()
+    socks=[socket.create_connection(('localhost',port),5.0) for i in range(20)]
+    try :
+        for sock in socks :
+            negotiate(sock)
+            send_frame(sock,OP.SUBSCRIBE,request_id=1)
+            assert recv_frame(sock)[0]==OP.SUBSCRIBE
+        assert threading.active_count()==n_threads
+        ring.publish(b'xyz')
+        for sock in socks :
+            (opcode,flags,seq,body)=recv_frame(sock)
+            assert (opcode,bytes(body))==(OP.STREAM_DATA,b'xyz')
+        assert len(ring.notifiers)==1 #One wake-up per publish, however many subscribers
+    finally :
+        for sock in socks :
+            sock.close()
+        next(service,None)
+    assert errors==[]
+
+def test_tstat_follows_acquisition(sim_server):
+    import di4108_server
+    from di4108_server import STATE
+    from di4108_client import DI4108Client
+    site=di4108_server.SITES[sim_server]
+    servers=di4108_server.start_site_services('localhost',site)
+    try :
+        with DI4108Client('localhost',sim_server) as client :
+            client.init(fs=10000,chans=2,n_samps_post=2000)
+            with socket.create_connection(('localhost',site.tstat_port),5.0) as sock :
+                rfile=sock.makefile('rb')
+                rfile.readline() #Current status, armed by the connection
+                client.acquire(30.0)
+                lines=[]
+                while len(lines)==0 or lines[-1][0]!=STATE.IDLE :
+                    lines.append([int(v) for v in rfile.readline().split()])
+    finally :
+        for server in servers :
+            server.shutdown()
+            server.server_close()
+    #Each state of the pulse in turn, with the elapsed samples rising through RUNPOST
+    states=[l[0] for l in lines]
+    assert [s for (i,s) in enumerate(states) if i==0 or s!=states[i-1]]== \
+        [STATE.ARM,STATE.RUNPOST,STATE.POPROCESS,STATE.IDLE]
+    assert all([l[2]==2000 for l in lines])
+    elapsed=[l[3] for l in lines if l[0]==STATE.RUNPOST]
+    assert elapsed[0]==0 and elapsed==sorted(elapsed) and len(elapsed)>=5
+    assert lines[states.index(STATE.POPROCESS)][3]>=2000